@@ -1,4 +1,5 @@
 #!/bin/bash
-# Gather static files and then run gunicorn
+# Gather static files, bring the database up to date and then run gunicorn
 python townapi/manage.py collectstatic --noinput
+python townapi/manage.py migrate --noinput
 gunicorn -c gunicorn_conf.py --chdir townapi townapi.wsgi:application --reload
@@ -6,3 +6,18 @@ bind = "0.0.0.0:8000"
 loglevel = 'info'
 errorlog = '-'
 accesslog = '-'
+
+
+def post_worker_init(worker):
+    """
+        Warm up each worker (see api/warmup.py) before it starts handling
+        requests. The worker notifies the arbiter after each request and
+        before each retry, so that a long warm-up does not hit the worker
+        timeout.
+    """
+    from django.conf import settings
+    from api.warmup import warm_up
+
+    if settings.API_WARMUP_ON_START:
+        report = warm_up(heartbeat=worker.notify)
+        worker.log.info(report.summary())
@@ -0,0 +1,136 @@
+"""
+    admission.py
+
+    Provide cost-aware admission control for api requests.
+
+    Each request is given a cost class based on its endpoint and query (see
+    get_cost_class). Classes with a limit in API_ADMISSION_LIMITS may only
+    have that many requests running at once across all workers on the host;
+    any further requests are rejected straight away (see
+    AdmissionControlMiddleware) rather than queueing behind them. Classes
+    without a limit (e.g. cheap lookups) are always admitted. Batches are
+    admitted one sub-query at a time instead (see batch.py).
+
+    Limits are shared between workers using a set of lock files for each
+    class (one per slot) in API_ADMISSION_LOCK_DIR. Holding an exclusive
+    flock() on a file holds its slot, and the lock is released automatically
+    if the worker dies.
+"""
+import fcntl
+import os
+import random
+import re
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .dataset import get_dataset_version
+
+CHEAP = "cheap"
+MODERATE = "moderate"
+EXPENSIVE = "expensive"
+
+# Filters which limit an aggregation to part of the dataset
+AGGS_FILTERS = ("region_code", "department_code", "district_code")
+
+
+def _classify_aggs(request):
+    """ Aggregating over the whole dataset is expensive """
+    if any(request.GET.get(name) for name in AGGS_FILTERS):
+        return MODERATE
+    return EXPENSIVE
+
+
+def _classify_towns(request):
+    """ Deep offsets, large pages and sorting all need more work """
+    try:
+        offset = int(request.GET.get("offset", 0))
+        limit = int(request.GET.get("limit", 0))
+    except ValueError:
+        return CHEAP
+
+    if offset >= settings.API_ADMISSION_DEEP_OFFSET or \
+            limit >= settings.API_ADMISSION_LARGE_LIMIT:
+        return EXPENSIVE
+    if request.GET.get("ordering"):
+        return MODERATE
+    return CHEAP
+
+
+def _classify_columnar(request):
+    """ Files are cheap to send once they are built (and cached) """
+    # Imported here, since views imports this module (through batch.py)
+    from .views import TownsColumnarView
+
+    key = TownsColumnarView.get_cache_key(request.GET, get_dataset_version())
+    if key in caches[settings.API_RESPONSE_CACHE]:
+        return CHEAP
+    return EXPENSIVE
+
+
+# Rules for working out the cost class of a request, checked in order
+COST_RULES = (
+    (re.compile(r"^/(aggs|changes)/[a-z]+/?$"), _classify_aggs),
+    (re.compile(r"^/towns/columnar/?$"), _classify_columnar),
+    (re.compile(r"^/towns/top/?$"), lambda request: EXPENSIVE),
+    (re.compile(r"^/towns/?$"), _classify_towns),
+)
+
+
+def get_cost_class(request):
+    """
+        Work out the cost class of a request.
+
+        :returns: CHEAP, MODERATE or EXPENSIVE
+    """
+    for pattern, classify in COST_RULES:
+        if pattern.match(request.path_info):
+            return classify(request)
+    return CHEAP
+
+
+class AdmissionSlot:
+    """ A slot held by an admitted request, which must be released """
+
+    def __init__(self, descriptor=None):
+        self.descriptor = descriptor
+
+    def release(self):
+        """ Give the slot back to the pool """
+        if self.descriptor is not None:
+            fcntl.flock(self.descriptor, fcntl.LOCK_UN)
+            os.close(self.descriptor)
+            self.descriptor = None
+
+
+def acquire_slot(cost_class):
+    """
+        Try to take a slot for a request, without waiting.
+
+        :param cost_class: The cost class of the request
+        :returns: An AdmissionSlot, or None if the class is at its limit
+    """
+    limit = settings.API_ADMISSION_LIMITS.get(cost_class)
+    if limit is None:
+        return AdmissionSlot()
+
+    lock_dir = settings.API_ADMISSION_LOCK_DIR
+    os.makedirs(lock_dir, exist_ok=True)
+
+    # Start from a random slot so that workers do not all contend for the
+    # first one
+    start = random.randrange(limit) if limit else 0
+    for i in range(limit):
+        path = os.path.join(lock_dir, "{0}.{1}.lock".format(
+            cost_class, (start + i) % limit))
+        descriptor = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(descriptor)
+            continue
+
+        return AdmissionSlot(descriptor)
+
+    return None
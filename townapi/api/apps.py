@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # Bump the dataset version whenever any place or population changes,
+        # and take down the static snapshot once it no longer matches
+        from .dataset import dataset_changed, handle_place_changed
+        from .snapshot import handle_dataset_changed
+        from .models import (Department, District, Region, Town,
+                             TownPopulation, Vintage)
+
+        for model in (Region, Department, District, Town, Vintage,
+                      TownPopulation):
+            post_save.connect(handle_place_changed, sender=model)
+            post_delete.connect(handle_place_changed, sender=model)
+
+        dataset_changed.connect(handle_dataset_changed)
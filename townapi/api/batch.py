@@ -0,0 +1,280 @@
+"""
+    batch.py
+
+    Run several read-only API queries in one request (see BatchView), for
+    pages such as dashboards which would otherwise make many round trips.
+
+    Each sub-query is a path (which must resolve to one of BATCH_VIEWS) with
+    its query parameters. It is run by calling the endpoint's view directly,
+    skipping the middleware, so each result is the same data the individual
+    endpoint would send (using the same serializers). Identical sub-queries
+    are only run once.
+
+    Sub-queries are run on a pool of API_BATCH_WORKERS threads shared by the
+    whole process, so one batch cannot start more than that many queries at
+    once. Django gives each thread its own database connection (connections
+    cannot safely be shared between threads), so the pool's threads are
+    long-lived and keep their connections between batches (as far as
+    CONN_MAX_AGE allows).
+
+    Each sub-query takes an admission slot for its own cost class (see
+    admission.py), as if it had been sent on its own, so a batch weighs as
+    much as its sub-queries. Sub-queries which cannot get a slot straight
+    away are retried one at a time once the rest of the batch is done (so
+    they do not compete with the batch's own sub-queries), and fail with a
+    503 if there is still no slot.
+
+    All the results of a batch are checked to come from the same dataset
+    version, and the batch is re-run if the version changed while it was
+    running. This only guarantees consistent results for changes which are
+    committed in the same transaction as their version bump, as imports are
+    (see import_from_csv); a change saved through the admin is committed
+    just before its version is bumped.
+"""
+import io
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.db import close_old_connections
+from django.urls import Resolver404, resolve
+
+from .admission import acquire_slot, get_cost_class
+from .dataset import get_dataset_version
+
+logger = logging.getLogger(__name__)
+
+# Parts of the batch request which are passed on to each sub-query (so that
+# any links in the results point to the same host)
+FORWARDED_META = ("SERVER_NAME", "SERVER_PORT", "SCRIPT_NAME", "HTTP_HOST",
+                  "HTTP_X_FORWARDED_HOST", "HTTP_X_FORWARDED_PROTO",
+                  "REMOTE_ADDR", "wsgi.url_scheme")
+
+
+# The result of a sub-query which could not get an admission slot
+BUSY = (503, {"detail": "The server is too busy to run this query. Please "
+                        "try again later."})
+
+
+class BatchError(Exception):
+    """ Raised for a batch which is not in the expected format """
+
+
+class InconsistentBatch(Exception):
+    """ Raised when the dataset kept changing while a batch was running """
+
+
+class SubQuery:
+    """
+        One query in a batch.
+
+        :param path: The path of the endpoint to query
+        :param params: A dictionary of query parameters, whose values are
+                       strings or lists of strings
+    """
+
+    def __init__(self, path, params):
+        self.path = path
+        self.params = params
+        self.query_string = urlencode(sorted(params.items()), doseq=True)
+
+    @property
+    def key(self):
+        """ Identify identical sub-queries (whatever their parameter order) """
+        return self.path, self.query_string
+
+    def build_request(self, request):
+        """ Build a GET request for the sub-query, based on the batch one """
+        environ = {name: request.META[name]
+                   for name in FORWARDED_META
+                   if name in request.META}
+        environ.update({
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": self.path,
+            "QUERY_STRING": self.query_string,
+            "HTTP_ACCEPT": "application/json",
+            "wsgi.input": io.BytesIO(),
+        })
+        return WSGIRequest(environ)
+
+
+def parse_batch(data):
+    """
+        Parse the body of a batch request, which should be of the form:
+
+            {"queries": [{"id": <ID>, "path": <PATH>, "params": {...}}, ...]}
+
+        where the ids are optional (defaulting to each query's position).
+
+        :returns: An OrderedDict of SubQuery objects by id
+        :raises BatchError: If the body is not in this format
+    """
+    queries = data.get("queries") if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        raise BatchError("Expected a non-empty list of `queries`.")
+
+    max_queries = getattr(settings, "API_BATCH_MAX_QUERIES", None)
+    if max_queries is not None and len(queries) > max_queries:
+        raise BatchError("A batch can have at most {0} queries."
+                         .format(max_queries))
+
+    parsed = OrderedDict()
+    for position, query in enumerate(queries):
+        if not isinstance(query, dict) or \
+                not isinstance(query.get("path"), str):
+            raise BatchError("Query {0} must have a `path`."
+                             .format(position))
+
+        params = query.get("params", {})
+        if not isinstance(params, dict) or not all(
+                isinstance(value, (str, int, float)) or
+                (isinstance(value, list) and
+                 all(isinstance(item, (str, int, float)) for item in value))
+                for value in params.values()):
+            raise BatchError("The `params` of query {0} must map names to "
+                             "values or lists of values.".format(position))
+
+        query_id = str(query.get("id", position))
+        if query_id in parsed:
+            raise BatchError("Query id {0!r} is used more than once."
+                             .format(query_id))
+
+        parsed[query_id] = SubQuery(query["path"], params)
+
+    return parsed
+
+
+def _get_view(path):
+    """
+        Resolve a sub-query's path to its view.
+
+        :returns: A tuple of (view, args, kwargs, error), where error is a
+                  (status, data) tuple if the path cannot be queried
+    """
+    try:
+        match = resolve(path)
+    except Resolver404:
+        return None, (), {}, (404, {"detail": "Not found."})
+
+    # Imported here as views.py imports this module
+    from .views import BATCH_VIEWS
+    view_class = getattr(match.func, "view_class", None)
+    if view_class is None or not issubclass(view_class, BATCH_VIEWS):
+        return None, (), {}, (400, {"detail": "This endpoint cannot be "
+                                              "batched."})
+
+    return match.func, match.args, match.kwargs, None
+
+
+def run_sub_query(request, sub_query):
+    """
+        Run one sub-query.
+
+        :returns: A (status, data) tuple, which is BUSY if the sub-query
+                  could not get an admission slot
+    """
+    view, args, kwargs, error = _get_view(sub_query.path)
+    if error is not None:
+        return error
+
+    sub_request = sub_query.build_request(request)
+    slot = acquire_slot(get_cost_class(sub_request))
+    if slot is None:
+        return BUSY
+
+    try:
+        response = view(sub_request, *args, **kwargs)
+        return response.status_code, getattr(response, "data", None)
+    except Exception:
+        logger.exception("Error running batched query %s?%s",
+                         sub_query.path, sub_query.query_string)
+        return 500, {"detail": "A server error occurred."}
+    finally:
+        slot.release()
+
+
+def _run_in_worker(request, sub_query):
+    """ Run a sub-query on a pool thread, tidying its connection up after """
+    try:
+        return run_sub_query(request, sub_query)
+    finally:
+        close_old_connections()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """ Get the thread pool shared by every batch (created on first use) """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.API_BATCH_WORKERS,
+                thread_name_prefix="api-batch")
+        return _executor
+
+
+def _run_unique(request, sub_queries):
+    """
+        Run each distinct sub-query once.
+
+        :returns: A dictionary of (status, data) tuples by sub-query key
+    """
+    unique = OrderedDict((sub_query.key, sub_query)
+                         for sub_query in sub_queries)
+
+    if settings.API_BATCH_WORKERS < 1 or len(unique) == 1:
+        responses = {key: run_sub_query(request, sub_query)
+                     for key, sub_query in unique.items()}
+    else:
+        executor = _get_executor()
+        futures = {key: executor.submit(_run_in_worker, request, sub_query)
+                   for key, sub_query in unique.items()}
+        responses = {key: future.result() for key, future in futures.items()}
+
+    # Retry the sub-queries which were only refused a slot because of the
+    # rest of the batch
+    for key, response in responses.items():
+        if response is BUSY:
+            responses[key] = run_sub_query(request, unique[key])
+
+    return responses
+
+
+def run_batch(request, sub_queries):
+    """
+        Run a batch of sub-queries against a single version of the dataset.
+
+        :param sub_queries: An OrderedDict of SubQuery objects by id (see
+                            parse_batch)
+        :returns: A tuple of (dataset version, results), where results is an
+                  OrderedDict by id of {"status": ..., "data": ...} for
+                  successful sub-queries, and {"status": ..., "error": ...}
+                  for failed ones
+        :raises InconsistentBatch: If the dataset changed during every
+                                   attempt (API_BATCH_RETRIES + 1)
+    """
+    for _ in range(settings.API_BATCH_RETRIES + 1):
+        version = get_dataset_version()
+        responses = _run_unique(request, sub_queries.values())
+        if get_dataset_version() == version:
+            break
+    else:
+        raise InconsistentBatch()
+
+    results = OrderedDict()
+    for query_id, sub_query in sub_queries.items():
+        status, data = responses[sub_query.key]
+        results[query_id] = OrderedDict((
+            ("status", status),
+            ("data" if status < 400 else "error", data),
+        ))
+
+    return version, results
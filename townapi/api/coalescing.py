@@ -0,0 +1,171 @@
+"""
+    coalescing.py
+
+    Provide single-flight coalescing of identical concurrent computations.
+
+    When several threads ask for the same key at once, only the first (the
+    leader) runs the computation, and the others wait for it and share its
+    result. Optionally, leaders in different workers can also coordinate
+    through a shared cache: only one worker computes the result, and the
+    others pick it up from the cache.
+
+    Counters of how often this happens are kept for each worker (see
+    get_coalescing_stats).
+"""
+import os
+import threading
+import time
+from collections import Counter
+
+# How often to check the shared cache for another worker's result
+SHARED_POLL_INTERVAL = 0.01
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    """ Increment one of the coalescing counters """
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def get_coalescing_stats():
+    """
+        Get the coalescing counters for this worker:
+
+        - leaders: computations which were actually run
+        - coalesced: requests which shared another thread's result
+        - shared: requests which used another worker's result
+        - timeouts: requests which gave up waiting and ran themselves
+
+        :returns: A dictionary of counts
+    """
+    with _stats_lock:
+        return {name: _stats[name]
+                for name in ("leaders", "coalesced", "shared", "timeouts")}
+
+
+class _Flight:
+    """ A computation which is in progress """
+    __slots__ = ("done", "result", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+        Coalesce concurrent calls with the same key into one computation.
+
+        :param timeout: How long (in seconds) to wait for another thread or
+                        worker before running the computation anyway
+        :param cache: A Django cache shared between workers, or None to only
+                      coalesce within this worker
+        :param cache_ttl: How long (in seconds) a result is kept in the
+                          shared cache for other workers to pick up
+    """
+
+    def __init__(self, timeout, cache=None, cache_ttl=5):
+        self.timeout = timeout
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        """
+            Run compute() for the given key, unless another thread is already
+            doing so, in which case wait for its result.
+
+            :param key: A string identifying the computation
+            :param compute: A function taking no arguments. Its result must
+                            be picklable if a shared cache is used, and None
+                            means the result cannot be shared.
+            :returns: A tuple of (result, coalesced), where coalesced is True
+                      if the result came from another thread or worker
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+
+        if not leader:
+            if flight.done.wait(self.timeout) and flight.result is not None:
+                _count("coalesced")
+                return flight.result, True
+
+            if not flight.done.is_set():
+                _count("timeouts")
+            return compute(), False
+
+        try:
+            result, claimed = self.wait_for_other_worker(key)
+            coalesced = result is not None
+
+            if not coalesced:
+                result = self.compute_shared(key, compute, claimed)
+
+            flight.result = result
+            return result, coalesced
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def wait_for_other_worker(self, key):
+        """
+            Pick up another worker's recent result for the key if there is
+            one, or claim the key in the shared cache. If another worker has
+            already claimed it, wait for that worker's result.
+
+            :returns: A tuple of (result, claimed), where result is the other
+                      worker's result (or None if this worker should compute
+                      the result itself) and claimed is True if this worker
+                      now holds the claim on the key
+        """
+        if self.cache is None:
+            return None, False
+
+        lock_key = "api:coalescing:lock:" + key
+        result_key = "api:coalescing:result:" + key
+        deadline = time.monotonic() + self.timeout
+
+        while True:
+            result = self.cache.get(result_key)
+            if result is not None:
+                _count("shared")
+                return result, False
+
+            if self.cache.add(lock_key, os.getpid(), self.timeout):
+                return None, True
+
+            if time.monotonic() > deadline:
+                _count("timeouts")
+                return None, False
+            time.sleep(SHARED_POLL_INTERVAL)
+
+    def compute_shared(self, key, compute, claimed):
+        """
+            Run the computation, publishing the result to other workers if
+            this worker holds the claim on the key.
+        """
+        _count("leaders")
+
+        if not claimed:
+            return compute()
+
+        try:
+            result = compute()
+            if result is not None:
+                self.cache.set("api:coalescing:result:" + key,
+                               result,
+                               self.cache_ttl)
+            return result
+        finally:
+            self.cache.delete("api:coalescing:lock:" + key)
@@ -0,0 +1,209 @@
+"""
+    columnar.py
+
+    Encode and decode the columnar bulk-download format for towns.
+
+    The format is designed to be loaded straight into dataframes (or memory
+    mapped) without parsing a JSON object per town. It is laid out as
+    follows, with all integers little-endian:
+
+        magic          8 bytes    b"TOWNCOL1"
+        header_length  uint32     Length of the header in bytes
+        header         JSON       Padded with spaces so that the data starts
+                                  on an 8-byte boundary
+        data           bytes      One buffer per column, each starting on an
+                                  8-byte boundary
+
+    The header is a JSON object with the following keys:
+
+        dataset_version  The version of the dataset the file was built from
+        rows             The number of towns in the file
+        columns          A list of column descriptions, in the same order as
+                         the fields of TownSerializer
+
+    Each column description has a `name`, a `type`, and the `offset` (from
+    the start of the data, i.e. 12 + header_length bytes into the file) and
+    `length` (in bytes) of its buffer. Types are:
+
+        uint32           Fixed-width integers (used for population)
+        dictionary       Dictionary-encoded strings (used for all codes and
+                         names). The buffer holds one index per row, of the
+                         width given by `index_type` (uint8, uint16 or
+                         uint32), into the list of strings in `dictionary`.
+
+    For example, with numpy the population column can be mapped without
+    copying using:
+
+        numpy.frombuffer(data, dtype="<u4", count=rows,
+                         offset=12 + header_length + offset)
+
+    read_columnar() gives a reference reader using only the standard library.
+"""
+import array
+import json
+import struct
+import sys
+
+COLUMNAR_MAGIC = b"TOWNCOL1"
+COLUMNAR_CONTENT_TYPE = "application/vnd.townapi.columnar"
+COLUMNAR_ALIGNMENT = 8
+
+# Array typecodes for each integer type, checked against their sizes below
+INTEGER_TYPES = (("uint8", "B", 1),
+                 ("uint16", "H", 2),
+                 ("uint32", "I", 4))
+TYPECODES = {name: typecode for name, typecode, _ in INTEGER_TYPES}
+
+for _, _typecode, _size in INTEGER_TYPES:
+    assert array.array(_typecode).itemsize == _size
+
+# The columns of the format, with the position of each one in the rows
+# passed to encode_towns() and whether it is dictionary-encoded
+TOWN_COLUMNS = (("town_code", True),
+                ("town_name", True),
+                ("population", False),
+                ("district_code", True),
+                ("department_code", True),
+                ("region_code", True),
+                ("region_name", True))
+
+
+def _to_bytes(values):
+    """ Get the little-endian bytes of an array """
+    if sys.byteorder != "little":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _pad(length):
+    """ Get the padding needed to align a length """
+    return -length % COLUMNAR_ALIGNMENT
+
+
+def _dictionary_encode(values):
+    """
+        Dictionary-encode a sequence of strings.
+
+        :returns: A tuple of (dictionary, index type name, indices array)
+    """
+    positions = {}
+    indices = [positions.setdefault(value, len(positions))
+               for value in values]
+
+    for name, typecode, size in INTEGER_TYPES:
+        if len(positions) <= 1 << (8 * size):
+            break
+
+    return list(positions), name, array.array(typecode, indices)
+
+
+def encode_towns(rows, dataset_version):
+    """
+        Encode towns into the columnar format.
+
+        :param rows: An iterable of tuples, with one value per entry of
+                     TOWN_COLUMNS (codes and names as strings, population as
+                     an integer)
+        :param dataset_version: The dataset version to record in the header
+        :returns: The encoded file, as bytes
+    """
+    rows = list(rows)
+    columns = []
+    buffers = []
+
+    for position, (name, dictionary_encoded) in enumerate(TOWN_COLUMNS):
+        values = [row[position] for row in rows]
+
+        if dictionary_encoded:
+            dictionary, index_type, indices = _dictionary_encode(values)
+            columns.append({"name": name,
+                            "type": "dictionary",
+                            "index_type": index_type,
+                            "dictionary": dictionary})
+            buffers.append(_to_bytes(indices))
+        else:
+            columns.append({"name": name, "type": "uint32"})
+            buffers.append(_to_bytes(array.array(TYPECODES["uint32"],
+                                                 values)))
+
+    offset = 0
+    for column, buffer in zip(columns, buffers):
+        column["offset"] = offset
+        column["length"] = len(buffer)
+        offset += len(buffer) + _pad(len(buffer))
+
+    header = json.dumps({"dataset_version": dataset_version,
+                         "rows": len(rows),
+                         "columns": columns}).encode("utf-8")
+    header += b" " * _pad(len(COLUMNAR_MAGIC) + 4 + len(header))
+
+    parts = [COLUMNAR_MAGIC, struct.pack("<I", len(header)), header]
+    for buffer in buffers:
+        parts.extend((buffer, b"\0" * _pad(len(buffer))))
+
+    return b"".join(parts)
+
+
+class DictionaryColumn:
+    """
+        A dictionary-encoded column, read without copying its indices.
+        Indexing it gives the decoded string for a row.
+    """
+
+    def __init__(self, dictionary, indices):
+        self.dictionary = dictionary
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, row):
+        return self.dictionary[self.indices[row]]
+
+    def __iter__(self):
+        return (self.dictionary[index] for index in self.indices)
+
+
+def read_columnar(data):
+    """
+        Read a file in the columnar format, without copying the column
+        buffers. This works with bytes or a memory-mapped file.
+
+        Integer columns are returned as memoryviews of the underlying data
+        (on little-endian machines) and dictionary-encoded columns as
+        DictionaryColumn objects.
+
+        :param data: The contents of the file, as a buffer
+        :returns: A tuple of (header, columns), where header is the decoded
+                  header and columns is a dictionary of columns by name
+    """
+    data = memoryview(data)
+    prefix_length = len(COLUMNAR_MAGIC) + 4
+
+    if bytes(data[:len(COLUMNAR_MAGIC)]) != COLUMNAR_MAGIC:
+        raise ValueError("Not a columnar town file")
+
+    header_length, = struct.unpack("<I", data[len(COLUMNAR_MAGIC):
+                                              prefix_length])
+    header = json.loads(bytes(data[prefix_length:
+                                   prefix_length + header_length])
+                        .decode("utf-8"))
+    data_start = prefix_length + header_length
+
+    columns = {}
+    for column in header["columns"]:
+        start = data_start + column["offset"]
+        buffer = data[start:start + column["length"]]
+        integer_type = column.get("index_type", column["type"])
+        values = buffer.cast(TYPECODES[integer_type])
+
+        if sys.byteorder != "little":
+            values = array.array(values.format, values)
+            values.byteswap()
+
+        if column["type"] == "dictionary":
+            values = DictionaryColumn(column["dictionary"], values)
+        columns[column["name"]] = values
+
+    return header, columns
@@ -0,0 +1,72 @@
+"""
+    compression.py
+
+    Provide the content codings used to compress api responses.
+
+    gzip is always available. Brotli is used in preference to it when the
+    optional brotli package is installed and the client accepts it.
+"""
+import gzip
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Supported content codings, in order of preference
+ENCODINGS = OrderedDict()
+if brotli is not None:
+    ENCODINGS["br"] = lambda body: brotli.compress(body,
+                                                   quality=BROTLI_QUALITY)
+ENCODINGS["gzip"] = lambda body: gzip.compress(body,
+                                               compresslevel=GZIP_LEVEL)
+
+# File extensions used for pre-compressed files (as expected by nginx)
+ENCODING_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+
+def compress(body, encoding):
+    """
+        Compress a response body.
+
+        :param body: The body to compress, as bytes
+        :param encoding: One of the keys of ENCODINGS
+        :returns: The compressed body, as bytes
+    """
+    return ENCODINGS[encoding](body)
+
+
+def choose_encoding(accept_encoding):
+    """
+        Choose the content coding to use for a response, based on a request's
+        Accept-Encoding header.
+
+        :param accept_encoding: The value of the Accept-Encoding header
+        :returns: The most preferred supported encoding accepted by the
+                  client, or None if the body should not be compressed
+    """
+    accepted = {}
+
+    for item in accept_encoding.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+
+        accepted[coding.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, wildcard) > 0:
+            return encoding
+
+    return None
@@ -10,5 +10,11 @@
 FR_OVERSEAS_REGION_CODES = list(range(1, 6))
 FR_EU_REGION_CODES = [11, 24, 27, 28, 32, 44, 52, 53, 75, 76, 84, 93, 94]
 
-FR_REGION_CODES = tuple([(x, "{:0>2}".format(x)) for x
+
+def format_region_code(code):
+    """ Display a region code as in FR_REGION_CODES (e.g. 1 as "01") """
+    return "{:0>2}".format(code)
+
+
+FR_REGION_CODES = tuple([(x, format_region_code(x)) for x
                          in FR_OVERSEAS_REGION_CODES + FR_EU_REGION_CODES])
@@ -0,0 +1,93 @@
+"""
+    dataset.py
+
+    Keep track of the version of the dataset held in the database.
+
+    Anything derived from the places in the database (cached responses,
+    indexes etc.) should be keyed on get_dataset_version(), so that it is
+    rebuilt whenever the data changes. The version is bumped automatically
+    whenever a place is saved or deleted (see ApiConfig.ready), or once at the
+    end of a bulk operation wrapped in deferred_dataset_version_bump().
+"""
+import random
+import threading
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+from .models import DatasetVersion
+
+DATASET_VERSION_ID = 1
+DATASET_VERSION_BITS = 62
+
+# Sent (with the new version) whenever the dataset version is bumped
+dataset_changed = Signal(providing_args=["version"])
+
+_state = threading.local()
+
+
+def _new_version():
+    """ Pick a new random version (see the DatasetVersion model) """
+    return random.getrandbits(DATASET_VERSION_BITS)
+
+
+def get_dataset_version():
+    """
+        Get the version of the dataset currently held in the database.
+
+        :returns: An integer which changes whenever the dataset changes
+    """
+    version = (DatasetVersion.objects
+               .filter(pk=DATASET_VERSION_ID)
+               .values_list("version", flat=True)
+               .first())
+
+    if version is None:
+        version = DatasetVersion.objects.get_or_create(
+            pk=DATASET_VERSION_ID,
+            defaults={"version": _new_version()})[0].version
+
+    return version
+
+
+def bump_dataset_version():
+    """
+        Mark the dataset as changed. If a bump is currently deferred, then
+        this is only recorded, and the version is bumped once at the end.
+    """
+    if getattr(_state, "deferred", 0):
+        _state.pending = True
+        return
+
+    version = _new_version()
+    updated = (DatasetVersion.objects
+               .filter(pk=DATASET_VERSION_ID)
+               .update(version=version))
+
+    if not updated:
+        DatasetVersion.objects.get_or_create(pk=DATASET_VERSION_ID,
+                                             defaults={"version": version})
+
+    dataset_changed.send(sender=DatasetVersion, version=version)
+
+
+@contextmanager
+def deferred_dataset_version_bump():
+    """
+        Defer bumping the dataset version until the end of a block of changes
+        (e.g. a bulk import), rather than bumping it for every saved place.
+    """
+    _state.deferred = getattr(_state, "deferred", 0) + 1
+    try:
+        yield
+    finally:
+        _state.deferred -= 1
+
+        if not _state.deferred and getattr(_state, "pending", False):
+            _state.pending = False
+            bump_dataset_version()
+
+
+def handle_place_changed(sender, **kwargs):
+    """ Signal receiver to bump the version when a place is changed """
+    bump_dataset_version()
@@ -0,0 +1,207 @@
+"""
+    fastfilters.py
+
+    Provide a fast path for filtering with the FilterSets in filters.py.
+
+    django-filter builds a FilterSet, a form and a form field for every filter
+    on each request, validates every value through them, and clones the
+    queryset once per filter. For the simple filters used by this API (exact
+    or range lookups on a code or population) that costs more than the SQL
+    itself, so each FilterSet class is compiled once into a list of
+    (parameter, lookup, parser) entries, and the query parameters are mapped
+    straight to the lookups of a single filter() call.
+
+    Anything the compiled filters do not handle exactly like django-filter
+    (an unsupported filter type, a custom filter method, or a value which
+    does not validate) falls back to django-filter, so results and errors are
+    unchanged.
+"""
+from decimal import Decimal, DecimalException
+from functools import partial
+
+from django.conf import settings
+from django_filters import filters
+from django_filters import rest_framework
+
+# Filter arguments (passed through to the form field) which the parsers below
+# handle the same way as the form fields would
+SUPPORTED_EXTRA = ("choices", "required")
+
+
+class InvalidValue(Exception):
+    """ Raised by a parser for a value which django-filter would reject """
+
+
+def _parse_char(value):
+    """ Parse a value the way a CharField would (stripped) """
+    return value.strip() or None
+
+
+def _parse_number(value):
+    """ Parse a value the way a DecimalField would (as a finite Decimal) """
+    value = value.strip()
+    if not value:
+        return None
+
+    try:
+        value = Decimal(value)
+    except DecimalException:
+        raise InvalidValue(value)
+    if not value.is_finite():
+        raise InvalidValue(value)
+    return value
+
+
+def _parse_choice(choices, value):
+    """
+        Parse a value the way a ChoiceField would (one of the choices, other
+        than the null choice, which is left to django-filter)
+    """
+    if not value:
+        return None
+    if value not in choices:
+        raise InvalidValue(value)
+    return value
+
+
+def _get_choice_parser(filter_):
+    """ Bind a ChoiceFilter's (string) choices to the choice parser """
+    choices = filter_.extra["choices"]
+    if callable(choices):
+        return None
+
+    return partial(_parse_choice,
+                   {str(key) for key, _ in choices} - {filter_.null_value})
+
+
+# How to get the parser for each supported type of filter. Subclasses are
+# supported if they do not change how filtering is done, or if they provide a
+# get_field_name(queryset) method (see PopulationFilter).
+FILTER_PARSERS = (
+    (filters.ChoiceFilter, filters.ChoiceFilter.filter, _get_choice_parser),
+    (filters.NumberFilter, filters.Filter.filter,
+     lambda filter_: _parse_number),
+    (filters.CharFilter, filters.Filter.filter, lambda filter_: _parse_char),
+)
+
+
+def _get_parser(filter_):
+    """
+        Find the parser for a filter.
+
+        :returns: A parser function, or None if the filter cannot be compiled
+    """
+    if filter_.method is not None or filter_.exclude or filter_.distinct or \
+            not isinstance(filter_.lookup_expr, str) or \
+            filter_.extra.get("required") or \
+            set(filter_.extra) - set(SUPPORTED_EXTRA):
+        return None
+
+    for filter_class, filter_method, get_parser in FILTER_PARSERS:
+        if isinstance(filter_, filter_class):
+            if type(filter_).filter is filter_method or \
+                    hasattr(filter_, "get_field_name"):
+                return get_parser(filter_)
+            return None
+
+    return None
+
+
+def _is_single_valued(model, field_name):
+    """
+        Check that a lookup path only follows forward foreign keys, so that
+        filtering on it in one filter() call gives the same results as
+        django-filter's separate filter() calls.
+    """
+    for name in field_name.split("__"):
+        field = model._meta.get_field(name)
+        if field.many_to_many or field.one_to_many:
+            return False
+        if not field.is_relation:
+            return True
+        model = field.related_model
+
+    return True
+
+
+class CompiledFilterSet:
+    """
+        The filters of a FilterSet class, prepared for the fast path.
+
+        :param filterset_class: The FilterSet class to compile
+    """
+
+    def __init__(self, filterset_class):
+        self.filters = []
+        self.supported = True
+
+        for name, filter_ in filterset_class.base_filters.items():
+            parse = _get_parser(filter_)
+            if parse is None or not _is_single_valued(
+                    filterset_class._meta.model, filter_.field_name):
+                self.supported = False
+                break
+
+            self.filters.append((name, filter_, parse))
+
+    def get_lookups(self, query_params, queryset):
+        """
+            Map query parameters to filter() lookups.
+
+            :returns: A dictionary of lookups, or None if the parameters need
+                      to be handled by django-filter
+        """
+        if not self.supported:
+            return None
+
+        lookups = {}
+        for name, filter_, parse in self.filters:
+            value = query_params.get(name)
+            if value is None:
+                continue
+
+            try:
+                value = parse(value)
+            except InvalidValue:
+                return None
+            if value is None:
+                continue
+
+            field_name = filter_.field_name
+            if hasattr(filter_, "get_field_name"):
+                field_name = filter_.get_field_name(queryset)
+            lookups["{0}__{1}".format(field_name, filter_.lookup_expr)] = value
+
+        return lookups
+
+
+_compiled = {}
+
+
+def get_compiled_filterset(filterset_class):
+    """ Get the compiled filters for a FilterSet class (compiling once) """
+    compiled = _compiled.get(filterset_class)
+    if compiled is None:
+        compiled = _compiled[filterset_class] = \
+            CompiledFilterSet(filterset_class)
+    return compiled
+
+
+class FastFilterBackend(rest_framework.DjangoFilterBackend):
+    """
+        Filter using the compiled filters where possible (unless
+        API_FAST_FILTERS is turned off), and django-filter otherwise.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        filter_class = self.get_filter_class(view, queryset)
+        if filter_class is None or \
+                not getattr(settings, "API_FAST_FILTERS", True):
+            return super().filter_queryset(request, queryset, view)
+
+        lookups = get_compiled_filterset(filter_class).get_lookups(
+            request.query_params, queryset)
+        if lookups is None:
+            return super().filter_queryset(request, queryset, view)
+
+        return queryset.filter(**lookups) if lookups else queryset
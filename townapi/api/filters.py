@@ -3,20 +3,86 @@
 
     Declare filter classes to give useful functions for our models.
 """
+import copy
+import re
+
 from django_filters import rest_framework as filters
+from rest_framework.filters import OrderingFilter
 
 from .constants import FR_REGION_CODES
-from .models import Department, District, Town
+from .models import Department, District, Town, TownPopulation
+from .vintages import VINTAGE_POPULATION
+
+
+class PopulationFilter(filters.NumberFilter):
+    """
+        Filter towns on their population, reading it from the requested
+        vintage if there is one (see VintageViewMixin)
+    """
+
+    def get_field_name(self, qs):
+        """ Get the field to filter on (also used by fastfilters.py) """
+        if VINTAGE_POPULATION in qs.query.annotations:
+            return VINTAGE_POPULATION
+        return self.field_name
+
+    def filter(self, qs, value):
+        field_name = self.get_field_name(qs)
+        if field_name != self.field_name:
+            vintage_filter = copy.copy(self)
+            vintage_filter.field_name = field_name
+            return super(PopulationFilter, vintage_filter).filter(qs, value)
+
+        return super().filter(qs, value)
+
+
+class PopulationOrderingFilter(OrderingFilter):
+    """
+        Order towns by their population in the requested vintage if there is
+        one (see VintageViewMixin).
+
+        The fields which can be ordered on are read from the serializer class
+        once, rather than by building a serializer on every request, and
+        include its optional fields.
+    """
+    _default_valid_fields = {}
+
+    def get_default_valid_fields(self, queryset, view, context={}):
+        serializer_class = view.get_serializer_class()
+        valid_fields = self._default_valid_fields.get(serializer_class)
+
+        if valid_fields is None:
+            valid_fields = super().get_default_valid_fields(queryset, view)
+            valid_fields += [
+                (name, name)
+                for name in getattr(serializer_class, "get_optional_fields",
+                                    tuple)()]
+            self._default_valid_fields[serializer_class] = valid_fields
+
+        return valid_fields
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+
+        if ordering and VINTAGE_POPULATION in queryset.query.annotations:
+            ordering = [re.sub(r"^(-?)population$",
+                               r"\g<1>" + VINTAGE_POPULATION,
+                               term)
+                        for term in ordering]
+
+        return ordering
 
 
 class TownFilter(filters.FilterSet):
     """ Allow towns to be filtered by parent codes and population """
-    min_population = filters.NumberFilter(name="population",
-                                          lookup_expr="gte",
-                                          label="Minimum Population")
-    max_population = filters.NumberFilter(name="population",
-                                          lookup_expr="lte",
-                                          label="Maximum Population")
+    population = PopulationFilter(name="population",
+                                  label="Population")
+    min_population = PopulationFilter(name="population",
+                                      lookup_expr="gte",
+                                      label="Minimum Population")
+    max_population = PopulationFilter(name="population",
+                                      lookup_expr="lte",
+                                      label="Maximum Population")
 
     district_code = filters.CharFilter(name="district__code",
                                        label="District Code")
@@ -27,6 +93,36 @@ class TownFilter(filters.FilterSet):
         label="Region Code",
         choices=FR_REGION_CODES)
 
+    max_district_rank = filters.NumberFilter(name="district_rank",
+                                             lookup_expr="lte",
+                                             label="Maximum District Rank")
+    max_department_rank = filters.NumberFilter(
+        name="department_rank",
+        lookup_expr="lte",
+        label="Maximum Department Rank")
+    max_region_rank = filters.NumberFilter(name="region_rank",
+                                           lookup_expr="lte",
+                                           label="Maximum Region Rank")
+    max_national_rank = filters.NumberFilter(name="national_rank",
+                                             lookup_expr="lte",
+                                             label="Maximum National Rank")
+    min_district_percentile = filters.NumberFilter(
+        name="district_percentile",
+        lookup_expr="gte",
+        label="Minimum District Percentile")
+    min_department_percentile = filters.NumberFilter(
+        name="department_percentile",
+        lookup_expr="gte",
+        label="Minimum Department Percentile")
+    min_region_percentile = filters.NumberFilter(
+        name="region_percentile",
+        lookup_expr="gte",
+        label="Minimum Region Percentile")
+    min_national_percentile = filters.NumberFilter(
+        name="national_percentile",
+        lookup_expr="gte",
+        label="Minimum National Percentile")
+
     class Meta:
         model = Town
         fields = ('population', )
@@ -70,3 +166,20 @@ class TownAggsFilter(filters.FilterSet):
     class Meta:
         model = Town
         fields = []
+
+
+class PopulationChangeFilter(filters.FilterSet):
+    """ Allow population changes to be filtered by the towns' parents """
+    district_code = filters.CharFilter(name="town__district__code",
+                                       label="District Code")
+    department_code = filters.CharFilter(
+        name="town__district__department__code",
+        label="Department Code")
+    region_code = filters.ChoiceFilter(
+        name="town__district__department__region__code",
+        label="Region Code",
+        choices=FR_REGION_CODES)
+
+    class Meta:
+        model = TownPopulation
+        fields = []
@@ -0,0 +1,133 @@
+"""
+    fragments.py
+
+    Keep the JSON encoding of each row sent by the list endpoints, so that a
+    page can be built by joining rows which were encoded once, rather than
+    serializing and encoding every row again on each request (see
+    PreEncodedJSONRenderer).
+
+    Rows are encoded by the renderer with the same options as DRF's
+    JSONRenderer, so the pages are byte-for-byte identical to the ones it
+    renders. Each worker keeps the encoded rows in memory for one dataset
+    version at a time (the store is dropped the first time it is used after
+    the version changes), keyed on the serializer class and fields, the
+    vintage and the row's primary key. Once API_JSON_FRAGMENTS_MAX_ROWS rows
+    are kept, further rows are encoded for each request without being kept.
+"""
+import json
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .dataset import get_dataset_version
+
+
+class EncodedRows:
+    """
+        A list of rows which have already been encoded as JSON.
+
+        PreEncodedJSONRenderer joins the encoded rows straight into the page.
+        Anything else which iterates over them (such as another renderer, or
+        a batch) gets the rows decoded again.
+
+        :param fragments: A list of the rows encoded as JSON (in bytes)
+    """
+
+    def __init__(self, fragments):
+        self.fragments = fragments
+
+    def __len__(self):
+        return len(self.fragments)
+
+    def __iter__(self):
+        for fragment in self.fragments:
+            yield json.loads(fragment.decode("utf-8"),
+                             object_pairs_hook=OrderedDict)
+
+
+class FragmentStore:
+    """
+        The encoded rows for one version of the dataset.
+
+        :param version: The dataset version the rows come from
+        :param max_rows: The most rows to keep, or None for no limit
+    """
+
+    def __init__(self, version, max_rows=None):
+        self.version = version
+        self.max_rows = max_rows
+        self.groups = {}
+        self.row_count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.row_count
+
+    def encode(self, serializer, instances, encode_row, key=None):
+        """
+            Encode instances with a serializer, reusing the rows which were
+            already encoded.
+
+            :param serializer: The serializer for a single instance, whose
+                               class and fields are part of the key
+            :param instances: An iterable of model instances
+            :param encode_row: A function encoding a serialized row as bytes
+            :param key: Anything else the serialized rows depend on (such as
+                        the vintage)
+            :returns: An EncodedRows object
+        """
+        group_key = (type(serializer), tuple(serializer.fields), key)
+        group = self.groups.get(group_key)
+        if group is None:
+            group = self.groups.setdefault(group_key, {})
+
+        fragments = []
+        for instance in instances:
+            fragment = group.get(instance.pk)
+            if fragment is None:
+                fragment = encode_row(serializer.to_representation(instance))
+                self.add(group, instance.pk, fragment)
+            fragments.append(fragment)
+
+        return EncodedRows(fragments)
+
+    def add(self, group, pk, fragment):
+        """ Keep an encoded row, unless the store is full """
+        with self.lock:
+            if self.max_rows is not None and self.row_count >= self.max_rows:
+                return
+            if pk not in group:
+                group[pk] = fragment
+                self.row_count += 1
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_fragment_store():
+    """
+        Get the encoded rows for the current dataset version (starting an
+        empty store if the version changed).
+
+        This should be called before querying the rows to encode, so that
+        they cannot come from a newer version than the store.
+    """
+    global _store
+
+    version = get_dataset_version()
+    with _store_lock:
+        if _store is None or _store.version != version:
+            _store = FragmentStore(
+                version, getattr(settings, "API_JSON_FRAGMENTS_MAX_ROWS",
+                                 None))
+        return _store
+
+
+def clear_fragment_store():
+    """ Drop every encoded row kept by this worker """
+    global _store
+
+    with _store_lock:
+        _store = None
@@ -0,0 +1,153 @@
+"""
+    hierarchy.py
+
+    Provide the in-memory index behind the place detail endpoints, which look
+    places up by their code path (region, department, district, town).
+
+    The whole hierarchy is loaded into nested dictionaries once per dataset
+    version, with the aggregates for every place precomputed (using the same
+    partial aggregates as the rollup, see rollup.py). Looking a place up is
+    then a handful of dictionary lookups, with no database queries other than
+    checking the dataset version.
+
+    The index is rebuilt (once per worker) the first time it is used after
+    the dataset version changes.
+"""
+import threading
+from collections import namedtuple
+
+from django.db import transaction
+
+from .constants import format_region_code
+from .dataset import get_dataset_version
+from .models import Department, District, Region, Town
+from .rollup import RollupNode
+
+# The levels of the hierarchy, from the top down, with the field used for a
+# place's code in the responses of its children, how to parse its code from a
+# URL and how to display its code (matching the flat aggs serializers)
+HIERARCHY_LEVELS = (
+    ("region_code", int, format_region_code),
+    ("department_code", str, str),
+    ("district_code", int, int),
+    ("town_code", int, int),
+)
+
+# Towns are the bulk of the index, so they are stored as tuples in their
+# district's children, and only made into nodes when they are looked up
+IndexedTown = namedtuple("IndexedTown", ("name", "population"))
+
+
+class HierarchyIndex:
+    """
+        The places in one version of the dataset, nested by code.
+
+        :param version: The dataset version the index was built from
+        :param regions: A dictionary of RollupNode objects by region code,
+                        each holding its departments, districts and towns
+    """
+
+    def __init__(self, version, regions):
+        self.version = version
+        self.regions = regions
+
+    def lookup(self, *codes):
+        """
+            Look up a place by its code path.
+
+            :param codes: The codes of the place and its parents from the top
+                          down, as stored in the database (e.g. an integer
+                          region code and a string department code)
+            :returns: A RollupNode for the place, or None if there is no such
+                      place
+        """
+        children = self.regions
+        node = None
+
+        for code in codes:
+            if children is None or code not in children:
+                return None
+            node = children[code]
+            children = getattr(node, "children", None)
+
+        if isinstance(node, IndexedTown):
+            town = RollupNode(HIERARCHY_LEVELS[-1][2](codes[-1]), node.name)
+            town.add(node.population, node.population, node.population, 1)
+            return town
+        return node
+
+
+def build_hierarchy_index():
+    """
+        Load every place into a new index, with four queries (one for each
+        level) in a single transaction.
+
+        :returns: A HierarchyIndex
+    """
+    display = [display for _, _, display in HIERARCHY_LEVELS]
+
+    with transaction.atomic():
+        version = get_dataset_version()
+
+        regions = {code: RollupNode(display[0](code), name, "departments")
+                   for code, name in Region.objects.values_list("code",
+                                                                "name")}
+
+        departments = {}
+        for code, region_code in Department.objects.values_list("code",
+                                                                "region_id"):
+            node = departments[code] = RollupNode(display[1](code),
+                                                  children_name="districts")
+            regions[region_code].children[code] = node
+
+        districts = {}
+        for pk, code, department_code in District.objects.values_list(
+                "id", "code", "department_id"):
+            node = districts[pk] = RollupNode(display[2](code),
+                                              children_name="towns")
+            departments[department_code].children[code] = node
+
+        for code, name, population, district_id in (
+                Town.objects.values_list("code", "name", "population",
+                                         "district_id").iterator()):
+            district = districts[district_id]
+            district.children[code] = IndexedTown(name, population)
+            district.add(population, population, population, 1)
+
+    # Combine the districts' aggregates upwards
+    for parents in (departments.values(), regions.values()):
+        for parent in parents:
+            for child in parent.children.values():
+                if child.town_count:
+                    parent.add(child.min_population,
+                               child.max_population,
+                               child.total_population,
+                               child.town_count)
+
+    return HierarchyIndex(version, regions)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_hierarchy_index():
+    """
+        Get the index for the current dataset version, rebuilding it if the
+        dataset has changed since it was built.
+
+        :returns: A HierarchyIndex
+    """
+    global _index
+
+    version = get_dataset_version()
+    index = _index
+
+    if index is None or index.version != version:
+        with _index_lock:
+            # Another thread may have rebuilt it while we waited
+            if _index is None or _index.version != version:
+                _index = build_hierarchy_index()
+            index = _index
+
+    return index
@@ -6,7 +6,7 @@
 """
 import csv
 import os
-from api.models import Department, District, Region, Town
+from api.models import Department, District, Region, Town, TownPopulation
 
 CSV_FILE_PATH = os.path.join(os.path.dirname(__file__),
                              "..",
@@ -18,12 +18,13 @@ CSV_FILE_PATH = os.path.join(os.path.dirname(__file__),
 CSV_INT_FIELDS = ["population", ]
 
 
-def get_towns_from_csv():
+def iter_towns_from_csv(csv_file_path=CSV_FILE_PATH):
     """
-        Vanity method for getting a list of dictionaries for each line of the
-        towns.csv data file, and cleaning up any data found there
+        Read the towns.csv data file (or another file in the same format) one
+        line at a time, cleaning up any data found there. Only one record is
+        held in memory at a time, however large the file is.
 
-        :returns: A list of dictionaries, where each one is keyed by the
+        :returns: An iterator of dictionaries, where each one is keyed by the
                   API names of town properties
     """
     def clean_record(record):
@@ -40,16 +41,32 @@ def get_towns_from_csv():
 
         return c_record
 
-    with open(CSV_FILE_PATH, 'r', encoding='utf-8') as csv_file:
-        towns = [clean_record(record) for record in csv.DictReader(csv_file)]
+    with open(csv_file_path, 'r', encoding='utf-8') as csv_file:
+        for record in csv.DictReader(csv_file):
+            yield clean_record(record)
+
+
+def get_towns_from_csv(csv_file_path=CSV_FILE_PATH):
+    """
+        Vanity method for getting a list of dictionaries for each line of the
+        towns.csv data file (or another file in the same format), and cleaning
+        up any data found there
 
-    return towns
+        :returns: A list of dictionaries, where each one is keyed by the
+                  API names of town properties
+    """
+    return list(iter_towns_from_csv(csv_file_path))
 
 
-def save_town_and_parents_to_db(town):
+def save_town_and_parents_to_db(town, vintage=None, update_current=True):
     """
         Given a JSON object containing information about a Town, add it and
         all of it's parent objects to the DB (after fully validating them)
+
+        If a Vintage is given, the population is also stored for that
+        vintage, and a town which already exists is reused (with its
+        population only changed if update_current is set, i.e. if this is the
+        latest vintage).
     """
     region, created = Region.objects.get_or_create(code=town["region_code"],
                                                    name=town["region_name"])
@@ -68,9 +85,28 @@ def save_town_and_parents_to_db(town):
     if created:
         district.full_clean(validate_unique=False)
 
-    town = Town(code=town["town_code"],
-                district=district,
-                name=town["town_name"],
-                population=town["population"])
-    town.full_clean()
-    town.save()
+    existing = None
+    if vintage is not None:
+        existing = Town.objects.filter(code=town["town_code"],
+                                       district=district).first()
+
+    if existing is None:
+        saved = Town(code=town["town_code"],
+                     district=district,
+                     name=town["town_name"],
+                     population=town["population"])
+        saved.full_clean()
+        saved.save()
+    else:
+        saved = existing
+        if update_current:
+            saved.name = town["town_name"]
+            saved.population = town["population"]
+            saved.full_clean()
+            saved.save()
+
+    if vintage is not None:
+        TownPopulation.objects.update_or_create(
+            town=saved,
+            vintage=vintage,
+            defaults={"population": town["population"]})
@@ -0,0 +1,87 @@
+"""
+    benchmark_compression.py
+
+    Django admin command to measure the bytes sent and the CPU time spent per
+    request for typical api pages, with and without compression, and with
+    and without the compressed response cache.
+
+    Requests are made in-process against the current database, so the data
+    should be imported first.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from api.compression import ENCODINGS
+
+DEFAULT_URLS = ("/towns",
+                "/towns?limit=1000",
+                "/towns?limit=10000",
+                "/aggs/regions",
+                "/aggs/departments",
+                "/aggs/towns")
+
+
+class Command(BaseCommand):
+    help = ('Measure response sizes and CPU time per request for typical '
+            'pages with each supported content coding')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url",
+                            action="append",
+                            dest="urls",
+                            help="URL to benchmark (can be repeated)")
+        parser.add_argument("--repeat",
+                            type=int,
+                            default=10,
+                            help="Number of requests to time for each case")
+        parser.add_argument("--host",
+                            default="localhost",
+                            help="Host header to send with each request")
+
+    def handle(self, *args, **options):
+        client = Client(HTTP_HOST=options["host"])
+        cache = caches[settings.API_RESPONSE_CACHE]
+        repeat = options["repeat"]
+
+        self.stdout.write("{0:<24} {1:<9} {2:>10} {3:>12} {4:>12}".format(
+            "URL", "Encoding", "Bytes", "Cold CPU ms", "Warm CPU ms"))
+
+        for url in options["urls"] or DEFAULT_URLS:
+            for encoding in ("identity", ) + tuple(ENCODINGS):
+                def fetch():
+                    """ Return the content coding and body of the page """
+                    response = client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+                    # Large pages are streamed, and rendered while read
+                    if response.streaming:
+                        body = b"".join(response.streaming_content)
+                    else:
+                        body = response.content
+                    return response.get("Content-Encoding", "identity"), body
+
+                # Cold requests render and compress the page every time
+                cold = 0.0
+                for _ in range(repeat):
+                    cache.clear()
+                    start = time.process_time()
+                    coding, body = fetch()
+                    cold += time.process_time() - start
+
+                # Warm requests are served from the response cache
+                fetch()
+                warm = 0.0
+                for _ in range(repeat):
+                    start = time.process_time()
+                    fetch()
+                    warm += time.process_time() - start
+
+                self.stdout.write(
+                    "{0:<24} {1:<9} {2:>10} {3:>12.2f} {4:>12.2f}".format(
+                        url,
+                        coding,
+                        len(body),
+                        cold * 1000 / repeat,
+                        warm * 1000 / repeat))
@@ -0,0 +1,83 @@
+"""
+    benchmark_rendering.py
+
+    Django admin command to measure how many rows per second typical api
+    pages are rendered at, with DRF's JSONRenderer and from pre-encoded rows
+    (see api/fragments.py), both before the rows are encoded (cold) and once
+    they have been (warm).
+
+    Requests are made in-process against the current database, so the data
+    should be imported first. The response cache is cleared before each
+    request, so that every page is rendered.
+"""
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+
+from api.fragments import clear_fragment_store
+
+DEFAULT_URLS = ("/towns",
+                "/towns?limit=1000",
+                "/towns?limit=10000",
+                "/towns?limit=10000&fields=town_code,population",
+                "/aggs/departments",
+                "/aggs/towns")
+
+CASES = (
+    ("JSONRenderer", False, True),
+    ("Cold rows", True, True),
+    ("Warm rows", True, False),
+)
+
+
+class Command(BaseCommand):
+    help = ('Measure the rows per second rendered for typical pages, with '
+            'and without pre-encoded rows')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url",
+                            action="append",
+                            dest="urls",
+                            help="URL to benchmark (can be repeated)")
+        parser.add_argument("--repeat",
+                            type=int,
+                            default=10,
+                            help="Number of requests to time for each case")
+        parser.add_argument("--host",
+                            default="localhost",
+                            help="Host header to send with each request")
+
+    def handle(self, *args, **options):
+        client = Client(HTTP_HOST=options["host"])
+        cache = caches[settings.API_RESPONSE_CACHE]
+        repeat = options["repeat"]
+
+        self.stdout.write("{0:<48} {1:<13} {2:>8} {3:>10} {4:>12}".format(
+            "URL", "Renderer", "Rows", "ms", "Rows/s"))
+
+        for url in options["urls"] or DEFAULT_URLS:
+            for name, fragments, cold in CASES:
+                elapsed = 0.0
+                with override_settings(API_JSON_FRAGMENTS=fragments):
+                    for _ in range(repeat):
+                        cache.clear()
+                        if cold:
+                            clear_fragment_store()
+                        start = time.perf_counter()
+                        # Streamed pages are only rendered as they are read
+                        body = b"".join(client.get(url))
+                        elapsed += time.perf_counter() - start
+
+                data = json.loads(body.decode("utf-8"))
+                if isinstance(data, dict):
+                    data = data.get("results")
+                rows = len(data) if isinstance(data, list) else 0
+
+                self.stdout.write(
+                    "{0:<48} {1:<13} {2:>8} {3:>10.2f} {4:>12.0f}".format(
+                        url, name, rows, elapsed * 1000 / repeat,
+                        rows * repeat / elapsed if elapsed else 0))
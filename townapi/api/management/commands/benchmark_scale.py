@@ -0,0 +1,154 @@
+"""
+    benchmark_scale.py
+
+    Django admin command to measure how the api behaves as the dataset grows.
+
+    For each scale (a multiple of the size of data/towns.csv), a synthetic
+    dataset is generated (see api/synthetic.py) and imported into a fresh
+    SQLite database, and the import time, database size and cold latency of
+    typical endpoints are reported. The configured database is not touched.
+
+    Note that large scales take a long time to import, so it is worth
+    starting with the smaller ones.
+"""
+import os
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+
+from api.synthetic import generate_towns, write_towns_csv
+
+DEFAULT_SCALES = (1, 10, 100)
+DEFAULT_URLS = ("/towns",
+                "/towns?ordering=-population",
+                "/towns?department_code=1",
+                "/aggs/regions",
+                "/aggs/departments",
+                "/aggs/districts",
+                "/aggs/towns?department_code=1")
+
+
+class Command(BaseCommand):
+    help = ('Measure import time, database size and endpoint latency with '
+            'synthetic datasets of increasing size')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scale",
+                            type=float,
+                            action="append",
+                            dest="scales",
+                            help="Size relative to data/towns.csv (can be "
+                                 "repeated, default 1, 10 and 100)")
+        parser.add_argument("--url",
+                            action="append",
+                            dest="urls",
+                            help="URL to time (can be repeated)")
+        parser.add_argument("--repeat",
+                            type=int,
+                            default=5,
+                            help="Number of requests to time for each URL")
+        parser.add_argument("--seed",
+                            type=int,
+                            default=0,
+                            help="Random seed for the synthetic data")
+        parser.add_argument("--work-dir",
+                            help="Directory to keep the generated CSV files "
+                                 "and databases in (a temporary directory "
+                                 "is used by default)")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("The scale benchmark needs a SQLite database")
+
+        if options["work_dir"]:
+            os.makedirs(options["work_dir"], exist_ok=True)
+            self.run(options["work_dir"], options)
+        else:
+            with tempfile.TemporaryDirectory() as work_dir:
+                self.run(work_dir, options)
+
+    def run(self, work_dir, options):
+        """ Benchmark each scale, using files in the given directory """
+        urls = options["urls"] or DEFAULT_URLS
+
+        self.stdout.write("{0:>7} {1:>10} {2:>10} {3:>9}  {4}".format(
+            "Scale", "Towns", "Import s", "DB MB", "Median cold ms by URL"))
+
+        for scale in options["scales"] or DEFAULT_SCALES:
+            csv_path = os.path.join(work_dir, "towns-{0:g}.csv".format(scale))
+            db_path = os.path.join(work_dir, "db-{0:g}.sqlite3".format(scale))
+            if os.path.exists(db_path):
+                os.remove(db_path)
+
+            with open(csv_path, "w", encoding="utf-8", newline="") \
+                    as csv_file:
+                count = write_towns_csv(
+                    csv_file, generate_towns(scale, options["seed"]))
+
+            with self.use_database(db_path):
+                call_command("migrate", verbosity=0)
+
+                start = time.perf_counter()
+                with open(os.devnull, "w", encoding="utf-8") as devnull:
+                    call_command("import_from_csv",
+                                 csv=csv_path,
+                                 snapshot=False,
+                                 warm_up=False,
+                                 stdout=devnull)
+                import_seconds = time.perf_counter() - start
+
+                latencies = [(url, self.time_url(url, options["repeat"]))
+                             for url in urls]
+
+            self.stdout.write("{0:>7g} {1:>10} {2:>10.1f} {3:>9.1f}".format(
+                scale,
+                count,
+                import_seconds,
+                os.path.getsize(db_path) / (1024 * 1024)))
+            for url, latency in latencies:
+                self.stdout.write("{0:>40}  {1:>10.1f}  {2}".format(
+                    "", latency * 1000, url))
+
+    @staticmethod
+    def time_url(url, repeat):
+        """ Get the median latency of a URL, with a cold response cache """
+        client = Client(HTTP_HOST="localhost")
+        cache = caches[settings.API_RESPONSE_CACHE]
+        timings = []
+
+        for _ in range(repeat):
+            cache.clear()
+            start = time.perf_counter()
+            response = client.get(url, HTTP_ACCEPT="application/json")
+            timings.append(time.perf_counter() - start)
+
+            if response.status_code != 200:
+                raise CommandError("Could not fetch {0} (status {1})"
+                                   .format(url, response.status_code))
+
+        return statistics.median(timings)
+
+    @staticmethod
+    @contextmanager
+    def use_database(path):
+        """
+            Point the default database connection at another SQLite file for
+            the duration of the context
+        """
+        connection.close()
+        original = connection.settings_dict["NAME"]
+        connection.settings_dict["NAME"] = path
+
+        try:
+            yield
+        finally:
+            connection.close()
+            connection.settings_dict["NAME"] = original
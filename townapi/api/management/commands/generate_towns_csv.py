@@ -0,0 +1,40 @@
+"""
+    generate_towns_csv.py
+
+    Django admin command to write a synthetic dataset (see api/synthetic.py)
+    in the same format as data/towns.csv, at any multiple of its size. The
+    result can be loaded with `import_from_csv --csv <PATH>`.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.synthetic import generate_towns, write_towns_csv
+
+
+class Command(BaseCommand):
+    help = 'Generate a synthetic town dataset in the same format as the CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument("output",
+                            help="Path of the CSV file to write")
+        parser.add_argument("--scale",
+                            type=float,
+                            default=1.0,
+                            help="Size relative to data/towns.csv")
+        parser.add_argument("--seed",
+                            type=int,
+                            default=0,
+                            help="Random seed (the same seed and scale "
+                                 "always give the same data)")
+
+    def handle(self, *args, **options):
+        if options["scale"] <= 0:
+            raise CommandError("The scale must be positive")
+
+        with open(options["output"], "w", encoding="utf-8", newline="") \
+                as csv_file:
+            count = write_towns_csv(csv_file,
+                                    generate_towns(options["scale"],
+                                                   options["seed"]))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Wrote {0} towns to {1}".format(count, options["output"])))
@@ -4,16 +4,67 @@
     Simple Django admin command to make importing data from the CSV dataset
     into the database easy
 """
+from django.core.management import call_command
 from django.core.management.base import BaseCommand
-from ._utils import get_towns_from_csv, save_town_and_parents_to_db
+from django.db import transaction
+from api.dataset import deferred_dataset_version_bump
+from api.models import Vintage
+from api.ranking import refresh_town_ranks
+from api.warmup import has_shared_response_cache
+from ._utils import (CSV_FILE_PATH, iter_towns_from_csv,
+                     save_town_and_parents_to_db)
 
 
 class Command(BaseCommand):
     help = 'Import the town data from the CSV data file'
 
+    def add_arguments(self, parser):
+        parser.add_argument("--csv",
+                            default=CSV_FILE_PATH,
+                            help="CSV file to import (data/towns.csv by "
+                                 "default)")
+        parser.add_argument("--vintage",
+                            type=int,
+                            help="Import the populations as the census "
+                                 "extract for this year (towns are updated "
+                                 "if this is the latest vintage)")
+        parser.add_argument("--no-snapshot",
+                            action="store_false",
+                            dest="snapshot",
+                            help="Do not re-render the static snapshot")
+        parser.add_argument("--no-warm-up",
+                            action="store_false",
+                            dest="warm_up",
+                            help="Do not warm up the api after the import "
+                                 "(it is only warmed up if the response "
+                                 "cache is shared between processes)")
+
     def handle(self, *args, **options):
-        for town in get_towns_from_csv():
-            save_town_and_parents_to_db(town)
+        # Only bump the dataset version once, when the import is complete,
+        # and commit it with the imported data, so that nothing sees part of
+        # an import under either version. Towns are read one at a time, so
+        # large files fit in memory.
+        with transaction.atomic(), deferred_dataset_version_bump():
+            vintage = None
+            update_current = True
+            if options["vintage"] is not None:
+                vintage, _ = Vintage.objects.get_or_create(
+                    year=options["vintage"])
+                update_current = not Vintage.objects.filter(
+                    year__gt=vintage.year).exists()
+
+            for town in iter_towns_from_csv(options["csv"]):
+                save_town_and_parents_to_db(town, vintage, update_current)
+
+                self.stdout.write(self.style.SUCCESS(
+                    "Successfully added {0}".format(town["town_name"])))
+
+            refresh_town_ranks()
+            self.stdout.write(self.style.SUCCESS("Refreshed the town ranks"))
 
-            self.stdout.write(self.style.SUCCESS("Successfully added {0}"
-                                                 .format(town["town_name"])))
+        if options["snapshot"]:
+            call_command("render_snapshot", stdout=self.stdout)
+        # Warming up in this process only helps the workers if they share
+        # its response cache
+        if options["warm_up"] and has_shared_response_cache():
+            call_command("warm_cache", stdout=self.stdout)
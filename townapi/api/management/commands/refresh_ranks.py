@@ -0,0 +1,28 @@
+"""
+    refresh_ranks.py
+
+    Django admin command to recompute the precomputed town ranks and
+    percentiles (see api/ranking.py), e.g. after towns are changed outside
+    of an import, and re-render the static snapshot.
+"""
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from api.ranking import refresh_town_ranks
+
+
+class Command(BaseCommand):
+    help = 'Recompute the population rank and percentile of every town'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--no-snapshot",
+                            action="store_false",
+                            dest="snapshot",
+                            help="Do not re-render the static snapshot")
+
+    def handle(self, *args, **options):
+        refresh_town_ranks()
+        self.stdout.write(self.style.SUCCESS("Refreshed the town ranks"))
+
+        if options["snapshot"]:
+            call_command("render_snapshot", stdout=self.stdout)
@@ -0,0 +1,166 @@
+"""
+    render_snapshot.py
+
+    Django admin command to render the most requested api responses into a
+    static directory, so that nginx can serve them without calling Django.
+
+    The snapshot contains the unfiltered /aggs/* endpoints, the aggs
+    endpoints filtered by each region code and the first pages of /towns.
+    Each response is written as JSON, along with pre-compressed variants, to:
+
+        <ROOT>/<PATH>/<QUERY>.json[.gz|.br]
+
+    where `<QUERY>` is the raw query string (or `index` if there is none).
+    Pagination links are made relative, as nginx serves the snapshot for
+    every host. Each snapshot is rendered into a directory named after the
+    dataset version, and `<ROOT>` is then atomically switched over to it
+    with a symlink, so nginx never sees a partially written snapshot. A
+    snapshot is discarded if the data changes while it is being rendered,
+    and is taken down when the data changes afterwards (see
+    api/snapshot.py).
+"""
+import glob
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+
+from api.compression import ENCODINGS, ENCODING_EXTENSIONS, compress
+from api.dataset import get_dataset_version
+from api.models import Region
+from api.pagination import OneHundredResultsLimitOffsetPagination
+from api.snapshot import get_snapshot_target, make_links_relative
+from api.warmup import get_with_retries
+
+AGGS_URLS = ("/aggs/regions",
+             "/aggs/departments",
+             "/aggs/districts",
+             "/aggs/towns",
+             "/aggs/rollup")
+REGION_AGGS_URLS = ("/aggs/departments",
+                    "/aggs/districts",
+                    "/aggs/towns",
+                    "/aggs/rollup")
+
+
+def get_snapshot_urls(towns_pages):
+    """
+        List the URLs to include in the snapshot.
+
+        :param towns_pages: The number of pages of /towns to include
+        :returns: A list of URLs (including their query strings)
+    """
+    urls = list(AGGS_URLS)
+
+    for region_code in Region.objects.order_by("code") \
+                                     .values_list("code", flat=True):
+        urls.extend("{0}?region_code={1}".format(url, region_code)
+                    for url in REGION_AGGS_URLS)
+
+    # Later pages use the same query strings as the pagination links
+    limit = OneHundredResultsLimitOffsetPagination.default_limit
+    if towns_pages:
+        urls.append("/towns")
+    urls.extend("/towns?limit={0}&offset={1}".format(limit, page * limit)
+                for page in range(1, towns_pages))
+
+    return urls
+
+
+def get_snapshot_path(root, url):
+    """ Get the path a URL is stored at in the snapshot (see above) """
+    path, _, query = url.partition("?")
+    return os.path.join(root, path.strip("/"), (query or "index") + ".json")
+
+
+class Command(BaseCommand):
+    help = ('Render the most requested api responses into a static '
+            'snapshot for nginx to serve')
+
+    def add_arguments(self, parser):
+        parser.add_argument("--output",
+                            default=settings.API_SNAPSHOT_ROOT,
+                            help="Path the snapshot should be served from")
+        parser.add_argument("--host",
+                            default=settings.API_SNAPSHOT_HOST,
+                            help="Host to render the responses for")
+        parser.add_argument("--towns-pages",
+                            type=int,
+                            default=settings.API_SNAPSHOT_TOWNS_PAGES,
+                            help="Number of pages of /towns to render")
+
+    def handle(self, *args, **options):
+        root = os.path.abspath(options["output"])
+        version = get_dataset_version()
+        target = get_snapshot_target(root, version)
+        working = target + ".tmp"
+        shutil.rmtree(working, ignore_errors=True)
+
+        client = Client(HTTP_HOST=options["host"])
+        urls = get_snapshot_urls(options["towns_pages"])
+
+        for url in urls:
+            # Wait for a slot if the server is busy with expensive requests
+            response = get_with_retries(client, url,
+                                        HTTP_ACCEPT="application/json")
+
+            if response.status_code != 200:
+                raise CommandError("Could not render {0} (status {1})"
+                                   .format(url, response.status_code))
+
+            # Large pages, such as /aggs/towns, are streamed
+            if response.streaming:
+                content = b"".join(response.streaming_content)
+            else:
+                content = response.content
+
+            base_url = response.wsgi_request.build_absolute_uri("/")
+            self.write(get_snapshot_path(working, url),
+                       make_links_relative(content, base_url))
+
+        if get_dataset_version() != version:
+            shutil.rmtree(working, ignore_errors=True)
+            raise CommandError("The data changed while the snapshot was "
+                               "being rendered, please render it again")
+
+        self.switch(root, working, target)
+
+        self.stdout.write(self.style.SUCCESS(
+            "Rendered {0} responses into {1}".format(len(urls), target)))
+
+    @staticmethod
+    def write(path, body):
+        """ Write a response body, along with its compressed variants """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(body)
+
+        for encoding in ENCODINGS:
+            with open(path + ENCODING_EXTENSIONS[encoding], "wb") \
+                    as snapshot_file:
+                snapshot_file.write(compress(body, encoding))
+
+    @staticmethod
+    def switch(root, working, target):
+        """
+            Move a finished snapshot into place, point the root symlink at it
+            and remove any older snapshots.
+        """
+        shutil.rmtree(target, ignore_errors=True)
+        os.rename(working, target)
+
+        if os.path.isdir(root) and not os.path.islink(root):
+            shutil.rmtree(root)
+
+        link = root + ".link"
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.basename(target), link)
+        os.replace(link, root)
+
+        for old in glob.glob(glob.escape(root) + "-*"):
+            if old != target:
+                shutil.rmtree(old, ignore_errors=True)
@@ -0,0 +1,80 @@
+"""
+    slow_requests.py
+
+    Django admin command to summarize the slow request log (see
+    api/slowlog.py): the slowest requests, and the SQL statement shapes
+    which took the most time over a window, with their query plans.
+"""
+import datetime
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.slowlog import read_records, summarize_shapes
+
+WINDOW_RE = re.compile(r"^(\d+)([smhd])$")
+WINDOW_UNITS = {"s": "seconds", "m": "minutes", "h": "hours", "d": "days"}
+
+
+def parse_window(value):
+    """ Parse a window such as 30m, 12h or 7d into a timedelta """
+    match = WINDOW_RE.match(value)
+    if match is None:
+        raise CommandError("Invalid window {0!r}: use a number followed by "
+                           "s, m, h or d (e.g. 24h)".format(value))
+    return datetime.timedelta(
+        **{WINDOW_UNITS[match.group(2)]: int(match.group(1))})
+
+
+class Command(BaseCommand):
+    help = 'Summarize the slowest requests and query shapes in the slow ' \
+           'request log'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since",
+                            default="24h",
+                            help="Only include requests from this long ago "
+                                 "(e.g. 30m, 12h or 7d, 24h by default)")
+        parser.add_argument("--top",
+                            type=int,
+                            default=10,
+                            help="Number of requests and query shapes to "
+                                 "show")
+        parser.add_argument("--log",
+                            help="Slow request log to read, instead of "
+                                 "API_SLOW_REQUEST_LOG")
+
+    def handle(self, *args, **options):
+        since = datetime.datetime.utcnow() - parse_window(options["since"])
+        records = read_records(options["log"], since)
+
+        if not records:
+            self.stdout.write(self.style.SUCCESS(
+                "No slow requests in the last {0}".format(options["since"])))
+            return
+
+        self.stdout.write(self.style.WARNING(
+            "{0} slow requests in the last {1}".format(len(records),
+                                                       options["since"])))
+
+        self.stdout.write("\nSlowest requests:")
+        slowest = sorted(records, key=lambda record: -record["duration_ms"])
+        for record in slowest[:options["top"]]:
+            self.stdout.write("{0:>10.1f}ms {1:>4} {2}  ({3} queries, "
+                              "{4:.1f}ms SQL)".format(
+                                  record["duration_ms"],
+                                  record["status"],
+                                  record["url"],
+                                  record["statement_count"],
+                                  record["phases"]["sql"]))
+
+        self.stdout.write("\nQuery shapes by total time:")
+        for summary in summarize_shapes(records, options["top"]):
+            url, _ = summary.urls.most_common(1)[0]
+            self.stdout.write(
+                "{0:>10.1f}ms total {1:>6} runs {2:>10.1f}ms max  "
+                "(mostly {3})".format(summary.total_ms, summary.count,
+                                      summary.max_ms, url))
+            self.stdout.write("    " + summary.shape)
+            for line in summary.plan or ():
+                self.stdout.write("      plan: " + line)
@@ -0,0 +1,51 @@
+"""
+    warm_cache.py
+
+    Django admin command to warm up the api by replaying the most frequently
+    requested URLs in-process (see api/warmup.py), and report how long it
+    took and what it covered.
+
+    Note that with the default (per-process) cache, this only warms the
+    database pages for other processes. Gunicorn workers warm up their own
+    response caches on start (see gunicorn_conf.py), and imports only run
+    this when the response cache is shared.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.warmup import warm_up
+
+
+class Command(BaseCommand):
+    help = 'Replay the most frequently requested URLs to warm up the api'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url",
+                            action="append",
+                            dest="urls",
+                            help="URL to replay, instead of those in "
+                                 "API_WARMUP_URLS (can be repeated)")
+        parser.add_argument("--access-log",
+                            help="Gunicorn access log to take the most "
+                                 "frequent URLs from")
+        parser.add_argument("--max-urls",
+                            type=int,
+                            help="Maximum number of URLs to replay")
+        parser.add_argument("--host",
+                            help="Host header to send with each request")
+
+    def handle(self, *args, **options):
+        try:
+            report = warm_up(urls=options["urls"],
+                             access_log=options["access_log"],
+                             max_urls=options["max_urls"],
+                             host=options["host"])
+        except OSError as error:
+            raise CommandError("Could not read the access log: {0}"
+                               .format(error))
+
+        for result in report.results:
+            self.stdout.write("{0:>4} {1:>8.1f}ms  {2}".format(
+                result.status, result.seconds * 1000, result.url))
+
+        style = self.style.WARNING if report.failed else self.style.SUCCESS
+        self.stdout.write(style(report.summary()))
@@ -0,0 +1,337 @@
+"""
+    middleware.py
+
+    Declare middleware used by the api app.
+"""
+import hashlib
+import re
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+from django.utils.cache import has_vary_header, patch_vary_headers
+
+from .admission import acquire_slot, get_cost_class
+from .coalescing import SingleFlight
+from .compression import choose_encoding, compress
+from .dataset import get_dataset_version
+from .slowlog import (RequestTimer, build_record, count_rows,
+                      record_statements, write_record)
+
+IDENTITY = "identity"
+
+
+class CompressedResponseCacheMiddleware:
+    """
+        Cache successful JSON responses for each version of the dataset, and
+        compress them using the best content coding the client accepts.
+
+        Both the uncompressed body and each compressed variant are stored in
+        the cache, so a hot page is rendered and compressed once per dataset
+        version rather than once per request. Bodies smaller than
+        API_COMPRESSION_MIN_SIZE are never compressed, as the saving would not
+        be worth the CPU time.
+    """
+    # Headers which are recalculated when a cached response is served
+    skipped_headers = ("content-length", "content-encoding")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.cache = caches[getattr(settings, "API_RESPONSE_CACHE",
+                                    "default")]
+        self.timeout = getattr(settings, "API_RESPONSE_CACHE_TIMEOUT", None)
+        self.min_size = getattr(settings, "API_COMPRESSION_MIN_SIZE", 1024)
+
+    def __call__(self, request):
+        if request.method != "GET":
+            return self.get_response(request)
+
+        encoding = choose_encoding(
+            request.META.get("HTTP_ACCEPT_ENCODING", "")) or IDENTITY
+        key = self.get_cache_key(request)
+
+        entry = self.cache.get(key + encoding)
+        if entry is None and encoding != IDENTITY:
+            # If the page has already been rendered then we only need to
+            # compress it
+            entry = self.cache.get(key + IDENTITY)
+            if entry is not None:
+                entry = self.store(key, entry, encoding)
+
+        if entry is None:
+            response = self.get_response(request)
+            if not self.is_cacheable(response):
+                return response
+
+            entry = self.store(key, self.make_entry(response), IDENTITY)
+            if encoding != IDENTITY:
+                entry = self.store(key, entry, encoding)
+
+        return self.build_response(entry)
+
+    def get_cache_key(self, request):
+        """
+            Build the cache key prefix for a request. Responses depend on the
+            dataset, the URL (including the host, which is used in pagination
+            links) and the Accept header (used to pick the renderer).
+        """
+        request_key = "\n".join((request.get_host(),
+                                 request.get_full_path(),
+                                 request.META.get("HTTP_ACCEPT", "")))
+
+        return "api:response:{0}:{1}:".format(
+            get_dataset_version(),
+            hashlib.md5(request_key.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def is_cacheable(response):
+        """ Only cache complete, successful JSON responses """
+        content_type = response.get("Content-Type", "")
+
+        return (response.status_code == 200 and
+                not response.streaming and
+                not response.has_header("Content-Encoding") and
+                not response.cookies and
+                "no-store" not in response.get("Cache-Control", "") and
+                content_type.startswith("application/json"))
+
+    def make_entry(self, response):
+        """ Pack a response into a (body, headers, encoding) cache entry """
+        headers = [(key, value) for key, value in response.items()
+                   if key.lower() not in self.skipped_headers]
+
+        return (response.content, headers, IDENTITY)
+
+    def store(self, key, entry, encoding):
+        """
+            Store a cache entry under the given encoding, compressing the
+            uncompressed entry first if needed.
+
+            :returns: The stored entry
+        """
+        body, headers, current = entry
+
+        # Small bodies are stored uncompressed, but still under the requested
+        # encoding so that the next request finds them straight away
+        if encoding != current and len(body) >= self.min_size:
+            body = compress(body, encoding)
+            current = encoding
+
+        entry = (body, headers, current)
+        self.cache.set(key + encoding, entry, self.timeout)
+        return entry
+
+    @staticmethod
+    def build_response(entry):
+        """ Build a response from a cache entry """
+        body, headers, encoding = entry
+
+        response = HttpResponse(body)
+        for key, value in headers:
+            response[key] = value
+
+        if encoding != IDENTITY:
+            response["Content-Encoding"] = encoding
+        response["Content-Length"] = str(len(body))
+        patch_vary_headers(response, ("Accept-Encoding", ))
+
+        return response
+
+
+class RequestCoalescingMiddleware:
+    """
+        Run concurrent identical GET requests once, and share the rendered
+        response between them (see coalescing.py). This stops a cache expiry
+        or dataset change from running the same expensive query many times
+        at once.
+
+        Requests are identical if they have the same host, path, query
+        parameters (in any order) and Accept header, and are for the same
+        dataset version. Shared responses have an X-Coalesced header. If
+        API_COALESCING_SHARED is set, workers also coordinate through the
+        API_COALESCING_CACHE cache.
+
+        As responses are shared without regard to who asked for them, only
+        anonymous requests (without a session cookie or an Authorization
+        header) for the public read-only endpoints are coalesced, and
+        responses which are private (or vary on cookies) are never shared.
+
+        This should come after CompressedResponseCacheMiddleware (so cached
+        responses are served straight away) and before
+        AdmissionControlMiddleware (so waiting requests do not hold a slot).
+    """
+
+    # The public read-only endpoints (not the admin, nor /status, whose
+    # counters are kept by each worker)
+    coalesced_paths = re.compile(
+        r"^/(towns(/(top|columnar))?|(aggs|changes)/[a-z]+|regions/[\w/]+)/?$")
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+        cache = None
+        if getattr(settings, "API_COALESCING_SHARED", False):
+            cache = caches[getattr(settings, "API_COALESCING_CACHE",
+                                   "default")]
+
+        self.flight = SingleFlight(
+            getattr(settings, "API_COALESCING_TIMEOUT", 30),
+            cache=cache,
+            cache_ttl=getattr(settings, "API_COALESCING_SHARED_TTL", 5))
+
+    def __call__(self, request):
+        if not self.should_coalesce(request):
+            return self.get_response(request)
+
+        # The leader keeps its own response, in case it cannot be shared
+        own = []
+
+        def compute():
+            response = self.get_response(request)
+            own.append(response)
+            return self.freeze(response)
+
+        frozen, coalesced = self.flight.do(self.get_key(request), compute)
+
+        if own and not coalesced:
+            return own[0]
+
+        response = self.thaw(frozen)
+        response["X-Coalesced"] = "1"
+        return response
+
+    def should_coalesce(self, request):
+        """ Only coalesce anonymous GET requests for the public endpoints """
+        session_cookie = getattr(settings, "SESSION_COOKIE_NAME", "sessionid")
+
+        return (request.method == "GET" and
+                self.coalesced_paths.match(request.path_info) is not None and
+                session_cookie not in request.COOKIES and
+                "HTTP_AUTHORIZATION" not in request.META)
+
+    @staticmethod
+    def get_key(request):
+        """ Build the key identifying identical requests """
+        query = urlencode(sorted(request.GET.lists()), doseq=True)
+        request_key = "\n".join((request.get_host(),
+                                 request.path,
+                                 query,
+                                 request.META.get("HTTP_ACCEPT", "")))
+
+        return "{0}:{1}".format(
+            get_dataset_version(),
+            hashlib.md5(request_key.encode("utf-8")).hexdigest())
+
+    @staticmethod
+    def freeze(response):
+        """
+            Pack a response into a (status, headers, body) tuple which can be
+            shared, or None if it cannot be shared.
+        """
+        cache_control = {directive.split("=")[0].strip().lower()
+                         for directive in
+                         response.get("Cache-Control", "").split(",")}
+
+        if response.streaming or response.cookies or \
+                "private" in cache_control or \
+                has_vary_header(response, "Cookie"):
+            return None
+
+        return (response.status_code,
+                list(response.items()),
+                response.content)
+
+    @staticmethod
+    def thaw(frozen):
+        """ Build a new response from a frozen one """
+        status, headers, body = frozen
+
+        response = HttpResponse(body, status=status)
+        for key, value in headers:
+            response[key] = value
+
+        return response
+
+
+class AdmissionControlMiddleware:
+    """
+        Reject requests straight away when too many requests of the same
+        cost class are already running (see admission.py), rather than
+        letting expensive requests take every worker.
+
+        Rejected requests get a 503 response with a Retry-After header. This
+        should come after CompressedResponseCacheMiddleware, so that cached
+        responses (which are cheap whatever the query) are always served.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        cost_class = get_cost_class(request)
+        slot = acquire_slot(cost_class)
+
+        if slot is None:
+            response = JsonResponse(
+                {"detail": "The server is too busy to handle this {0} "
+                           "request. Please try again later."
+                           .format(cost_class)},
+                status=503)
+            response["Retry-After"] = str(settings.API_ADMISSION_RETRY_AFTER)
+            return response
+
+        try:
+            return self.get_response(request)
+        finally:
+            slot.release()
+
+
+class SlowRequestMiddleware:
+    """
+        Write a record of each request which takes longer than
+        API_SLOW_REQUEST_THRESHOLD seconds to the slow request log, with its
+        SQL statements and the time spent in each phase (see slowlog.py).
+        Statement parameters are only kept from API_SLOW_REQUEST_DETAIL_AFTER
+        seconds into the request, and statements run by a batch's worker
+        threads are not recorded.
+
+        This should come first (after SecurityMiddleware), so that the time
+        spent in the other middleware is included. Set the threshold to None
+        to turn recording off.
+    """
+    timer_attr = "_slow_request_timer"
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        threshold = getattr(settings, "API_SLOW_REQUEST_THRESHOLD", None)
+        if threshold is None:
+            return self.get_response(request)
+
+        detail_after = getattr(settings, "API_SLOW_REQUEST_DETAIL_AFTER", 0)
+
+        timer = RequestTimer()
+        setattr(request, self.timer_attr, timer)
+        with record_statements(detail_after) as statements:
+            response = self.get_response(request)
+        timer.finish()
+
+        if timer.duration >= threshold:
+            write_record(build_record(request, response, timer, statements))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        timer = getattr(request, self.timer_attr, None)
+        if timer is not None:
+            timer.mark("view")
+
+    def process_template_response(self, request, response):
+        timer = getattr(request, self.timer_attr, None)
+        if timer is not None:
+            timer.mark("render")
+            timer.rows = count_rows(response)
+            response.add_post_render_callback(
+                lambda response: timer.mark("middleware_out"))
+        return response
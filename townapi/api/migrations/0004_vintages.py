@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.6 on 2026-10-19 11:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_datasetversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TownPopulation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('population', models.PositiveIntegerField()),
+                ('town', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='vintage_populations', to='api.Town')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Vintage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveSmallIntegerField(unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='townpopulation',
+            name='vintage',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='town_populations', to='api.Vintage'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='townpopulation',
+            unique_together=set([('vintage', 'town')]),
+        ),
+    ]
@@ -67,6 +67,12 @@ class Town(models.Model):
         This represents a Town (or city). Each District contains multiple
         districts, which are uniquely numbered within the district (but not
         globally unique).
+
+        Each town's rank by population (1 for the largest) and percentile
+        (100 for the largest) within its district, department, region and
+        the whole country are precomputed (see ranking.refresh_town_ranks),
+        and indexed so that they can be filtered and ordered on cheaply. They
+        are empty until they are first refreshed.
     """
     code = models.PositiveSmallIntegerField()
     district = models.ForeignKey(District, on_delete=models.CASCADE)
@@ -74,5 +80,66 @@ class Town(models.Model):
                             validators=[MinLengthValidator(1), ])
     population = models.PositiveIntegerField()
 
+    district_rank = models.PositiveIntegerField(null=True, blank=True,
+                                                db_index=True)
+    district_percentile = models.FloatField(null=True, blank=True,
+                                            db_index=True)
+    department_rank = models.PositiveIntegerField(null=True, blank=True,
+                                                  db_index=True)
+    department_percentile = models.FloatField(null=True, blank=True,
+                                              db_index=True)
+    region_rank = models.PositiveIntegerField(null=True, blank=True,
+                                              db_index=True)
+    region_percentile = models.FloatField(null=True, blank=True,
+                                          db_index=True)
+    national_rank = models.PositiveIntegerField(null=True, blank=True,
+                                                db_index=True)
+    national_percentile = models.FloatField(null=True, blank=True,
+                                            db_index=True)
+
     class Meta:
         unique_together = ("code", "district", )
+
+
+class Vintage(models.Model):
+    """
+        This represents one yearly census extract (a vintage) of the town
+        populations.
+
+        Each vintage's populations are kept in TownPopulation, while
+        Town.population holds the population from the latest vintage (or from
+        the original import, if no vintages have been imported).
+    """
+    year = models.PositiveSmallIntegerField(unique=True)
+
+
+class TownPopulation(models.Model):
+    """
+        This represents the population of a Town in one vintage. Only the
+        town, the vintage and the population are stored, so each extra
+        vintage costs one narrow row per town, rather than a copy of the
+        whole hierarchy.
+    """
+    town = models.ForeignKey(Town,
+                             on_delete=models.CASCADE,
+                             related_name="vintage_populations")
+    vintage = models.ForeignKey(Vintage,
+                                on_delete=models.CASCADE,
+                                related_name="town_populations")
+    population = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ("vintage", "town", )
+
+
+class DatasetVersion(models.Model):
+    """
+        This records the version of the dataset held in the database. There
+        is only ever one row, whose version is changed whenever a place is
+        added, changed or removed (see dataset.py), so that anything derived
+        from the data (such as cached responses) can be keyed on it.
+
+        Versions are random rather than sequential, so that two databases (or
+        a database which has been rolled back) never share a version.
+    """
+    version = models.BigIntegerField()
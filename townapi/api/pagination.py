@@ -3,9 +3,38 @@
 
     Provide utility classes for pagination.
 """
+from django.conf import settings
+from rest_framework.exceptions import ValidationError
 from rest_framework.pagination import LimitOffsetPagination
 
 
 class OneHundredResultsLimitOffsetPagination(LimitOffsetPagination):
-    """ Set the page size to 100 """
+    """
+        Set the page size to 100, and reject pages larger than
+        API_MAX_PAGE_LIMIT (rather than silently returning fewer results than
+        were asked for), so that one request cannot load the whole dataset
+        into memory.
+    """
     default_limit = 100
+
+    @property
+    def max_limit(self):
+        return getattr(settings, "API_MAX_PAGE_LIMIT", None)
+
+    def get_limit(self, request):
+        value = request.query_params.get(self.limit_query_param)
+        max_limit = self.max_limit
+
+        if value is not None and max_limit is not None:
+            try:
+                too_large = int(value) > max_limit
+            except ValueError:
+                too_large = False
+
+            if too_large:
+                raise ValidationError({
+                    self.limit_query_param: [
+                        "Must be at most {0}. Use `offset` to fetch more "
+                        "results.".format(max_limit)]})
+
+        return super().get_limit(request)
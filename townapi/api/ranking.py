@@ -0,0 +1,199 @@
+"""
+    ranking.py
+
+    Provide queries for ranking towns within the administrative levels above
+    them.
+
+    These use SQL window functions (ROW_NUMBER() OVER (PARTITION BY ...)),
+    which Django 1.11 cannot express directly, so the window is wrapped
+    around the SQL of an ordinary (filtered) queryset. Window functions need
+    SQLite 3.25 or later (or any recent PostgreSQL), and a NotSupportedError
+    is raised on older versions.
+
+    Each town's rank and percentile within every level are also precomputed
+    into columns of the Town model (see refresh_town_ranks), using a single
+    UPDATE ... FROM on SQLite 3.33 or later, or one UPDATE per town on older
+    versions.
+"""
+from django.db import NotSupportedError, connection, transaction
+from django.db.models import F
+
+from .dataset import bump_dataset_version
+from .models import Town
+
+# The levels towns can be grouped by, with the lookup of the group each town
+# belongs to, and the TownSerializer fields which identify the group
+TOWN_GROUPS = {
+    "region": ("district__department__region",
+               ("region_code", "region_name")),
+    "department": ("district__department",
+                   ("region_code", "department_code")),
+    "district": ("district",
+                 ("region_code", "department_code", "district_code")),
+}
+
+# The fields towns can be sorted by within a group
+TOWN_SORT_FIELDS = ("population", "name")
+
+# The levels towns have precomputed ranks and percentiles within (in the
+# <LEVEL>_rank and <LEVEL>_percentile fields of Town), with the lookup of the
+# group each town belongs to (None for the whole country)
+RANK_LEVELS = (
+    ("district", "district"),
+    ("department", "district__department"),
+    ("region", "district__department__region"),
+    ("national", None),
+)
+
+# The names of the precomputed rank and percentile fields
+RANK_FIELDS = tuple(field
+                    for level, _ in RANK_LEVELS
+                    for field in (level + "_rank", level + "_percentile"))
+
+TOP_N_SQL = """
+    SELECT "id" FROM (
+        SELECT "id", ROW_NUMBER() OVER (
+            PARTITION BY "group_key"
+            ORDER BY "sort_key" {direction}, "id"
+        ) AS "group_rank"
+        FROM ({towns}) AS "towns"
+    ) AS "ranked_towns"
+    WHERE "group_rank" <= %s
+"""
+
+
+# The first SQLite versions with window functions and UPDATE ... FROM
+SQLITE_WINDOW_FUNCTIONS = (3, 25, 0)
+SQLITE_UPDATE_FROM = (3, 33, 0)
+
+
+def has_sqlite_version(version):
+    """
+        Check whether the database is SQLite of at least the given version
+        (or another database, which is assumed to be recent enough).
+    """
+    return (connection.vendor != "sqlite" or
+            connection.Database.sqlite_version_info >= version)
+
+
+def check_window_functions():
+    """ Raise NotSupportedError if the database has no window functions """
+    if not has_sqlite_version(SQLITE_WINDOW_FUNCTIONS):
+        raise NotSupportedError(
+            "Ranking towns needs SQLite {0} or later (found {1})".format(
+                ".".join(str(part) for part in SQLITE_WINDOW_FUNCTIONS),
+                connection.Database.sqlite_version))
+
+
+def top_n_per_group(towns, group, n, ordering):
+    """
+        Limit a queryset of towns to the first N towns in each group, using a
+        single query.
+
+        :param towns: A (possibly filtered) Town queryset
+        :param group: One of the keys of TOWN_GROUPS
+        :param n: The number of towns to keep in each group
+        :param ordering: One of TOWN_SORT_FIELDS, optionally prefixed with
+                         `-` for descending order
+        :returns: A Town queryset, ordered by group and then by `ordering`
+    """
+    check_window_functions()
+
+    group_lookup = TOWN_GROUPS[group][0]
+    sort_field = ordering.lstrip("-")
+    descending = ordering.startswith("-")
+
+    inner = (towns.order_by()
+                  .annotate(group_key=F(group_lookup),
+                            sort_key=F(sort_field))
+                  .values("id", "group_key", "sort_key"))
+    sql, params = inner.query.sql_with_params()
+
+    # This is added with extra() rather than as a RawSQL expression, since
+    # __in would wrap the expression in a second set of brackets (making it
+    # a scalar subquery)
+    ranked = "{0}.{1} IN ({2})".format(
+        connection.ops.quote_name(towns.model._meta.db_table),
+        connection.ops.quote_name("id"),
+        TOP_N_SQL.format(towns=sql,
+                         direction="DESC" if descending else "ASC"))
+
+    return (towns.model.objects
+                 .extra(where=[ranked], params=params + (n, ))
+                 .order_by(group_lookup, ordering, "id"))
+
+
+RANK_COLUMNS_SQL = """
+    RANK() OVER ({partition} ORDER BY "population" DESC) AS {rank},
+    ROUND(100.0 * CUME_DIST() OVER ({partition} ORDER BY "population"), 2)
+        AS {percentile}
+"""
+
+RANKED_TOWNS_SQL = """
+    SELECT "id", {columns}
+    FROM ({towns}) AS "towns"
+"""
+
+REFRESH_RANKS_SQL = """
+    UPDATE {table} SET {assignments}
+    FROM ({ranked}) AS "ranked_towns"
+    WHERE {table}."id" = "ranked_towns"."id"
+"""
+
+UPDATE_TOWN_RANKS_SQL = """
+    UPDATE {table} SET {assignments}
+    WHERE "id" = %s
+"""
+
+
+def refresh_town_ranks():
+    """
+        Recompute every town's rank by population (1 for the largest, with
+        ties sharing a rank) and percentile (the percentage of towns with the
+        same or a smaller population, so 100 for the largest) within each of
+        RANK_LEVELS, using a single UPDATE (or, on SQLite older than 3.33,
+        by selecting the ranks and then updating each town).
+
+        This should be run after the towns are changed (it is run at the end
+        of each import). The dataset version is bumped afterwards, since raw
+        updates do not send the signals which would otherwise do that.
+    """
+    check_window_functions()
+
+    quote = connection.ops.quote_name
+    table = quote(Town._meta.db_table)
+    keys = {level: F(lookup) for level, lookup in RANK_LEVELS if lookup}
+
+    towns = (Town.objects.order_by()
+                         .annotate(**{level + "_key": key
+                                      for level, key in keys.items()})
+                         .values("id", "population",
+                                 *(level + "_key" for level in keys)))
+    sql, params = towns.query.sql_with_params()
+
+    columns = ",".join(RANK_COLUMNS_SQL.format(
+        partition=("PARTITION BY " + quote(level + "_key")
+                   if level in keys else ""),
+        rank=quote(level + "_rank"),
+        percentile=quote(level + "_percentile"))
+        for level, _ in RANK_LEVELS)
+    ranked = RANKED_TOWNS_SQL.format(columns=columns, towns=sql)
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            if has_sqlite_version(SQLITE_UPDATE_FROM):
+                cursor.execute(REFRESH_RANKS_SQL.format(
+                    table=table,
+                    assignments=", ".join(
+                        "{0} = {1}.{0}".format(quote(field),
+                                               quote("ranked_towns"))
+                        for field in RANK_FIELDS),
+                    ranked=ranked), params)
+            else:
+                cursor.execute(ranked, params)
+                rows = [row[1:] + row[:1] for row in cursor.fetchall()]
+                cursor.executemany(UPDATE_TOWN_RANKS_SQL.format(
+                    table=table,
+                    assignments=", ".join("{0} = %s".format(quote(field))
+                                          for field in RANK_FIELDS)), rows)
+        bump_dataset_version()
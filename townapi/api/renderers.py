@@ -0,0 +1,131 @@
+"""
+    renderers.py
+
+    Declare renderers for formats which are not provided by DRF, and a
+    faster JSON renderer for pages of pre-encoded rows.
+"""
+import json
+import re
+import uuid
+
+from rest_framework.compat import INDENT_SEPARATORS, LONG_SEPARATORS, \
+    SHORT_SEPARATORS
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .columnar import COLUMNAR_CONTENT_TYPE
+from .fragments import EncodedRows
+
+# Stands in for each EncodedRows object while the rest of a page is encoded
+# (random, so that it cannot clash with the data)
+PLACEHOLDER_TOKEN = uuid.uuid4().hex
+PLACEHOLDER_RE = re.compile(
+    '"{0}:([0-9]+)"'.format(PLACEHOLDER_TOKEN).encode("ascii"))
+
+# The number of rows joined into each chunk of a streamed page
+STREAM_CHUNK_ROWS = 1000
+
+
+class ColumnarRenderer(BaseRenderer):
+    """
+        Pass through bodies which have already been encoded in the columnar
+        format (see columnar.py).
+
+        Anything else (such as an error) is sent as JSON, as there is nothing
+        useful to encode.
+    """
+    media_type = COLUMNAR_CONTENT_TYPE
+    format = "columnar"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, bytes):
+            return data
+        return json.dumps(data).encode("utf-8")
+
+
+class PlaceholderEncoder(JSONEncoder):
+    """
+        Encode each EncodedRows object as a placeholder string, and add it to
+        a list so that its rows can be put in place of the placeholder.
+    """
+
+    def __init__(self, *args, placeholders, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.placeholders = placeholders
+
+    def default(self, obj):
+        if isinstance(obj, EncodedRows):
+            self.placeholders.append(obj)
+            return "{0}:{1}".format(PLACEHOLDER_TOKEN,
+                                    len(self.placeholders) - 1)
+        return super().default(obj)
+
+
+class PreEncodedJSONRenderer(JSONRenderer):
+    """
+        Render JSON exactly as DRF's JSONRenderer does, except that the rows
+        of EncodedRows objects (see fragments.py) are joined into the output
+        as they are, rather than being decoded and encoded again.
+
+        Indented output (e.g. for the browsable API) is rendered as usual.
+    """
+
+    def encode(self, data, indent=None, encoder_class=None, **kwargs):
+        """
+            Encode data as JSON bytes, with the options of JSONRenderer (any
+            keyword arguments are passed on to the encoder).
+        """
+        if indent is None:
+            separators = SHORT_SEPARATORS if self.compact else LONG_SEPARATORS
+        else:
+            separators = INDENT_SEPARATORS
+
+        ret = json.dumps(
+            data, cls=encoder_class or self.encoder_class,
+            indent=indent, ensure_ascii=self.ensure_ascii,
+            allow_nan=not self.strict, separators=separators, **kwargs)
+
+        # As in JSONRenderer, so that the output is a javascript subset
+        ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+        return ret.encode("utf-8")
+
+    def render_chunks(self, data, accepted_media_type=None,
+                      renderer_context=None, chunk_rows=STREAM_CHUNK_ROWS):
+        """
+            Render data as a sequence of byte strings, with the pre-encoded
+            rows joined in chunks of up to chunk_rows rows (or all at once if
+            chunk_rows is None).
+        """
+        if data is None:
+            return
+
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None:
+            yield self.encode(data, indent)
+            return
+
+        placeholders = []
+        parts = PLACEHOLDER_RE.split(
+            self.encode(data, encoder_class=PlaceholderEncoder,
+                        placeholders=placeholders))
+
+        # The parts alternate between encoded data and placeholder numbers
+        yield parts[0]
+        for index in range(1, len(parts), 2):
+            fragments = placeholders[int(parts[index])].fragments
+            step = chunk_rows or max(len(fragments), 1)
+
+            yield b"["
+            for start in range(0, len(fragments), step):
+                if start:
+                    yield b","
+                yield b",".join(fragments[start:start + step])
+            yield b"]"
+
+            yield parts[index + 1]
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return b"".join(self.render_chunks(data, accepted_media_type,
+                                           renderer_context, chunk_rows=None))
@@ -0,0 +1,115 @@
+"""
+    rollup.py
+
+    Provide the in-memory rollup used by the hierarchical aggregation
+    endpoint.
+
+    Rather than running one GROUP BY per administrative level, the towns are
+    grouped once at the deepest requested level in SQL, and the results are
+    then combined upwards in Python (in the same way as SQL's ROLLUP). Since
+    min, max, sum and count can all be combined from partial results, this
+    gives exactly the same figures as aggregating each level separately.
+"""
+from django.db.models import Count, Max, Min, Sum
+
+from .constants import format_region_code
+
+# The levels of the hierarchy, from the top down. Each entry gives the name
+# used for a node's children in the response, the fields that identify a
+# node at that level in a Town values() query, and how to display its code
+# (matching the flat aggs serializers).
+ROLLUP_LEVELS = (
+    ("departments",
+     ("district__department__region__code",
+      "district__department__region__name"),
+     format_region_code),
+    ("districts", ("district__department__code", ), str),
+    (None, ("district__code", ), int),
+)
+ROLLUP_MAX_DEPTH = len(ROLLUP_LEVELS)
+
+
+class RollupNode:
+    """
+        A single place in the rollup tree, holding the partial aggregates
+        needed to combine it with its siblings.
+    """
+    __slots__ = ("code", "name", "children_name", "children",
+                 "min_population", "max_population", "total_population",
+                 "town_count")
+
+    def __init__(self, code, name=None, children_name=None):
+        self.code = code
+        self.name = name
+        self.children_name = children_name
+        self.children = {} if children_name else None
+        self.min_population = None
+        self.max_population = None
+        self.total_population = 0
+        self.town_count = 0
+
+    @property
+    def avg_population(self):
+        """ Match the average given by the database for the flat endpoints """
+        if not self.town_count:
+            return None
+        return self.total_population / self.town_count
+
+    def add(self, min_population, max_population, total_population,
+            town_count):
+        """ Fold a set of partial aggregates into this node """
+        if self.min_population is None or min_population < self.min_population:
+            self.min_population = min_population
+        if self.max_population is None or max_population > self.max_population:
+            self.max_population = max_population
+        self.total_population += total_population
+        self.town_count += town_count
+
+    def sorted_children(self):
+        """ Return the children of this node, ordered by their code """
+        return [self.children[key] for key in sorted(self.children)]
+
+
+def build_rollup(towns, depth=ROLLUP_MAX_DEPTH, population="population"):
+    """
+        Build the rollup tree for a queryset of towns.
+
+        :param towns: A (possibly filtered) Town queryset
+        :param depth: The number of levels to include, from 1 (regions only)
+                      to ROLLUP_MAX_DEPTH (down to districts)
+        :param population: The lookup for each town's population (e.g. to
+                           read it from a past vintage, see vintages.py)
+        :returns: A list of RollupNode objects for the regions, ordered by
+                  code
+    """
+    levels = ROLLUP_LEVELS[:depth]
+    group_fields = [field for _, fields, _ in levels for field in fields]
+
+    rows = (towns.order_by()
+                 .values_list(*group_fields)
+                 .annotate(min_population=Min(population),
+                           max_population=Max(population),
+                           total_population=Sum(population),
+                           town_count=Count("id")))
+
+    regions = {}
+    for row in rows:
+        aggregates = row[len(group_fields):]
+        siblings = regions
+        position = 0
+
+        for i, (children_name, fields, display) in enumerate(levels):
+            key = row[position]
+            name = row[position + 1] if len(fields) > 1 else None
+            position += len(fields)
+
+            node = siblings.get(key)
+            if node is None:
+                node = siblings[key] = RollupNode(
+                    display(key),
+                    name,
+                    children_name if i + 1 < depth else None)
+            node.add(*aggregates)
+            siblings = node.children
+
+    return [regions[key] for key in sorted(regions)]
@@ -4,16 +4,92 @@
     This file decares the serializers for the api app. There is a single
     serializer for each API endpoint.
 """
+import re
+
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
+from .hierarchy import HIERARCHY_LEVELS
 from .models import Department, District, Region, Town
+from .ranking import RANK_FIELDS
+from .vintages import VINTAGE_POPULATION
 """
 Add the following serializers:
 - AggsSerializer - Custom serializer to pack the required aggregate data into
                    a JSON object
  """
 
+DISPLAY_METHOD_RE = re.compile(r"^get_(\w+)_display$")
+
+
+class SparseFieldsMixin:
+    """
+        Allow a model serializer to be limited to a subset of its fields, by
+        passing `fields=<NAMES>` when it is created. Fields listed in
+        `Meta.optional_fields` are only included when they are asked for.
 
-class TownSerializer(serializers.ModelSerializer):
+        The serializer can also report which related objects and columns the
+        remaining fields are read from, so that views can avoid joining or
+        selecting anything that will not be sent.
+    """
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop("fields", None)
+        super().__init__(*args, **kwargs)
+
+        if fields is None:
+            fields = set(self.fields) - set(self.get_optional_fields())
+
+        for name in set(self.fields) - set(fields):
+            self.fields.pop(name)
+
+    @classmethod
+    def get_optional_fields(cls):
+        """ Get the fields which are only included when asked for """
+        return getattr(cls.Meta, "optional_fields", ())
+
+    def get_query_dependencies(self):
+        """
+            Work out what the current fields need from the database, by
+            following each field's source through the model relations.
+
+            :returns: A tuple of (relations, columns), where relations is the
+                      set of relation paths to pass to select_related() and
+                      columns is the set of field paths to pass to only().
+                      Sources which are not model fields (e.g. annotations)
+                      are skipped.
+        """
+        relations = set()
+        columns = set()
+
+        for field in self.fields.values():
+            model = self.Meta.model
+            path = []
+
+            for attr in field.source_attrs:
+                display = DISPLAY_METHOD_RE.match(attr)
+                if display:
+                    attr = display.group(1)
+
+                try:
+                    model_field = model._meta.get_field(attr)
+                except FieldDoesNotExist:
+                    break
+
+                path.append(attr)
+                columns.add("__".join(path))
+
+                # Reading a foreign key's attname (e.g. department_id) does
+                # not need the related object to be fetched
+                if not model_field.is_relation or attr != model_field.name:
+                    break
+
+                relations.add("__".join(path))
+                model = model_field.related_model
+
+        return relations, columns
+
+
+class TownSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
         The Town model is serialized into a single flat JSON object containing
         both the Town's fields and those of the Town's administrative parents.
@@ -28,13 +104,16 @@ class TownSerializer(serializers.ModelSerializer):
         - Names are sent as strings
         - Properties are sent as the appropriate type (e.g. population is sent
           as an integer)
+
+        The precomputed ranks and percentiles (see ranking.py) are optional,
+        so they are only sent when they are asked for.
     """
     town_code = serializers.CharField(source="code", label="Town Code")
     town_name = serializers.CharField(source="name", label="Town Name")
     district_code = serializers.CharField(source="district.code",
                                           label="District Code")
     department_code = serializers.CharField(
-        source="district.department.code",
+        source="district.department_id",
         label="Department Code")
     region_code = serializers.CharField(
         source="district.department.region.get_code_display",
@@ -50,16 +129,27 @@ class TownSerializer(serializers.ModelSerializer):
             Manually declare the list of fields in case the models change.
         """
         model = Town
+        optional_fields = RANK_FIELDS
         fields = ("town_code",
                   "town_name",
                   "population",
                   "district_code",
                   "department_code",
                   "region_code",
-                  "region_name")
+                  "region_name") + optional_fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
 
+        # Send the population from the requested vintage if there is one
+        # (see VintageViewMixin)
+        if "population" in data and hasattr(instance, VINTAGE_POPULATION):
+            data["population"] = getattr(instance, VINTAGE_POPULATION)
 
-class AggsSerializer(serializers.ModelSerializer):
+        return data
+
+
+class AggsSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     """
         This serializer returns the aggregates mix/max average population,
         and the identifying information (code) for whatever we are
@@ -109,7 +199,7 @@ class DistrictAggsSerializer(AggsSerializer):
     region_code = serializers.CharField(
         source="department.region.get_code_display",
         label="Region Code")
-    department_code = serializers.CharField(source="department.code",
+    department_code = serializers.CharField(source="department_id",
                                             label="Department Code")
 
     class Meta(AggsSerializer.Meta):
@@ -126,7 +216,7 @@ class TownAggsSerializer(AggsSerializer):
     district_code = serializers.CharField(source="district.code",
                                           label="District Code")
     department_code = serializers.CharField(
-        source="district.department.code",
+        source="district.department_id",
         label="Department Code")
 
     class Meta(AggsSerializer.Meta):
@@ -135,3 +225,70 @@ class TownAggsSerializer(AggsSerializer):
                                                "region_code",
                                                "department_code",
                                                "district_code")
+
+
+class PlaceNodeSerializer(serializers.Serializer):
+    """
+        Serialize a node of the rollup tree (see rollup.py) or hierarchy index
+        (see hierarchy.py) using the same fields as AggsSerializer, along with
+        its name if it has one (as regions do).
+    """
+    code = serializers.ReadOnlyField()
+    min_population = serializers.IntegerField()
+    max_population = serializers.IntegerField()
+    avg_population = serializers.IntegerField()
+    town_count = serializers.IntegerField()
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        if instance.name is not None:
+            data["name"] = instance.name
+
+        return data
+
+
+class RollupAggsSerializer(PlaceNodeSerializer):
+    """
+        Serialize a node of the rollup tree (see rollup.py) using the same
+        fields as AggsSerializer.
+
+        Regions also carry their name, and every level except the deepest one
+        requested carries its children under a key named after their level
+        (e.g. "departments" for a region).
+    """
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        if instance.children is not None:
+            data[instance.children_name] = self.__class__(
+                instance.sorted_children(), many=True).data
+
+        return data
+
+
+class PlaceDetailSerializer(PlaceNodeSerializer):
+    """
+        Serialize a single place from the hierarchy index (see hierarchy.py)
+        using the same fields as AggsSerializer, along with the codes of its
+        parents and the codes of its children, listed under a key named after
+        their level (e.g. "departments" for a region).
+
+        The codes of the place's parents should be passed from the top down as
+        the `parent_codes` context.
+    """
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+
+        parent_codes = self.context.get("parent_codes", ())
+        for (field, _, display), code in zip(HIERARCHY_LEVELS, parent_codes):
+            data[field] = display(code)
+
+        if instance.children is not None:
+            display = HIERARCHY_LEVELS[len(parent_codes) + 1][2]
+            data[instance.children_name] = [
+                display(code) for code in sorted(instance.children)]
+
+        return data
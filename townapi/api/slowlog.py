@@ -0,0 +1,411 @@
+"""
+    slowlog.py
+
+    Record requests which take longer than API_SLOW_REQUEST_THRESHOLD
+    seconds (see SlowRequestMiddleware), to diagnose latency spikes.
+
+    Every SQL statement run while handling a request is timed by a thin cursor
+    wrapper (rather than Django's debug cursor, which also formats each
+    statement with its parameters). Statement parameters are only kept for
+    the slowest statement so far, and for statements run once the request
+    has taken API_SLOW_REQUEST_DETAIL_AFTER seconds (see StatementLog). Only
+    once a request turns out to be slow is anything else done: the slowest
+    SELECT is explained, and a record of the request is written as one line
+    of JSON to a rotating log file at API_SLOW_REQUEST_LOG.
+
+    Statements are recorded for the connections of the thread handling the
+    request, so those run by the worker threads of a batch (see batch.py) are
+    not captured.
+
+    Each record holds:
+    - The normalized URL (with query values replaced by "?"), the status and
+      the total time
+    - The time spent in each phase (middleware before the view, the view,
+      rendering and middleware after the view) and in SQL
+    - The number of rows in the response, if it is a list of results
+    - Every statement, with its time, (for writes) its row count and (if it
+      was run after the detail threshold, see above) its parameters
+    - The slowest statement's parameters and query plan
+
+    The slow_requests management command summarizes the log.
+"""
+import datetime
+import glob
+import json
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from urllib.parse import parse_qsl
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.backends.utils import CursorWrapper
+
+from .fragments import EncodedRows
+
+# The format of record timestamps (always in UTC)
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+
+Statement = namedtuple("Statement", ("alias", "sql", "params", "duration",
+                                     "rowcount"))
+
+# A summary of the statements of one shape (see summarize_shapes)
+ShapeSummary = namedtuple("ShapeSummary", ("shape", "count", "total_ms",
+                                           "max_ms", "urls", "plan"))
+
+WHITESPACE_RE = re.compile(r"\s+")
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER_LIST_RE = re.compile(r"\?(?:, \?)+")
+
+
+class StatementLog:
+    """
+        The statements run while handling a request.
+
+        Every statement is kept with its time and row count, but its
+        parameters are only kept if it is the slowest so far or once
+        `detail_after` seconds have passed, so that the many fast requests do
+        not hold on to the parameters of every statement.
+
+        :param detail_after: The time into the request (in seconds) from which
+                             the parameters of every statement are kept
+    """
+
+    def __init__(self, detail_after=0):
+        self.detail_from = time.perf_counter() + detail_after
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = None
+        self.statements = []
+
+    def add(self, alias, sql, params, start, cursor):
+        """ Record a statement which was started at `start` """
+        end = time.perf_counter()
+        duration = end - start
+        self.count += 1
+        self.duration += duration
+
+        try:
+            rowcount = cursor.rowcount
+        except Exception:
+            rowcount = -1
+
+        statement = Statement(alias, sql, params, duration, rowcount)
+        if self.slowest is None or duration > self.slowest.duration:
+            self.slowest = statement
+
+        if end < self.detail_from:
+            statement = statement._replace(params=None)
+        self.statements.append(statement)
+
+
+class TimingCursorWrapper(CursorWrapper):
+    """
+        Time each statement run through a cursor, and add it to a
+        StatementLog.
+
+        :param cursor: The cursor to wrap (which may itself be wrapped)
+        :param db: The connection the cursor belongs to
+        :param statements: The StatementLog to add statements to
+    """
+
+    def __init__(self, cursor, db, statements):
+        super().__init__(cursor, db)
+        self.statements = statements
+
+    def execute(self, sql, params=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self.statements.add(self.db.alias, sql, params, start,
+                                self.cursor)
+
+    def executemany(self, sql, param_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, param_list)
+        finally:
+            self.statements.add(self.db.alias, sql, None, start, self.cursor)
+
+
+@contextmanager
+def record_statements(detail_after=0):
+    """
+        Time every statement run on this thread's connections (statements run
+        by other threads, such as a batch's workers, are not recorded).
+
+        Queries are still logged as usual if they were already being logged
+        (e.g. with DEBUG on, or in tests using CaptureQueriesContext).
+
+        :param detail_after: See StatementLog
+        :returns: A StatementLog, which statements are added to
+    """
+    statements = StatementLog(detail_after)
+    restore = []
+
+    for connection in connections.all():
+        previous = connection.__dict__.get("make_debug_cursor")
+        make_debug_cursor = connection.make_debug_cursor
+        make_cursor = (make_debug_cursor if connection.queries_logged
+                       else connection.make_cursor)
+
+        def make_timing_cursor(cursor, connection=connection,
+                               make_cursor=make_cursor):
+            return TimingCursorWrapper(make_cursor(cursor), connection,
+                                       statements)
+
+        restore.append((connection, previous, connection.force_debug_cursor))
+        connection.make_debug_cursor = make_timing_cursor
+        connection.force_debug_cursor = True
+
+    try:
+        yield statements
+    finally:
+        for connection, previous, force_debug_cursor in restore:
+            connection.force_debug_cursor = force_debug_cursor
+            if previous is None:
+                del connection.make_debug_cursor
+            else:
+                connection.make_debug_cursor = previous
+
+
+class RequestTimer:
+    """
+        Mark the start of each phase of handling a request.
+
+        The phases are named after the mark which starts them, and each runs
+        until the next mark. The number of rows in the response is also kept
+        (see count_rows), as later middleware may replace the response.
+    """
+
+    def __init__(self):
+        self.marks = [("middleware_in", time.perf_counter())]
+        self.rows = None
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def finish(self):
+        self.end = time.perf_counter()
+
+    @property
+    def duration(self):
+        return self.end - self.marks[0][1]
+
+    def get_phases(self):
+        """ :returns: A dictionary of the milliseconds spent in each phase """
+        ends = [start for _, start in self.marks[1:]] + [self.end]
+        return {name: _ms(end - start)
+                for (name, start), end in zip(self.marks, ends)}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+def normalize_url(request):
+    """
+        Normalize a request's URL by replacing the query values with "?" and
+        sorting the query parameters.
+    """
+    names = sorted({name for name, _ in parse_qsl(
+        request.META.get("QUERY_STRING", ""), keep_blank_values=True)})
+    if not names:
+        return request.path
+    return "{0}?{1}".format(request.path,
+                            "&".join(name + "=?" for name in names))
+
+
+def normalize_sql(sql):
+    """
+        Reduce a statement to its shape, by replacing parameters and literals
+        with "?" (and lists of them with a single "?, ...").
+    """
+    sql = WHITESPACE_RE.sub(" ", sql.strip())
+    sql = STRING_RE.sub("?", sql)
+    sql = NUMBER_RE.sub("?", sql.replace("%s", "?"))
+    return PLACEHOLDER_LIST_RE.sub("?, ...", sql)
+
+
+def explain_statement(statement):
+    """
+        Get the query plan for a SELECT statement.
+
+        :returns: A list of strings (one per line of the plan), or None if
+                  the statement cannot be explained
+    """
+    if not statement.sql.lstrip().upper().startswith("SELECT"):
+        return None
+
+    connection = connections[statement.alias]
+    prefix = ("EXPLAIN QUERY PLAN " if connection.vendor == "sqlite"
+              else "EXPLAIN ")
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + statement.sql, statement.params)
+            rows = cursor.fetchall()
+    except DatabaseError:
+        return None
+
+    if connection.vendor == "sqlite":
+        return [str(row[-1]) for row in rows]
+    return [" ".join(str(column) for column in row) for row in rows]
+
+
+def count_rows(response):
+    """ Count the results in a response, if it has a list of them """
+    data = getattr(response, "data", None)
+    if isinstance(data, dict):
+        data = data.get("results")
+    return len(data) if isinstance(data, (list, EncodedRows)) else None
+
+
+def _statement_record(statement):
+    """ Describe a statement in a record """
+    record = {"sql": statement.sql,
+              "duration_ms": _ms(statement.duration),
+              "rowcount": statement.rowcount}
+    if statement.params is not None:
+        record["params"] = [str(param) for param in statement.params]
+    return record
+
+
+def build_record(request, response, timer, statements):
+    """
+        Build the record of a slow request.
+
+        :param statements: A StatementLog
+        :returns: A dictionary, which can be encoded as JSON
+    """
+    max_statements = getattr(settings, "API_SLOW_REQUEST_MAX_STATEMENTS",
+                             None)
+
+    record = {
+        "timestamp": datetime.datetime.utcnow().strftime(TIMESTAMP_FORMAT),
+        "pid": os.getpid(),
+        "method": request.method,
+        "url": normalize_url(request),
+        "query": request.META.get("QUERY_STRING", ""),
+        "status": response.status_code,
+        "duration_ms": _ms(timer.duration),
+        "phases": dict(timer.get_phases(), sql=_ms(statements.duration)),
+        "rows": timer.rows,
+        "statement_count": statements.count,
+        "statements": [
+            _statement_record(statement)
+            for statement in statements.statements[:max_statements]],
+        "slowest": None,
+    }
+
+    slowest = statements.slowest
+    if slowest is not None:
+        record["slowest"] = {
+            "sql": slowest.sql,
+            "params": [str(param) for param in slowest.params or ()],
+            "duration_ms": _ms(slowest.duration),
+            "plan": explain_statement(slowest),
+        }
+
+    return record
+
+
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def _get_handler(path):
+    """ Get the rotating file handler for a log file (one per path) """
+    with _handlers_lock:
+        handler = _handlers.get(path)
+        if handler is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = _handlers[path] = logging.handlers.RotatingFileHandler(
+                path,
+                maxBytes=getattr(settings, "API_SLOW_REQUEST_LOG_MAX_BYTES",
+                                 0),
+                backupCount=getattr(settings, "API_SLOW_REQUEST_LOG_BACKUPS",
+                                    0),
+                encoding="utf-8")
+        return handler
+
+
+def write_record(record, path=None):
+    """ Write a record to the slow request log, as a line of JSON """
+    path = path or settings.API_SLOW_REQUEST_LOG
+    _get_handler(path).handle(logging.makeLogRecord({
+        "msg": json.dumps(record, sort_keys=True, default=str)}))
+
+
+def read_records(path=None, since=None):
+    """
+        Read the records in the slow request log, including the rotated
+        files, skipping any lines which cannot be read.
+
+        :param since: If given, only read records from after this (naive UTC)
+                      datetime
+        :returns: A list of records, oldest first
+    """
+    path = path or settings.API_SLOW_REQUEST_LOG
+    rotated = [name for name in glob.glob(glob.escape(path) + ".*")
+               if name[len(path) + 1:].isdigit()]
+    paths = sorted(rotated, key=lambda name: -int(name[len(path) + 1:]))
+
+    records = []
+    for name in paths + [path]:
+        if not os.path.exists(name):
+            continue
+
+        with open(name, encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                    timestamp = datetime.datetime.strptime(
+                        record["timestamp"], TIMESTAMP_FORMAT)
+                except (ValueError, KeyError, TypeError):
+                    continue
+
+                if since is None or timestamp >= since:
+                    records.append(record)
+
+    return records
+
+
+def summarize_shapes(records, top=None):
+    """
+        Group the statements in slow request records by their shape (see
+        normalize_sql).
+
+        :param top: If given, only summarize this many shapes
+        :returns: A list of ShapeSummary objects, from the most to the least
+                  total time
+    """
+    shapes = {}
+
+    for record in records:
+        slowest = record.get("slowest") or {}
+        for statement in record.get("statements", ()):
+            shape = normalize_sql(statement["sql"])
+            summary = shapes.setdefault(
+                shape, {"count": 0, "total_ms": 0, "max_ms": 0,
+                        "urls": Counter(), "plan": None})
+            summary["count"] += 1
+            summary["total_ms"] += statement["duration_ms"]
+            summary["max_ms"] = max(summary["max_ms"],
+                                    statement["duration_ms"])
+            summary["urls"][record.get("url")] += 1
+            if statement["sql"] == slowest.get("sql") and slowest.get("plan"):
+                summary["plan"] = slowest["plan"]
+
+    summaries = sorted(
+        (ShapeSummary(shape, total_ms=round(summary.pop("total_ms"), 3),
+                      **summary)
+         for shape, summary in shapes.items()),
+        key=lambda summary: -summary.total_ms)
+    return summaries[:top] if top else summaries
@@ -0,0 +1,61 @@
+"""
+    snapshot.py
+
+    Provide helpers for the static snapshot of the most requested responses,
+    which nginx serves without calling Django (see the render_snapshot
+    command).
+
+    The snapshot is served for every host, so the pagination links in it are
+    made relative. It is only valid for the dataset version it was rendered
+    from: whenever the version is bumped (by an import, refresh_ranks or a
+    change through the admin site), the snapshot is taken down once the
+    change is committed, so that nginx falls back to Django until it is
+    rendered again.
+"""
+import os
+
+from django.conf import settings
+from django.db import transaction
+
+
+def get_snapshot_target(root, version):
+    """ Get the directory the snapshot of a dataset version is rendered to """
+    return "{0}-{1}".format(root, version)
+
+
+def make_links_relative(body, base_url):
+    """
+        Strip the scheme and host (as in base_url, e.g. http://localhost)
+        from the links in a JSON response body, so that they work for
+        whichever host the snapshot is served for.
+    """
+    prefix = '"{0}/'.format(base_url.rstrip("/")).encode("utf-8")
+    return body.replace(prefix, b'"/')
+
+
+def remove_stale_snapshot(version, root=None):
+    """
+        Take the snapshot down if it was not rendered from the given dataset
+        version (the rendered directories are left for the next render to
+        clean up).
+
+        :returns: True if the snapshot was taken down
+    """
+    root = os.path.abspath(root or settings.API_SNAPSHOT_ROOT)
+    if not os.path.islink(root):
+        return False
+
+    target = os.path.basename(get_snapshot_target(root, version))
+    if os.readlink(root) == target:
+        return False
+
+    os.remove(root)
+    return True
+
+
+def handle_dataset_changed(sender, version, **kwargs):
+    """
+        Signal receiver to take the snapshot down once a new dataset version
+        is committed
+    """
+    transaction.on_commit(lambda: remove_stale_snapshot(version))
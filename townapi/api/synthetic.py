@@ -0,0 +1,204 @@
+"""
+    synthetic.py
+
+    Generate realistic synthetic town data at any scale, in the same schema as
+    data/towns.csv, for benchmarking with larger datasets than the real one.
+
+    The generated data keeps to the same constraints as the real data:
+    - Every region code is one of FR_REGION_CODES, with a consistent name
+    - There are 101 departments (with their real codes, including 2A/2B and
+      the overseas 97x codes), each belonging to its real region
+    - Districts are numbered from 1 within each department, and towns from 1
+      within each district
+
+    Scaling mostly adds towns, and (more slowly) districts, since the
+    regions and departments are fixed. Town populations follow a heavy-tailed
+    (log-normal, with a few much larger cities) distribution with a median
+    close to that of the real data, capped at about the population of Paris.
+    Generation is deterministic for a given seed.
+"""
+import csv
+import math
+import random
+
+from .constants import FR_EU_REGION_CODES, FR_OVERSEAS_REGION_CODES
+
+# The number of towns in data/towns.csv, i.e. scale 1
+BASE_TOWN_COUNT = 35909
+
+REGION_NAMES = {
+    1: "Guadeloupe",
+    2: "Martinique",
+    3: "Guyane",
+    4: "La Réunion",
+    5: "Mayotte",
+    11: "Île-de-France",
+    24: "Centre-Val de Loire",
+    27: "Bourgogne-Franche-Comté",
+    28: "Normandie",
+    32: "Hauts-de-France",
+    44: "Grand-Est",
+    52: "Pays de la Loire",
+    53: "Bretagne",
+    75: "Nouvelle-Aquitaine",
+    76: "Occitanie",
+    84: "Auvergne-Rhône-Alpes",
+    93: "Provence-Alpes-Côte d'Azur",
+    94: "Corse",
+}
+
+# The codes of the departments in each region (as in data/towns.csv, where
+# leading zeros are dropped and Corsica is 2A and 2B rather than 20)
+REGION_DEPARTMENT_CODES = {
+    1: ("971", ),
+    2: ("972", ),
+    3: ("973", ),
+    4: ("974", ),
+    5: ("976", ),
+    11: ("75", "77", "78", "91", "92", "93", "94", "95"),
+    24: ("18", "28", "36", "37", "41", "45"),
+    27: ("21", "25", "39", "58", "70", "71", "89", "90"),
+    28: ("14", "27", "50", "61", "76"),
+    32: ("2", "59", "60", "62", "80"),
+    44: ("8", "10", "51", "52", "54", "55", "57", "67", "68", "88"),
+    52: ("44", "49", "53", "72", "85"),
+    53: ("22", "29", "35", "56"),
+    75: ("16", "17", "19", "23", "24", "33", "40", "47", "64", "79", "86",
+         "87"),
+    76: ("9", "11", "12", "30", "31", "32", "34", "46", "48", "65", "66",
+         "81", "82"),
+    84: ("1", "3", "7", "15", "26", "38", "42", "43", "63", "69", "73",
+         "74"),
+    93: ("4", "5", "6", "13", "83", "84"),
+    94: ("2A", "2B"),
+}
+
+# The number of districts in each department at scale 1
+DISTRICTS_PER_DEPARTMENT = (2, 5)
+
+# Town populations are log-normal with this median, and a small fraction of
+# towns are cities with Pareto-distributed multiples of that
+MEDIAN_POPULATION = 450
+POPULATION_SIGMA = 1.3
+CITY_PROBABILITY = 0.002
+CITY_PARETO_ALPHA = 1.2
+CITY_MULTIPLIER = 20
+MAX_POPULATION = 2200000
+
+NAME_PREFIXES = ("", "", "", "Saint-", "Sainte-", "Le ", "La ", "Les ",
+                 "L' ")
+NAME_ROOTS = ("Mont", "Beau", "Ville", "Font", "Roche", "Val", "Cham",
+              "Bois", "Mar", "Sau", "Ver", "Pont", "Lan", "Bel", "Cour",
+              "Ker", "Vil", "Aube", "Grand", "Bour")
+NAME_ENDINGS = ("ville", "court", "mont", "lieu", "ac", "ay", "ignac",
+                "euil", "ières", "ange", "ois", "y", "on", "elle", "an")
+NAME_SUFFIXES = ("", "", "", "", "", "-sur-Loire", "-sur-Mer",
+                 "-en-Bugey", "-le-Château", "-les-Bains", "-la-Forêt",
+                 "-de-Varey")
+
+# The columns of data/towns.csv, in order
+CSV_FIELDS = ("region_code", "region_name", "department_code",
+              "district_code", "town_code", "town_name", "population")
+
+
+def get_departments():
+    """
+        List the departments, with the region each one belongs to.
+
+        :returns: A list of (department code, region code) tuples
+    """
+    return [(department_code, region_code)
+            for region_code in FR_OVERSEAS_REGION_CODES + FR_EU_REGION_CODES
+            for department_code in REGION_DEPARTMENT_CODES[region_code]]
+
+
+def _allocate(total, weights):
+    """
+        Split a total between buckets in proportion to their weights (using
+        the largest remainder method, so the counts add up to the total).
+    """
+    scale = total / sum(weights)
+    shares = [weight * scale for weight in weights]
+    counts = [int(share) for share in shares]
+
+    by_remainder = sorted(range(len(shares)),
+                          key=lambda i: counts[i] - shares[i])
+    for i in by_remainder[:total - sum(counts)]:
+        counts[i] += 1
+
+    return counts
+
+
+def _town_name(rng):
+    """ Make up a plausible French town name """
+    return "{0}{1}{2}{3}".format(rng.choice(NAME_PREFIXES),
+                                 rng.choice(NAME_ROOTS),
+                                 rng.choice(NAME_ENDINGS),
+                                 rng.choice(NAME_SUFFIXES))
+
+
+def _population(rng):
+    """ Draw a town population from a heavy-tailed distribution """
+    population = rng.lognormvariate(math.log(MEDIAN_POPULATION),
+                                    POPULATION_SIGMA)
+    if rng.random() < CITY_PROBABILITY:
+        population *= CITY_MULTIPLIER * rng.paretovariate(CITY_PARETO_ALPHA)
+    return int(min(population, MAX_POPULATION))
+
+
+def generate_towns(scale, seed=0):
+    """
+        Generate synthetic towns. Towns are generated one at a time, so any
+        scale can be written out without holding the data in memory.
+
+        :param scale: The size of the dataset relative to data/towns.csv
+        :param seed: The random seed to use
+        :returns: An iterator of dictionaries, keyed by the API names of town
+                  properties (like those from get_towns_from_csv)
+    """
+    rng = random.Random(seed)
+    departments = get_departments()
+
+    # Districts grow with the square root of the scale, and towns make up
+    # the rest, so both get larger
+    district_factor = math.sqrt(scale)
+    districts = []
+    for department_code, region_code in departments:
+        count = max(1, round(rng.randint(*DISTRICTS_PER_DEPARTMENT) *
+                             district_factor))
+        districts.extend((region_code, department_code, district_code)
+                         for district_code in range(1, count + 1))
+
+    # Some districts have many more towns than others
+    weights = [rng.lognormvariate(0, 0.5) for _ in districts]
+    town_counts = _allocate(round(BASE_TOWN_COUNT * scale), weights)
+
+    for (region_code, department_code, district_code), town_count \
+            in zip(districts, town_counts):
+        for town_code in range(1, town_count + 1):
+            yield {"region_code": region_code,
+                   "region_name": REGION_NAMES[region_code],
+                   "department_code": department_code,
+                   "district_code": district_code,
+                   "town_code": town_code,
+                   "town_name": _town_name(rng),
+                   "population": _population(rng)}
+
+
+def write_towns_csv(csv_file, towns):
+    """
+        Write towns to a file in the same format as data/towns.csv (where
+        populations have thousands separators).
+
+        :returns: The number of towns written
+    """
+    writer = csv.DictWriter(csv_file, fieldnames=CSV_FIELDS)
+    writer.writeheader()
+
+    count = 0
+    for town in towns:
+        writer.writerow(dict(town,
+                             population="{0:,}".format(town["population"])))
+        count += 1
+
+    return count
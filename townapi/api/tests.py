@@ -11,13 +11,85 @@
       is obeyed, unless we have written the field class ourselves. Also,
       there is no need to test basic CRUD operations.
 """
-from django.test import TestCase
+import glob
+import gzip
+import itertools
+import json
+import os
+import tempfile
+import threading
+import tracemalloc
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import NotSupportedError, connection
+from django.http import HttpResponse, JsonResponse
+from django.test import (RequestFactory, TestCase, TransactionTestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
 from rest_framework.test import APIClient
 from rest_framework import status
 
+from .admission import (CHEAP, EXPENSIVE, MODERATE, acquire_slot,
+                        get_cost_class)
+from . import batch, coalescing
+from .coalescing import SingleFlight, get_coalescing_stats
+from .columnar import encode_towns, read_columnar
+from .constants import FR_REGION_CODES
+from .dataset import get_dataset_version
+from .fastfilters import get_compiled_filterset
+from .filters import TownFilter
+from .fragments import clear_fragment_store, get_fragment_store
+from .middleware import RequestCoalescingMiddleware
+from .management.commands import render_snapshot
 from .management.commands._utils import (get_towns_from_csv,
                                          save_town_and_parents_to_db)
-from .models import Department, District, Region, Town
+from .models import Department, District, Region, Town, Vintage
+from .pagination import OneHundredResultsLimitOffsetPagination
+from .ranking import (RANK_FIELDS, RANK_LEVELS, refresh_town_ranks,
+                      top_n_per_group)
+from .serializers import TownSerializer
+from .slowlog import (normalize_sql, read_records, record_statements,
+                      summarize_shapes)
+from .snapshot import make_links_relative, remove_stale_snapshot
+from .synthetic import (MAX_POPULATION, generate_towns, get_departments,
+                        write_towns_csv)
+from .views import PreEncodedRowsViewMixin
+from .warmup import (WARMUP_MAX_RETRY_WAIT, get_warmup_urls,
+                     get_with_retries, has_shared_response_cache,
+                     read_access_log)
+
+
+def add_dummy_towns(count, start=0, population=lambda x: x * 100,
+                    town_name="Town {0}".format, regions=2, departments=2,
+                    districts=3, region_name="Region {0}", vintage=None):
+    """
+        Add count dummy towns (numbered from start) to the DB: town x is in
+        region FR_REGION_CODES[x % regions], department x % departments + 1
+        and district x % districts, and gets its name and population from
+        the town_name and population functions of x.
+
+        region_name is formatted with the region's code, and a vintage can be
+        given to store the populations for (see save_town_and_parents_to_db).
+    """
+    for x in range(start, start + count):
+        region_code, _ = FR_REGION_CODES[x % regions]
+        save_town_and_parents_to_db({
+            "town_code": x,
+            "town_name": town_name(x),
+            "population": population(x),
+            "district_code": x % districts,
+            "department_code": str(x % departments + 1),
+            "region_code": region_code,
+            "region_name": region_name.format(region_code)},
+            vintage)
 
 
 class ModelTestCase(TestCase):
@@ -49,6 +121,27 @@ class ModelTestCase(TestCase):
 
         self.assertEqual(Town.objects.count(), len(towns))
 
+    def test_import_is_atomic(self):
+        """
+            Check that an import which fails part way through is rolled back,
+            along with its dataset version bump.
+        """
+        towns = list(itertools.islice(generate_towns(0.01), 20))
+        towns.append(dict(towns[-1], town_code="999", town_name=""))
+        version = get_dataset_version()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "towns.csv")
+            with open(path, "w", encoding="utf-8", newline="") as csv_file:
+                write_towns_csv(csv_file, towns)
+
+            with self.assertRaises(ValidationError):
+                call_command("import_from_csv", csv=path, snapshot=False,
+                             warm_up=False, stdout=StringIO())
+
+        self.assertEqual(Town.objects.count(), 0)
+        self.assertEqual(get_dataset_version(), version)
+
 
 class TownsViewTestCase(TestCase):
     """ Test suite for the Town api view (available at /towns). """
@@ -78,8 +171,10 @@ class TownsViewTestCase(TestCase):
             # Enumeration is zero-indexed, so add 1 here
             self.assertEqual(Town.objects.count(), i + 1)
 
-            # Retrieve (overriding pagination)
-            response = self.client.get("/towns?limit=100000")
+            # Retrieve the last page (pages larger than API_MAX_PAGE_LIMIT
+            # are rejected)
+            response = self.client.get("/towns?limit=1&offset={0}"
+                                       .format(i))
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(response.json()["results"][-1], town)
             self.assertEqual(response.json()["count"], i + 1)
@@ -154,3 +249,1955 @@ class AggsViewTestCase(TestCase):
         self.assertEqual(len(response.json()), 100)
         self.assertEqual(response.json()[0]["town_count"], 1)
         self.assertEqual(response.json()[0]["max_population"], 0)
+
+
+class RollupViewTestCase(TestCase):
+    """ Test suite for the rollup api view (available at /aggs/rollup). """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add some dummy towns spread over three
+            regions, six departments and four districts per department.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        self.client = APIClient()
+
+        for x in range(120):
+            department = x % 6
+            region_code, region_name = FR_REGION_CODES[department % 3]
+            save_town_and_parents_to_db({
+                "town_code": x,
+                "town_name": "Town {0}".format(x),
+                "population": x * 7 % 50,
+                "district_code": x % 4,
+                "department_code": str(department + 1),
+                "region_code": region_code,
+                "region_name": "Region {0}".format(region_name)})
+
+    @staticmethod
+    def strip_children(nodes, children_name):
+        """ Drop the children from a list of rollup nodes """
+        return [{key: value for key, value in node.items()
+                 if key != children_name}
+                for node in nodes]
+
+    def test_rollup_matches_flat_aggregations(self):
+        """
+            Check that every level of the tree matches the corresponding flat
+            aggs endpoint.
+        """
+        response = self.client.get("/aggs/rollup")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        regions = response.json()
+
+        flat_regions = [region for region
+                        in self.client.get("/aggs/regions").json()
+                        if region["town_count"]]
+        self.assertEqual(self.strip_children(regions, "departments"),
+                         sorted(flat_regions, key=lambda r: r["code"]))
+
+        departments = [department for region in regions
+                       for department in region["departments"]]
+        flat_departments = {department["code"]: department for department
+                            in self.client.get("/aggs/departments").json()}
+        self.assertEqual(len(departments), len(flat_departments))
+
+        for department in departments:
+            flat = flat_departments[department["code"]]
+            # Districts are the deepest level, so they have no children
+            # (such as "towns"), only the aggregates
+            for district in department["districts"]:
+                self.assertEqual(set(district),
+                                 {"code", "min_population", "max_population",
+                                  "avg_population", "town_count"})
+            del flat["region_code"]
+            self.assertEqual(
+                self.strip_children([department], "districts")[0], flat)
+
+        districts = [(department["code"], district)
+                     for department in departments
+                     for district in department["districts"]]
+        flat_districts = {
+            (district.pop("department_code"), district["code"]): district
+            for district in self.client.get("/aggs/districts").json()}
+        self.assertEqual(len(districts), len(flat_districts))
+
+        for department_code, district in districts:
+            flat = flat_districts[(department_code, district["code"])]
+            del flat["region_code"]
+            self.assertEqual(district, flat)
+
+    def test_rollup_depth_and_filters(self):
+        """
+            Check that the depth can be limited, that parent-code filters are
+            applied and that an invalid depth is rejected.
+        """
+        response = self.client.get("/aggs/rollup?depth=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 3)
+        for region in response.json():
+            self.assertNotIn("departments", region)
+            self.assertEqual(region["town_count"], 40)
+
+        region_code, region_display = FR_REGION_CODES[0]
+        response = self.client.get(
+            "/aggs/rollup?depth=2&region_code={0}".format(region_code))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([region["code"] for region in response.json()],
+                         [region_display])
+        departments = response.json()[0]["departments"]
+        self.assertEqual([department["code"] for department in departments],
+                         ["1", "4"])
+        for department in departments:
+            self.assertNotIn("districts", department)
+
+        response = self.client.get("/aggs/rollup?depth=4")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SparseFieldsTestCase(TestCase):
+    """ Test suite for the `fields` parameter on /towns and /aggs/*. """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add a few dummy towns.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        self.client = APIClient()
+        add_dummy_towns(10)
+
+    def get_with_sql(self, url):
+        """ Fetch a URL, returning the response and the SQL that was run """
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, " ".join(query["sql"] for query in queries)
+
+    def test_towns_fields(self):
+        """
+            Check that only the requested fields are returned, that the
+            values match the full records and that unneeded joins are dropped.
+        """
+        full = self.client.get("/towns?ordering=population").json()["results"]
+
+        response, sql = self.get_with_sql(
+            "/towns?fields=town_code,town_name,population&ordering=population")
+        results = response.json()["results"]
+        self.assertEqual(results,
+                         [{"town_code": town["town_code"],
+                           "town_name": town["town_name"],
+                           "population": town["population"]}
+                          for town in full])
+        self.assertNotIn('"api_district"', sql)
+        self.assertNotIn('"api_region"', sql)
+
+        # The department code is stored on the district, so the department
+        # and region do not need to be joined
+        response, sql = self.get_with_sql(
+            "/towns?fields=town_code,department_code&ordering=population")
+        self.assertEqual(response.json()["results"],
+                         [{"town_code": town["town_code"],
+                           "department_code": town["department_code"]}
+                          for town in full])
+        self.assertNotIn('"api_department"', sql)
+        self.assertNotIn('"api_region"', sql)
+
+        # Filters still work when the filtered field is not returned
+        response, sql = self.get_with_sql(
+            "/towns?fields=town_code&ordering=population&region_code={0}"
+            .format(FR_REGION_CODES[1][0]))
+        self.assertEqual(response.json()["results"],
+                         [{"town_code": town["town_code"]} for town in full
+                          if town["region_code"] == FR_REGION_CODES[1][1]])
+
+        response = self.client.get("/towns?fields=town_code,bogus")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_aggs_fields(self):
+        """ Check that the fields can also be limited on the aggs views """
+        full = self.client.get("/aggs/districts").json()
+
+        response, sql = self.get_with_sql(
+            "/aggs/districts?fields=code,department_code,town_count")
+        self.assertEqual(response.json(),
+                         [{"code": district["code"],
+                           "department_code": district["department_code"],
+                           "town_count": district["town_count"]}
+                          for district in full])
+        self.assertNotIn('"api_region"', sql)
+
+
+class CompressionTestCase(TestCase):
+    """
+        Test suite for the compressed response cache (see
+        CompressedResponseCacheMiddleware).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add enough dummy towns to make /towns worth
+            compressing.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        add_dummy_towns(50)
+
+    def test_compression(self):
+        """
+            Check that large responses are compressed when the client accepts
+            gzip, and that small responses are left alone.
+        """
+        plain = self.client.get("/towns")
+        self.assertEqual(plain.status_code, status.HTTP_200_OK)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+
+        compressed = self.client.get("/towns",
+                                     HTTP_ACCEPT_ENCODING="deflate, gzip")
+        self.assertEqual(compressed.status_code, status.HTTP_200_OK)
+        self.assertEqual(compressed["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", compressed["Vary"])
+        self.assertLess(len(compressed.content), len(plain.content))
+        self.assertEqual(gzip.decompress(compressed.content), plain.content)
+
+        refused = self.client.get("/towns",
+                                  HTTP_ACCEPT_ENCODING="gzip;q=0, deflate")
+        self.assertFalse(refused.has_header("Content-Encoding"))
+
+        small = self.client.get("/aggs/regions", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(small.status_code, status.HTTP_200_OK)
+        self.assertFalse(small.has_header("Content-Encoding"))
+
+    def test_cached_per_dataset_version(self):
+        """
+            Check that repeated requests are served from the cache (with only
+            the dataset version being read), and that changing the data
+            invalidates them.
+        """
+        first = self.client.get("/towns", HTTP_ACCEPT_ENCODING="gzip")
+
+        with self.assertNumQueries(1):
+            second = self.client.get("/towns", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(second.content, first.content)
+
+        # The uncompressed variant was stored when the page was rendered
+        with self.assertNumQueries(1):
+            self.client.get("/towns")
+
+        add_dummy_towns(1, start=50)
+        response = self.client.get("/towns", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(
+            json.loads(gzip.decompress(response.content).decode())["count"],
+            51)
+
+
+class SnapshotTestCase(TestCase):
+    """ Test suite for the static snapshot (see render_snapshot.py). """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add some dummy towns in two regions.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        self.client = APIClient(HTTP_HOST="localhost")
+        add_dummy_towns(150)
+
+    def test_render_snapshot(self):
+        """
+            Check that the snapshot contains the same responses as the api
+            (with relative links), with compressed variants, and that
+            re-rendering replaces it.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, "snapshot")
+            call_command("render_snapshot",
+                         output=root,
+                         host="localhost",
+                         towns_pages=2,
+                         stdout=StringIO())
+            self.assertTrue(os.path.islink(root))
+
+            region_code = FR_REGION_CODES[1][0]
+            for url, path in (
+                    ("/aggs/regions", "aggs/regions/index.json"),
+                    ("/aggs/departments?region_code={0}".format(region_code),
+                     "aggs/departments/region_code={0}.json"
+                     .format(region_code)),
+                    ("/towns", "towns/index.json"),
+                    ("/towns?limit=100&offset=100",
+                     "towns/limit=100&offset=100.json")):
+                expected = json.loads(make_links_relative(
+                    self.client.get(url).content, "http://localhost")
+                    .decode())
+                if url == "/towns":
+                    self.assertTrue(expected["next"].startswith("/towns?"))
+
+                with open(os.path.join(root, path), "rb") as snapshot_file:
+                    self.assertEqual(json.loads(snapshot_file.read().decode()),
+                                     expected)
+                with open(os.path.join(root, path + ".gz"), "rb") \
+                        as snapshot_file:
+                    self.assertEqual(
+                        json.loads(gzip.decompress(snapshot_file.read())
+                                   .decode()),
+                        expected)
+
+            # Only the latest snapshot is kept
+            first = os.readlink(root)
+            Town.objects.filter(code=0).delete()
+            call_command("render_snapshot",
+                         output=root,
+                         towns_pages=1,
+                         stdout=StringIO())
+            self.assertNotEqual(os.readlink(root), first)
+            self.assertEqual(sorted(os.listdir(directory)),
+                             sorted(["snapshot", os.readlink(root)]))
+
+    def test_stale_snapshot(self):
+        """
+            Check that the snapshot is taken down once the data changes, and
+            that a snapshot is discarded if the data changes while it is
+            being rendered.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, "snapshot")
+            call_command("render_snapshot",
+                         output=root,
+                         towns_pages=1,
+                         stdout=StringIO())
+            self.assertFalse(remove_stale_snapshot(get_dataset_version(),
+                                                   root))
+            self.assertTrue(os.path.islink(root))
+
+            Town.objects.filter(code=0).delete()
+            self.assertTrue(remove_stale_snapshot(get_dataset_version(),
+                                                  root))
+            self.assertFalse(os.path.lexists(root))
+
+            write = render_snapshot.Command.write
+
+            def change_data(path, body):
+                Town.objects.filter(code=1).delete()
+                write(path, body)
+
+            with mock.patch.object(render_snapshot.Command, "write",
+                                   side_effect=change_data):
+                with self.assertRaises(CommandError):
+                    call_command("render_snapshot",
+                                 output=root,
+                                 towns_pages=1,
+                                 stdout=StringIO())
+            self.assertFalse(os.path.lexists(root))
+            self.assertFalse(glob.glob(os.path.join(directory, "*.tmp")))
+
+
+class ColumnarTestCase(TestCase):
+    """
+        Test suite for the columnar bulk-download format (available at
+        /towns/columnar).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add some dummy towns in two regions.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        self.client = APIClient()
+        add_dummy_towns(300, population=lambda x: x * 1000,
+                        region_name="Région {0}")
+
+    @staticmethod
+    def to_records(columns):
+        """ Convert decoded columns back into /towns style records """
+        names = list(columns)
+        return [dict(zip(names, values))
+                for values in zip(*(columns[name] for name in names))]
+
+    def test_round_trip(self):
+        """ Check that encoded rows are read back unchanged """
+        rows = [(str(x), "Town {0}".format(x), x * 70000, str(x % 3),
+                 str(x % 7), "84", "Région")
+                for x in range(1000)]
+
+        header, columns = read_columnar(encode_towns(rows, 42))
+        self.assertEqual(header["dataset_version"], 42)
+        self.assertEqual(header["rows"], len(rows))
+        self.assertEqual(list(zip(*columns.values())), rows)
+
+        # Small dictionaries use narrow indices, and all buffers are aligned
+        types = {column["name"]: column.get("index_type")
+                 for column in header["columns"]}
+        self.assertEqual(types["region_name"], "uint8")
+        self.assertEqual(types["town_name"], "uint16")
+        for column in header["columns"]:
+            self.assertEqual(column["offset"] % 8, 0)
+
+        header, columns = read_columnar(encode_towns([], 42))
+        self.assertEqual(header["rows"], 0)
+        self.assertEqual(len(columns["population"]), 0)
+
+    def test_endpoint_matches_towns(self):
+        """
+            Check that the columnar download holds the same towns as /towns,
+            including when filtered.
+        """
+        for query in ("", "?region_code={0}&min_population=100000".format(
+                FR_REGION_CODES[1][0])):
+            response = self.client.get("/towns/columnar" + query)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response["Content-Type"],
+                             "application/vnd.townapi.columnar")
+
+            _, columns = read_columnar(response.content)
+            expected = self.client.get(
+                "/towns" + (query + "&" if query else "?") +
+                "limit=1000").json()["results"]
+            self.assertEqual(
+                sorted(self.to_records(columns),
+                       key=lambda town: int(town["town_code"])),
+                sorted(expected, key=lambda town: int(town["town_code"])))
+
+
+class TopTownsTestCase(TestCase):
+    """ Test suite for the top N towns view (available at /towns/top). """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add some dummy towns with tied populations.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        self.client = APIClient()
+        add_dummy_towns(90, departments=6, population=lambda x: x * 37 % 20,
+                        town_name=lambda x: "Town {0:0>2}".format(89 - x))
+
+        self.towns = self.client.get("/towns?limit=1000").json()["results"]
+
+    def expected(self, group_fields, n, key, reverse, towns=None):
+        """ Work out the expected groups from the full list of towns """
+        groups = {}
+        for town in towns or self.towns:
+            groups.setdefault(tuple(town[field] for field in group_fields),
+                              []).append(town)
+
+        for members in groups.values():
+            members.sort(key=lambda town: int(town["town_code"]))
+            members.sort(key=lambda town: town[key], reverse=reverse)
+
+        return {group: members[:n] for group, members in groups.items()}
+
+    def get_groups(self, url, group_fields):
+        """ Fetch the top towns, keyed by their group """
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {tuple(group[field] for field in group_fields): group["towns"]
+                for group in response.json()}
+
+    def test_top_towns(self):
+        """ Check the top towns for each group level and sort order """
+        fields = ("region_code", "department_code")
+        self.assertEqual(self.get_groups("/towns/top?n=3", fields),
+                         self.expected(fields, 3, "population", True))
+
+        fields = ("region_code", "department_code", "district_code")
+        self.assertEqual(
+            self.get_groups("/towns/top?group=district&n=2&ordering=name",
+                            fields),
+            self.expected(fields, 2, "town_name", False))
+
+        fields = ("region_code", "region_name")
+        self.assertEqual(
+            self.get_groups("/towns/top?group=region&n=50"
+                            "&ordering=-population&max_population=10",
+                            fields),
+            self.expected(fields, 50, "population", True,
+                          [town for town in self.towns
+                           if town["population"] <= 10]))
+
+    def test_invalid_parameters(self):
+        """ Check that invalid parameters are rejected """
+        for query in ("group=town", "n=0", "n=ten", "ordering=code"):
+            response = self.client.get("/towns/top?" + query)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertIn(query.split("=")[0], response.json())
+
+
+class AdmissionControlTestCase(TestCase):
+    """
+        Test suite for admission control (see admission.py and
+        AdmissionControlMiddleware).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add a dummy town.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        self.lock_dir = tempfile.TemporaryDirectory()
+
+        save_town_and_parents_to_db({"town_code": 1,
+                                     "town_name": "Town 1",
+                                     "population": 100,
+                                     "district_code": 1,
+                                     "department_code": "1",
+                                     "region_code": FR_REGION_CODES[0][0],
+                                     "region_name": "Region 1"})
+
+    def tearDown(self):
+        self.lock_dir.cleanup()
+
+    def test_cost_classes(self):
+        """ Check that requests are classified by endpoint and query """
+        factory = RequestFactory()
+
+        for url, cost_class in (("/towns", CHEAP),
+                                ("/towns?limit=10&department_code=1", CHEAP),
+                                ("/towns?ordering=-population", MODERATE),
+                                ("/towns?offset=20000", EXPENSIVE),
+                                ("/towns?limit=36000", EXPENSIVE),
+                                ("/towns/top", EXPENSIVE),
+                                ("/aggs/towns", EXPENSIVE),
+                                ("/aggs/regions", EXPENSIVE),
+                                ("/aggs/towns?department_code=1", MODERATE),
+                                ("/batch", CHEAP),
+                                ("/admin/", CHEAP)):
+            self.assertEqual(get_cost_class(factory.get(url)), cost_class,
+                             url)
+
+    def test_columnar_cache_hits(self):
+        """
+            Check that columnar files are only expensive until they are built
+            (for each set of filters).
+        """
+        factory = RequestFactory()
+        url = "/towns/columnar?department_code=1"
+        self.assertEqual(get_cost_class(factory.get(url)), EXPENSIVE)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(get_cost_class(factory.get(url)), CHEAP)
+        self.assertEqual(
+            get_cost_class(factory.get("/towns/columnar?department_code=2")),
+            EXPENSIVE)
+
+    def test_load_shedding(self):
+        """
+            Check that requests beyond a class's limit are rejected straight
+            away, while cheaper requests are still served.
+        """
+        with override_settings(API_ADMISSION_LIMITS={EXPENSIVE: 1},
+                               API_ADMISSION_LOCK_DIR=self.lock_dir.name):
+            slot = acquire_slot(EXPENSIVE)
+            self.assertIsNotNone(slot)
+            self.assertIsNone(acquire_slot(EXPENSIVE))
+
+            response = self.client.get("/aggs/regions")
+            self.assertEqual(response.status_code,
+                             status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertTrue(response.has_header("Retry-After"))
+
+            response = self.client.get("/towns?department_code=1")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            slot.release()
+            response = self.client.get("/aggs/regions")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class CoalescingTestCase(TestCase):
+    """
+        Check that concurrent identical requests are computed once and share
+        the result.
+    """
+
+    @staticmethod
+    def notify_waiters(waiters, count):
+        """
+            Make flights set an event once count followers are waiting for
+            them (rather than polling the flights).
+        """
+        lock = threading.Lock()
+        waiting = []
+
+        class Done(threading.Event):
+            def wait(self, timeout=None):
+                with lock:
+                    waiting.append(1)
+                    if len(waiting) >= count:
+                        waiters.set()
+                return super().wait(timeout)
+
+        class Flight(coalescing._Flight):
+            def __init__(self):
+                super().__init__()
+                self.done = Done()
+
+        return mock.patch.object(coalescing, "_Flight", Flight)
+
+    def test_single_flight(self):
+        """
+            Check that threads which ask for a key while it is being computed
+            wait for the leader and share its result.
+        """
+        flight = SingleFlight(timeout=10)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def compute():
+            calls.append(1)
+            started.set()
+            release.wait(10)
+            return "result"
+
+        def request():
+            results.append(flight.do("key", compute))
+
+        before = get_coalescing_stats()
+        waiters = threading.Event()
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        with self.notify_waiters(waiters, 4):
+            threads[0].start()
+            started.wait(10)
+            for thread in threads[1:]:
+                thread.start()
+
+            # Wait for the followers to join the flight before releasing it
+            waiters.wait(10)
+            release.set()
+            for thread in threads:
+                thread.join(10)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results),
+                         [("result", False)] + [("result", True)] * 4)
+        self.assertEqual(get_coalescing_stats()["coalesced"],
+                         before["coalesced"] + 4)
+
+        # Later calls compute the result again
+        release.set()
+        flight.do("key", compute)
+        self.assertEqual(len(calls), 2)
+
+    def test_shared_between_workers(self):
+        """
+            Check that a worker picks up the result another worker has just
+            computed, if a shared cache is used.
+        """
+        cache.clear()
+        first = SingleFlight(timeout=10, cache=cache)
+        second = SingleFlight(timeout=10, cache=cache)
+
+        self.assertEqual(first.do("key", lambda: "result"),
+                         ("result", False))
+        self.assertEqual(second.do("key", lambda: "other"),
+                         ("result", True))
+
+        # Results which cannot be shared are not published
+        self.assertEqual(first.do("unshared", lambda: None), (None, False))
+        self.assertEqual(second.do("unshared", lambda: "other"),
+                         ("other", False))
+
+    def test_request_key(self):
+        """
+            Check that requests are identified by their normalised path and
+            query.
+        """
+        factory = RequestFactory()
+        get_key = RequestCoalescingMiddleware.get_key
+
+        self.assertEqual(
+            get_key(factory.get("/towns?ordering=name&limit=10")),
+            get_key(factory.get("/towns?limit=10&ordering=name")))
+        self.assertNotEqual(
+            get_key(factory.get("/towns?ordering=name")),
+            get_key(factory.get("/towns?ordering=-name")))
+        self.assertNotEqual(
+            get_key(factory.get("/towns")),
+            get_key(factory.get("/towns", HTTP_ACCEPT="text/html")))
+
+    def test_middleware(self):
+        """
+            Check that a request which arrives while an identical one is
+            running gets the leader's response, marked with X-Coalesced.
+        """
+        started = threading.Event()
+        joined = threading.Event()
+        calls = []
+
+        def get_response(request):
+            calls.append(request)
+            started.set()
+            joined.wait(10)
+            return JsonResponse({"count": len(calls)})
+
+        middleware = RequestCoalescingMiddleware(get_response)
+        factory = RequestFactory()
+        responses = {}
+
+        def run(name):
+            responses[name] = middleware(factory.get("/aggs/regions"))
+
+        with self.notify_waiters(joined, 1):
+            leader = threading.Thread(target=run, args=("leader", ))
+            follower = threading.Thread(target=run, args=("follower", ))
+            leader.start()
+            started.wait(10)
+            follower.start()
+            leader.join(10)
+            follower.join(10)
+
+        self.assertEqual(len(calls), 1)
+        self.assertNotIn("X-Coalesced", responses["leader"])
+        self.assertEqual(responses["follower"]["X-Coalesced"], "1")
+        self.assertEqual(responses["follower"].content,
+                         responses["leader"].content)
+
+    def test_private_requests(self):
+        """
+            Check that the admin, /status and requests with credentials are
+            never coalesced, and that private responses are never shared.
+        """
+        factory = RequestFactory()
+        middleware = RequestCoalescingMiddleware(
+            lambda request: JsonResponse({}))
+
+        for request in (factory.get("/admin/"),
+                        factory.get("/admin/api/town/"),
+                        factory.get("/status"),
+                        factory.post("/batch"),
+                        factory.get("/towns", HTTP_COOKIE="sessionid=abc"),
+                        factory.get("/towns", HTTP_AUTHORIZATION="Token a")):
+            with mock.patch.object(middleware.flight, "do") as do:
+                middleware(request)
+            do.assert_not_called()
+
+        for url in ("/towns", "/towns/top", "/aggs/towns", "/changes/regions",
+                    "/regions/84/departments/1"):
+            self.assertTrue(middleware.should_coalesce(factory.get(url)),
+                            url)
+
+        private = JsonResponse({})
+        private["Cache-Control"] = "max-age=0, private"
+        varies = JsonResponse({})
+        varies["Vary"] = "Accept, Cookie"
+        for response in (private, varies):
+            self.assertIsNone(RequestCoalescingMiddleware.freeze(response))
+        self.assertIsNotNone(
+            RequestCoalescingMiddleware.freeze(JsonResponse({})))
+
+    def test_status(self):
+        """ Check that the coalescing counters are reported """
+        client = APIClient()
+        response = client.get("/status")
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["pid"], os.getpid())
+        self.assertEqual(set(response.data["coalescing"]),
+                         {"leaders", "coalesced", "shared", "timeouts"})
+        self.assertIn("no-store", response["Cache-Control"])
+
+
+class WarmUpTestCase(TestCase):
+    """ Test suite for warming up the api (see warmup.py). """
+
+    ACCESS_LOG = (
+        '10.0.0.1 - - [19/Oct/2026:10:00:00 +0000] "GET /aggs/towns HTTP/1.1" '
+        '200 1024 "-" "curl/7.55"\n'
+        '10.0.0.1 - - [19/Oct/2026:10:00:01 +0000] "GET /aggs/towns HTTP/1.1" '
+        '200 1024 "-" "curl/7.55"\n'
+        '10.0.0.2 - - [19/Oct/2026:10:00:02 +0000] "GET /towns?limit=10 '
+        'HTTP/1.1" 200 512 "-" "curl/7.55"\n'
+        '10.0.0.2 - - [19/Oct/2026:10:00:03 +0000] "GET /towns?limit=10 '
+        'HTTP/1.1" 200 512 "-" "curl/7.55"\n'
+        '10.0.0.2 - - [19/Oct/2026:10:00:03 +0000] "GET /towns?limit=10 '
+        'HTTP/1.1" 200 512 "-" "curl/7.55"\n'
+        '10.0.0.3 - - [19/Oct/2026:10:00:04 +0000] "GET /aggs/regions '
+        'HTTP/1.1" 200 256 "-" "curl/7.55"\n'
+        '10.0.0.3 - - [19/Oct/2026:10:00:05 +0000] "GET /towns?limit=-1 '
+        'HTTP/1.1" 400 64 "-" "curl/7.55"\n'
+        '10.0.0.3 - - [19/Oct/2026:10:00:06 +0000] "POST /towns HTTP/1.1" '
+        '405 64 "-" "curl/7.55"\n'
+        '10.0.0.3 - - [19/Oct/2026:10:00:07 +0000] "GET /admin/ HTTP/1.1" '
+        '200 2048 "-" "curl/7.55"\n')
+
+    def setUp(self):
+        """
+            Check that we are working with a clean database, add a dummy town
+            and write an access log.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+
+        save_town_and_parents_to_db({"town_code": 1,
+                                     "town_name": "Town 1",
+                                     "population": 100,
+                                     "district_code": 1,
+                                     "department_code": "1",
+                                     "region_code": FR_REGION_CODES[0][0],
+                                     "region_name": "Region 1"})
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.access_log = os.path.join(self.directory.name, "access.log")
+        with open(self.access_log, "w") as access_log:
+            access_log.write(self.ACCESS_LOG)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_access_log(self):
+        """
+            Check that only successful GET requests to the api endpoints are
+            counted.
+        """
+        self.assertEqual(dict(read_access_log(self.access_log)),
+                         {"/towns?limit=10": 3,
+                          "/aggs/towns": 2,
+                          "/aggs/regions": 1})
+
+    def test_warmup_urls(self):
+        """
+            Check that configured URLs come first, followed by the most
+            frequently logged ones, without duplicates.
+        """
+        urls, _ = get_warmup_urls(urls=["/aggs/towns"],
+                                  access_log=self.access_log,
+                                  max_urls=2)
+        self.assertEqual(urls, ["/aggs/towns", "/towns?limit=10"])
+
+    def test_retries(self):
+        """
+            Check that rejected requests are retried after a capped wait,
+            with a heartbeat before each wait.
+        """
+        busy = HttpResponse(status=503)
+        busy["Retry-After"] = "60"
+        client = mock.Mock()
+        client.get.side_effect = [busy, busy, HttpResponse()]
+        heartbeat = mock.Mock()
+
+        with mock.patch("api.warmup.time.sleep") as sleep:
+            response = get_with_retries(client, "/aggs/towns", heartbeat)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(heartbeat.call_count, 2)
+        sleep.assert_called_with(WARMUP_MAX_RETRY_WAIT)
+        self.assertEqual(sleep.call_count, 2)
+
+    def test_shared_response_cache(self):
+        """
+            Check that only caches shared between processes are worth warming
+            up from another process (such as an import).
+        """
+        self.assertFalse(has_shared_response_cache())
+
+        with override_settings(CACHES={"default": {
+                "BACKEND": "django.core.cache.backends.filebased."
+                           "FileBasedCache",
+                "LOCATION": self.directory.name}}):
+            self.assertTrue(has_shared_response_cache())
+
+    def test_warm_cache(self):
+        """
+            Check that the command fills the response cache and reports what
+            it covered.
+        """
+        output = StringIO()
+        call_command("warm_cache",
+                     urls=["/aggs/regions"],
+                     access_log=self.access_log,
+                     host="localhost",
+                     stdout=output)
+
+        self.assertIn("Warmed up 3 URLs", output.getvalue())
+        self.assertIn("(0 failed)", output.getvalue())
+        self.assertIn("covering 100.0% of logged requests",
+                      output.getvalue())
+
+        # The warmed responses are now served from the cache
+        client = APIClient(HTTP_HOST="localhost")
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get("/aggs/towns",
+                                  HTTP_ACCEPT="application/json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [query for query in queries.captured_queries
+             if "api_datasetversion" not in query["sql"]], [])
+
+
+class SyntheticDataTestCase(TestCase):
+    """ Test suite for the synthetic data generator (see synthetic.py). """
+
+    def test_generated_csv_is_valid(self):
+        """
+            Check that a generated CSV can be read back and imported (which
+            validates every place), and that its hierarchy is consistent.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "towns.csv")
+            with open(path, "w", encoding="utf-8", newline="") as csv_file:
+                count = write_towns_csv(csv_file, generate_towns(0.01))
+            towns = get_towns_from_csv(path)
+
+        self.assertEqual(count, 359)
+        self.assertEqual(len(towns), count)
+
+        for town in towns:
+            save_town_and_parents_to_db(town)
+        self.assertEqual(Town.objects.count(), count)
+
+        region_codes = {code for code, _ in FR_REGION_CODES}
+        for region in Region.objects.all():
+            self.assertIn(region.code, region_codes)
+        for department in Department.objects.all():
+            self.assertRegex(department.code, r"^\d{1,3}[ABM]?$")
+
+        # Each department belongs to one region, and each region has one name
+        departments = {}
+        region_names = {}
+        for town in towns:
+            self.assertEqual(departments.setdefault(town["department_code"],
+                                                    town["region_code"]),
+                             town["region_code"])
+            self.assertEqual(region_names.setdefault(town["region_code"],
+                                                     town["region_name"]),
+                             town["region_name"])
+
+    def test_departments(self):
+        """ Check that departments belong to their real regions """
+        departments = dict(get_departments())
+        self.assertEqual(len(departments), 101)
+        for department_code, region_code in (("2A", 94), ("2B", 94),
+                                             ("75", 11), ("2", 32),
+                                             ("13", 93), ("976", 5)):
+            self.assertEqual(departments[department_code], region_code)
+
+    def test_generation_is_skewed_and_deterministic(self):
+        """
+            Check that populations are heavily skewed, and that the same seed
+            gives the same data.
+        """
+        towns = list(generate_towns(0.1, seed=1))
+        populations = sorted(town["population"] for town in towns)
+        median = populations[len(populations) // 2]
+
+        self.assertLess(median, sum(populations) / len(populations))
+        self.assertGreater(populations[-1], 100 * median)
+        self.assertLessEqual(populations[-1], MAX_POPULATION)
+
+        self.assertEqual(list(itertools.islice(generate_towns(0.1, seed=1),
+                                               100)),
+                         towns[:100])
+        self.assertNotEqual(list(itertools.islice(generate_towns(0.1, seed=2),
+                                                  100)),
+                            towns[:100])
+
+
+def measure_peak_memory(function):
+    """
+        Run a function while tracing memory allocations.
+
+        :returns: The peak memory allocated (in bytes) while it ran
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+class NullOutput:
+    """
+        Discard the output of a command, so that it does not add to the
+        memory being measured.
+    """
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+class MemoryBudgetTestCase(TestCase):
+    """
+        Check that the importer and the largest responses stay within their
+        memory budgets, so that regressions (such as loading whole result sets
+        or files into memory) fail the build rather than getting workers
+        killed.
+
+        Budgets are the peak memory allocated (as traced by tracemalloc) for
+        TOWN_COUNT towns, with plenty of headroom over the measured values.
+    """
+    TOWN_COUNT = 2000
+    BUDGETS = {
+        "/towns?limit=2000": 12 * 1024 * 1024,
+        "/aggs/towns": 8 * 1024 * 1024,
+        "/aggs/districts": 256 * 1024,
+        "import": 1024 * 1024,
+    }
+    # How much more memory importing a file eight times as large may take.
+    # Django leaves some garbage for the cyclic collector, so the peaks vary
+    # by a few hundred KiB, but keeping every town of the larger file would
+    # take over 1.5 MiB more.
+    IMPORT_GROWTH = 512 * 1024
+
+    def setUp(self):
+        """
+            Check that we are working with a clean database and add the dummy
+            towns (in bulk, as this is not what is being measured).
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient(HTTP_HOST="localhost")
+
+    def create_towns(self, count=None):
+        """ Add count (or TOWN_COUNT) dummy towns, in several districts """
+        region = Region.objects.create(code=FR_REGION_CODES[0][0],
+                                       name="Region 1")
+        department = Department.objects.create(code="1", region=region)
+        districts = [District.objects.create(code=code,
+                                             department=department)
+                     for code in range(10)]
+
+        Town.objects.bulk_create(
+            Town(code=x,
+                 district=districts[x % len(districts)],
+                 name="Town {0}".format(x),
+                 population=x)
+            for x in range(count or self.TOWN_COUNT))
+
+    def test_response_memory(self):
+        """ Check the largest responses against their budgets """
+        self.create_towns()
+
+        for url in ("/towns?limit=2000", "/aggs/towns", "/aggs/districts"):
+            cache.clear()
+            responses = []
+            peak = measure_peak_memory(
+                lambda: responses.append(self.client.get(url)))
+
+            self.assertEqual(responses[0].status_code, status.HTTP_200_OK)
+            self.assertLess(peak, self.BUDGETS[url], url)
+
+    def test_large_pages_stream(self):
+        """
+            Check that, with the default settings, a full /aggs/towns (which
+            has about 36k rows in production) and the largest /towns pages
+            are streamed rather than rendered into memory.
+        """
+        self.assertLessEqual(settings.API_JSON_STREAM_ROWS,
+                             settings.API_MAX_PAGE_LIMIT)
+        self.create_towns(settings.API_JSON_STREAM_ROWS)
+
+        for url in ("/aggs/towns",
+                    "/towns?limit={0}".format(settings.API_MAX_PAGE_LIMIT)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming, url)
+            rows = json.loads(b"".join(response.streaming_content)
+                              .decode("utf-8"))
+            if url.startswith("/towns"):
+                rows = rows["results"]
+            self.assertEqual(len(rows), settings.API_JSON_STREAM_ROWS)
+
+        response = self.client.get("/towns?limit=100")
+        self.assertFalse(response.streaming)
+
+    def test_import_memory(self):
+        """
+            Check that the importer's memory use is within budget, and does
+            not grow with the size of the file (i.e. towns are streamed).
+
+            A first import (of the larger file) is not measured, so that
+            anything allocated once per process, whichever tests ran before,
+            is not counted.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            peaks = []
+            for scale in (0.08, 0.01, 0.08):
+                path = os.path.join(directory, "towns.csv")
+                with open(path, "w", encoding="utf-8", newline="") \
+                        as csv_file:
+                    write_towns_csv(csv_file, generate_towns(scale))
+
+                Town.objects.all().delete()
+                peaks.append(measure_peak_memory(
+                    lambda: call_command("import_from_csv",
+                                         csv=path,
+                                         snapshot=False,
+                                         warm_up=False,
+                                         stdout=NullOutput())))
+
+        small, large = peaks[1:]
+        self.assertLess(large, self.BUDGETS["import"])
+        self.assertLess(large, small + self.IMPORT_GROWTH)
+
+    def test_page_limit(self):
+        """
+            Check that pages larger than API_MAX_PAGE_LIMIT are rejected with
+            a clear error, rather than truncated.
+        """
+        with override_settings(API_MAX_PAGE_LIMIT=50):
+            response = self.client.get("/towns?limit=51")
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST)
+            self.assertIn("at most 50", response.json()["limit"][0])
+
+            response = self.client.get("/towns?limit=50")
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class PlaceDetailTestCase(TestCase):
+    """
+        Test suite for the place detail endpoints (/regions/<CODE>/...), which
+        are served from an in-memory index (see hierarchy.py).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, check that we are working with
+            a clean database and add some dummy towns in two regions.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        add_dummy_towns(60)
+
+    def test_matches_aggs(self):
+        """
+            Check that each level gives the same aggregates as the matching
+            /aggs endpoint, along with its parents' and children's codes.
+        """
+        region_code, region_display = FR_REGION_CODES[1]
+
+        expected = self.client.get(
+            "/aggs/regions?fields=code,min_population,max_population,"
+            "avg_population,town_count,name").json()
+        expected = [region for region in expected
+                    if region["code"] == region_display][0]
+        response = self.client.get("/regions/{0}".format(region_code))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(), dict(expected,
+                                               departments=["2"]))
+
+        expected = self.client.get("/aggs/districts?department_code=2") \
+                              .json()
+        expected = [district for district in expected
+                    if district["code"] == 1][0]
+        response = self.client.get(
+            "/regions/{0}/departments/2/districts/1".format(region_code))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(),
+                         dict(expected, towns=[1, 7, 13, 19, 25, 31, 37, 43,
+                                               49, 55]))
+
+        response = self.client.get(
+            "/regions/{0}/departments/2/districts/1/towns/7"
+            .format(region_code))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(),
+                         {"code": 7,
+                          "name": "Town 7",
+                          "min_population": 700,
+                          "max_population": 700,
+                          "avg_population": 700,
+                          "town_count": 1,
+                          "region_code": region_display,
+                          "department_code": "2",
+                          "district_code": 1})
+
+    def test_not_found(self):
+        """ Check that paths which do not lead to a place give a 404 """
+        region_code = FR_REGION_CODES[0][0]
+
+        for url in ("/regions/99",
+                    "/regions/{0}/departments/2".format(region_code),
+                    "/regions/{0}/departments/1/districts/9"
+                    .format(region_code),
+                    "/regions/{0}/departments/1/districts/0/towns/1"
+                    .format(region_code)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,
+                             status.HTTP_404_NOT_FOUND, url)
+
+    def test_index_rebuilt_on_change(self):
+        """
+            Check that lookups do not query the places once the index is
+            built, and that the index is rebuilt when the dataset changes.
+        """
+        url = "/regions/{0}".format(FR_REGION_CODES[0][0])
+        self.client.get(url)
+
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.json()["town_count"], 30)
+        self.assertEqual(
+            [query for query in queries.captured_queries
+             if "api_datasetversion" not in query["sql"]], [])
+
+        save_town_and_parents_to_db({
+            "town_code": 1000,
+            "town_name": "Town 1000",
+            "population": 1,
+            "district_code": 0,
+            "department_code": "1",
+            "region_code": FR_REGION_CODES[0][0],
+            "region_name": "Region {0}".format(FR_REGION_CODES[0][0])})
+
+        response = self.client.get(url)
+        self.assertEqual(response.json()["town_count"], 31)
+
+
+class VintageTestCase(TestCase):
+    """
+        Test suite for populations from past census extracts (vintages), on
+        /towns, /aggs/* and /changes/*.
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, and add some dummy towns with
+            populations in two vintages. The 2016 vintage is missing the last
+            town, which was only created in 2017.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        self.region_code, self.region_display = FR_REGION_CODES[0]
+
+        for year, count in ((2016, 9), (2017, 10)):
+            add_dummy_towns(
+                count, start=1, regions=1, districts=2, region_name="Region",
+                population=lambda x: x * 100 + (year - 2016) * x,
+                vintage=Vintage.objects.create(year=year))
+
+    def test_importer_updates_current(self):
+        """
+            Check that towns are reused across vintages, with their population
+            from the latest one.
+        """
+        self.assertEqual(Town.objects.count(), 10)
+        self.assertEqual(Town.objects.get(code=3).population, 303)
+
+        save_town_and_parents_to_db(
+            {"town_code": 3,
+             "town_name": "Town 3",
+             "population": 1,
+             "district_code": 1,
+             "department_code": "2",
+             "region_code": self.region_code,
+             "region_name": "Region"},
+            Vintage.objects.create(year=2015),
+            update_current=False)
+        self.assertEqual(Town.objects.count(), 10)
+        self.assertEqual(Town.objects.get(code=3).population, 303)
+
+    def test_towns(self):
+        """
+            Check that /towns sends, filters and orders by the populations
+            from the requested vintage.
+        """
+        response = self.client.get("/towns?vintage=2016&ordering=-population"
+                                   "&min_population=500")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([(town["town_code"], town["population"])
+                          for town in response.json()["results"]],
+                         [("9", 900), ("8", 800), ("7", 700), ("6", 600),
+                          ("5", 500)])
+
+        response = self.client.get("/towns?ordering=-population&limit=1")
+        self.assertEqual(response.json()["results"][0]["population"], 1010)
+
+    def test_aggs(self):
+        """ Check that the aggregates read the requested vintage """
+        for level in ("regions", "departments", "districts", "towns",
+                      "rollup"):
+            response = self.client.get(
+                "/aggs/{0}?vintage=2016".format(level))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(sum(place["town_count"]
+                                 for place in response.json()), 9, level)
+
+        response = self.client.get("/aggs/regions?vintage=2016")
+        self.assertEqual(response.json()[0]["max_population"], 900)
+        response = self.client.get("/aggs/regions?vintage=2017")
+        self.assertEqual(response.json()[0]["max_population"], 1010)
+
+    def test_changes(self):
+        """ Check the population changes between two vintages """
+        response = self.client.get("/changes/regions?from=2016&to=2017")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json(),
+                         [{"code": self.region_display,
+                           "name": "Region",
+                           "town_count": 10,
+                           "start_population": 4500,
+                           "end_population": 5555,
+                           "change": 1055,
+                           "change_percent": 23.44}])
+
+        response = self.client.get(
+            "/changes/towns?from=2016&to=2017&department_code=1")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        changes = response.json()
+        self.assertEqual([change["code"] for change in changes],
+                         [2, 4, 6, 8, 10])
+        self.assertEqual(changes[0]["change"], 2)
+        self.assertEqual(changes[-1]["start_population"], 0)
+        self.assertIsNone(changes[-1]["change_percent"])
+
+    def test_unknown_vintage(self):
+        """ Check that unknown or missing vintages are rejected """
+        for url in ("/towns?vintage=1999",
+                    "/aggs/regions?vintage=abc",
+                    "/changes/regions?from=2016",
+                    "/changes/regions?from=2016&to=1999"):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST, url)
+
+    def test_ranks_rejected(self):
+        """
+            Check that rank filters and ordering (which only hold for the
+            current populations) are rejected along with a vintage.
+        """
+        for url, names in (
+                ("/towns?vintage=2016&max_national_rank=3",
+                 ["max_national_rank"]),
+                ("/towns?vintage=2016&ordering=town_code,-region_percentile",
+                 ["ordering"]),
+                ("/towns?vintage=2016&min_district_percentile=50"
+                 "&ordering=national_rank",
+                 ["min_district_percentile", "ordering"])):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST, url)
+            self.assertEqual(sorted(response.json()), names)
+
+        response = self.client.get("/towns?max_national_rank=3"
+                                   "&ordering=national_rank")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+class FastFilterTestCase(TestCase):
+    """
+        Test suite for the compiled filters (see fastfilters.py), which must
+        give the same responses as django-filter.
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, and add some dummy towns in two
+            regions, with populations in a vintage.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        self.region_code = FR_REGION_CODES[1][0]
+        add_dummy_towns(40, departments=4,
+                        vintage=Vintage.objects.create(year=2016))
+
+    def test_parity(self):
+        """
+            Check that the fast path gives the same responses as django-filter
+            for valid, invalid and unknown parameters.
+        """
+        urls = []
+        for query in ("department_code=2",
+                      " department_code= 2 ",
+                      "region_code={0}".format(self.region_code),
+                      "region_code=99",
+                      "region_code=null",
+                      "region_code=",
+                      "district_code=1&department_code=3",
+                      "min_population=1000&max_population=2500.5",
+                      "min_population=abc",
+                      "min_population=NaN",
+                      "population=1e3",
+                      "population=700&population=800",
+                      "unknown=1"):
+            urls.append("/towns?" + query)
+            urls.append("/towns?vintage=2016&ordering=-population&" + query)
+            urls.append("/aggs/towns?" + query)
+            urls.append("/aggs/districts?" + query)
+            urls.append("/aggs/departments?" + query)
+            urls.append("/changes/districts?from=2016&to=2016&" + query)
+
+        for url in urls:
+            cache.clear()
+            with self.settings(API_FAST_FILTERS=False):
+                expected = self.client.get(url)
+            cache.clear()
+            response = self.client.get(url)
+
+            self.assertEqual(response.status_code, expected.status_code, url)
+            self.assertEqual(response.content, expected.content, url)
+
+    def test_fast_path_skips_filterset(self):
+        """
+            Check that valid values are handled without building a FilterSet,
+            and that invalid ones fall back to django-filter.
+        """
+        self.assertTrue(get_compiled_filterset(TownFilter).supported)
+
+        with mock.patch.object(TownFilter, "__init__",
+                               side_effect=AssertionError) as init:
+            response = self.client.get(
+                "/towns?department_code=2&min_population=500")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["count"], 9)
+        init.assert_not_called()
+
+        with mock.patch.object(TownFilter, "__init__",
+                               autospec=True,
+                               side_effect=TownFilter.__init__) as init:
+            response = self.client.get("/towns?region_code=99")
+        self.assertEqual(response.json()["count"], 0)
+        self.assertTrue(init.called)
+
+
+class SlowRequestTestCase(TestCase):
+    """
+        Test suite for the slow request log (see slowlog.py and
+        SlowRequestMiddleware).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, log to a temporary directory
+            and add some dummy towns.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.log_dir.name, "slow.log")
+
+        for x in range(20):
+            save_town_and_parents_to_db({
+                "town_code": x,
+                "town_name": "Town {0}".format(x),
+                "population": x * 100,
+                "district_code": x % 3,
+                "department_code": str(x % 2 + 1),
+                "region_code": FR_REGION_CODES[0][0],
+                "region_name": "Region"})
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def get(self, url, threshold):
+        with self.settings(API_SLOW_REQUEST_THRESHOLD=threshold,
+                           API_SLOW_REQUEST_LOG=self.log_path):
+            return self.client.get(url)
+
+    def test_slow_request_recorded(self):
+        """
+            Check that slow requests are recorded with their statements,
+            phases and the plan of the slowest statement.
+        """
+        response = self.get("/towns?department_code=2&limit=5", 0)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        records = read_records(self.log_path)
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record["url"], "/towns?department_code=?&limit=?")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["rows"], 5)
+        self.assertEqual(record["statement_count"],
+                         len(record["statements"]))
+        self.assertTrue(any("api_town" in statement["sql"]
+                            for statement in record["statements"]))
+        self.assertEqual(set(record["phases"]),
+                         {"middleware_in", "view", "render",
+                          "middleware_out", "sql"})
+        self.assertIn("api_town", record["slowest"]["sql"])
+        self.assertTrue(record["slowest"]["plan"])
+
+    def test_fast_request_not_recorded(self):
+        """
+            Check that fast requests are not recorded, and that queries are
+            still captured by CaptureQueriesContext while recording.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.get("/aggs/regions", 60)
+        self.assertTrue(queries.captured_queries)
+        self.assertEqual(read_records(self.log_path), [])
+
+    def test_statement_details(self):
+        """
+            Check that every statement is kept, but that parameters are only
+            kept (apart from the slowest statement's) once the detail
+            threshold has passed.
+        """
+        with record_statements(detail_after=60) as statements:
+            Town.objects.count()
+            list(Town.objects.filter(population__gt=500))
+        self.assertEqual(statements.count, 2)
+        self.assertEqual(len(statements.statements), 2)
+        self.assertEqual([statement.params
+                          for statement in statements.statements],
+                         [None, None])
+        self.assertIn("api_town", statements.slowest.sql)
+        self.assertIsNotNone(statements.slowest.params)
+        self.assertGreater(statements.duration, 0)
+
+        with record_statements() as statements:
+            Town.objects.count()
+            list(Town.objects.filter(population__gt=500))
+        self.assertEqual(statements.count, 2)
+        self.assertEqual(statements.statements[1].params, (500, ))
+        self.assertIn(statements.slowest, statements.statements)
+
+    def test_statements_before_detail_threshold(self):
+        """
+            Check that statements run before the detail threshold are still
+            recorded and summarized.
+        """
+        with self.settings(API_SLOW_REQUEST_DETAIL_AFTER=60):
+            self.get("/towns?department_code=2&limit=5", 0)
+
+        records = read_records(self.log_path)
+        self.assertEqual(len(records), 1)
+        statements = records[0]["statements"]
+        self.assertEqual(records[0]["statement_count"], len(statements))
+        self.assertTrue(any("api_town" in statement["sql"]
+                            for statement in statements))
+        self.assertFalse(any("params" in statement
+                             for statement in statements))
+        self.assertTrue(records[0]["slowest"]["params"])
+
+        summaries = summarize_shapes(records)
+        self.assertIn(normalize_sql(records[0]["slowest"]["sql"]),
+                      [summary.shape for summary in summaries])
+
+    def test_summary(self):
+        """ Check that statements are grouped by shape and summarized """
+        self.assertEqual(
+            normalize_sql('SELECT "a" FROM "t" WHERE "b" IN (%s, %s, %s)\n'
+                          "AND \"c\" = 'x' LIMIT 10"),
+            'SELECT "a" FROM "t" WHERE "b" IN (?, ...) AND "c" = ? LIMIT ?')
+
+        for url in ("/towns?department_code=1", "/towns?department_code=2",
+                    "/aggs/regions"):
+            self.get(url, 0)
+
+        summaries = summarize_shapes(read_records(self.log_path))
+        towns = [summary for summary in summaries
+                 if summary.urls["/towns?department_code=?"] == 2]
+        self.assertTrue(towns)
+        self.assertEqual(towns[0].count, 2)
+
+        out = StringIO()
+        call_command("slow_requests", since="1h", log=self.log_path,
+                     stdout=out)
+        self.assertIn("3 slow requests", out.getvalue())
+        self.assertIn("plan:", out.getvalue())
+
+
+class TownRankTestCase(TestCase):
+    """
+        Test suite for the precomputed town ranks and percentiles (see
+        ranking.refresh_town_ranks).
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, and add some dummy towns in two
+            regions (with some tied populations), then refresh the ranks.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        add_dummy_towns(40, departments=4,
+                        population=lambda x: (x % 13) * 100)
+        refresh_town_ranks()
+
+    def test_ranks(self):
+        """ Check the ranks and percentiles against a naive calculation """
+        towns = Town.objects.select_related("district__department")
+        groups = {
+            "district": lambda town: town.district_id,
+            "department": lambda town: town.district.department_id,
+            "region": lambda town: town.district.department.region_id,
+            "national": lambda town: None,
+        }
+
+        for level, _ in RANK_LEVELS:
+            for town in towns:
+                group = [other.population for other in towns
+                         if groups[level](other) == groups[level](town)]
+                self.assertEqual(
+                    getattr(town, level + "_rank"),
+                    1 + sum(population > town.population
+                            for population in group))
+                self.assertEqual(
+                    getattr(town, level + "_percentile"),
+                    round(100 * sum(population <= town.population
+                                    for population in group) / len(group),
+                          2))
+
+    def test_refresh_bumps_version(self):
+        """ Check that refreshing the ranks changes the dataset version """
+        version = get_dataset_version()
+        refresh_town_ranks()
+        self.assertNotEqual(get_dataset_version(), version)
+
+    def test_towns_fields_filter_and_ordering(self):
+        """
+            Check that the ranks are only sent when asked for, and can be
+            filtered and ordered on.
+        """
+        response = self.client.get("/towns?limit=1")
+        self.assertNotIn("department_rank", response.json()["results"][0])
+
+        response = self.client.get(
+            "/towns?fields=town_code,department_rank,national_percentile"
+            "&max_department_rank=2&ordering=department_rank,town_code")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()["results"]
+        self.assertEqual(len(results), 8)
+        self.assertEqual([town["department_rank"] for town in results],
+                         [1, 1, 1, 1, 2, 2, 2, 2])
+        self.assertEqual(set(results[0]),
+                         {"town_code", "department_rank",
+                          "national_percentile"})
+
+        response = self.client.get(
+            "/towns?min_national_percentile=95&ordering=-national_percentile"
+            "&fields=town_code,national_rank")
+        self.assertEqual([town["national_rank"]
+                          for town in response.json()["results"]],
+                         [1, 1, 1])
+
+    def test_sqlite_versions(self):
+        """
+            Check that the ranks are the same when refreshed without
+            UPDATE ... FROM (before SQLite 3.33), and that a clear error is
+            raised without window functions (before SQLite 3.25).
+        """
+        expected = list(Town.objects.order_by("id").values(*RANK_FIELDS))
+        Town.objects.update(**{field: None for field in RANK_FIELDS})
+
+        with mock.patch.object(connection.Database, "sqlite_version_info",
+                               (3, 32, 0)):
+            refresh_town_ranks()
+        self.assertEqual(
+            list(Town.objects.order_by("id").values(*RANK_FIELDS)),
+            expected)
+
+        with mock.patch.object(connection.Database, "sqlite_version_info",
+                               (3, 24, 0)):
+            with self.assertRaisesRegex(NotSupportedError, "SQLite 3.25"):
+                refresh_town_ranks()
+            with self.assertRaisesRegex(NotSupportedError, "SQLite 3.25"):
+                top_n_per_group(Town.objects.all(), "region", 2,
+                                "population")
+
+    def test_rank_filters_use_indexes(self):
+        """ Check that rank filters are answered using an index """
+        for level, _ in RANK_LEVELS:
+            sql, params = Town.objects.filter(
+                **{level + "_rank__lte": 10}).query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+                plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn("INDEX", plan, level)
+
+
+class BatchTestCase(TransactionTestCase):
+    """
+        Test suite for the /batch endpoint (see batch.py). The data is
+        committed (rather than kept in a test transaction), so that the
+        batch's worker threads can see it.
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, and add some dummy towns in two
+            regions.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        self.client = APIClient()
+        self.region_code = FR_REGION_CODES[1][0]
+        add_dummy_towns(30)
+
+    def post(self, queries):
+        return self.client.post("/batch", {"queries": queries},
+                                format="json")
+
+    def test_results_match_endpoints(self):
+        """
+            Check that each result is what the individual endpoint sends, and
+            that identical queries are only run once.
+        """
+        queries = [
+            {"id": "regions", "path": "/aggs/regions"},
+            {"id": "towns", "path": "/towns",
+             "params": {"department_code": "2", "limit": "3",
+                        "ordering": "-population"}},
+            {"id": "same-towns", "path": "/towns",
+             "params": {"ordering": "-population", "limit": 3,
+                        "department_code": "2"}},
+            {"id": "region",
+             "path": "/regions/{0}".format(self.region_code)},
+            {"path": "/changes/regions", "params": {"from": "1999"}},
+        ]
+
+        for workers in (0, 4):
+            with self.settings(API_BATCH_WORKERS=workers), \
+                    mock.patch.object(batch, "run_sub_query",
+                                      wraps=batch.run_sub_query) as run:
+                response = self.post(queries)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(run.call_count, 4)
+
+            results = response.json()["results"]
+            self.assertEqual(list(results),
+                             ["regions", "towns", "same-towns", "region",
+                              "4"])
+            self.assertEqual(response.json()["dataset_version"],
+                             get_dataset_version())
+
+            for query_id, url in (
+                    ("regions", "/aggs/regions"),
+                    ("towns", "/towns?department_code=2&limit=3"
+                              "&ordering=-population"),
+                    ("same-towns", "/towns?department_code=2&limit=3"
+                                   "&ordering=-population"),
+                    ("region", "/regions/{0}".format(self.region_code))):
+                self.assertEqual(results[query_id],
+                                 {"status": 200,
+                                  "data": self.client.get(url).json()},
+                                 query_id)
+
+            self.assertEqual(results["4"]["status"], 400)
+            self.assertIn("from", results["4"]["error"])
+
+    def test_item_errors(self):
+        """ Check that failing queries do not affect the rest of the batch """
+        response = self.post([{"path": "/nowhere"},
+                              {"path": "/status"},
+                              {"path": "/towns", "params": {"limit": "1"}}])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()["results"]
+        self.assertEqual(results["0"]["status"], 404)
+        self.assertEqual(results["1"]["status"], 400)
+        self.assertEqual(results["2"]["status"], 200)
+        self.assertEqual(len(results["2"]["data"]["results"]), 1)
+
+    def test_invalid_batches(self):
+        """ Check that batches in the wrong format are rejected """
+        for body in ({}, {"queries": []}, {"queries": [{}]},
+                     {"queries": [{"path": "/towns", "params": [1]}]},
+                     {"queries": [{"id": "a", "path": "/towns"},
+                                  {"id": "a", "path": "/aggs/regions"}]}):
+            response = self.client.post("/batch", body, format="json")
+            self.assertEqual(response.status_code,
+                             status.HTTP_400_BAD_REQUEST, body)
+
+        with self.settings(API_BATCH_MAX_QUERIES=2):
+            response = self.post([{"path": "/towns"}] * 3)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_admission(self):
+        """
+            Check that each sub-query takes a slot for its own cost class, and
+            that sub-queries refused a slot by the rest of the batch are
+            retried.
+        """
+        queries = [{"id": "regions", "path": "/aggs/regions"},
+                   {"id": "towns", "path": "/aggs/towns"},
+                   {"id": "page", "path": "/towns", "params": {"limit": "5"}}]
+
+        with tempfile.TemporaryDirectory() as lock_dir, \
+                self.settings(API_ADMISSION_LIMITS={EXPENSIVE: 1},
+                              API_ADMISSION_LOCK_DIR=lock_dir):
+            response = self.post(queries)
+            results = response.json()["results"]
+            self.assertEqual([result["status"] for result in results.values()],
+                             [200, 200, 200])
+
+            slot = acquire_slot(EXPENSIVE)
+            try:
+                response = self.post(queries)
+            finally:
+                slot.release()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()["results"]
+        self.assertEqual(results["regions"]["status"], 503)
+        self.assertEqual(results["towns"]["status"], 503)
+        self.assertEqual(results["page"]["status"], 200)
+
+    def test_dataset_changes(self):
+        """
+            Check that a batch is re-run if the dataset changes while it is
+            running, and gives up if it keeps changing.
+        """
+        versions = itertools.count()
+        with self.settings(API_BATCH_RETRIES=1), \
+                mock.patch.object(batch, "get_dataset_version",
+                                  side_effect=lambda: next(versions)):
+            response = self.post([{"path": "/aggs/regions"}])
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(next(versions), 4)
+
+        versions = iter([1, 2, 2, 2])
+        with mock.patch.object(batch, "get_dataset_version",
+                               side_effect=lambda: next(versions)):
+            response = self.post([{"path": "/aggs/regions"}])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["dataset_version"], 2)
+
+
+class PreEncodedJSONTestCase(TestCase):
+    """
+        Test suite for rendering pages from pre-encoded rows (see
+        fragments.py), which must give the same bytes as DRF's JSONRenderer.
+    """
+
+    def setUp(self):
+        """
+            Define the test API Client to use, and add some dummy towns (with
+            names which need escaping) in two regions, with populations in a
+            vintage.
+        """
+        self.assertEqual(Town.objects.count(), 0)
+        cache.clear()
+        clear_fragment_store()
+        self.client = APIClient()
+        add_dummy_towns(40, departments=4,
+                        town_name="Saint-Étienne \u2028\"{0}\"".format,
+                        region_name="Région {0}",
+                        vintage=Vintage.objects.create(year=2016))
+        refresh_town_ranks()
+
+    def get(self, url, **extra):
+        """
+            Get a page, bypassing the response cache.
+
+            :returns: A tuple of (response, body)
+        """
+        cache.clear()
+        response = self.client.get(url, **extra)
+        if response.streaming:
+            return response, b"".join(response.streaming_content)
+        return response, response.content
+
+    def get_with_drf(self, url, **extra):
+        """
+            Get a page rendered by DRF's JSONRenderer, as the views did before
+            rows were pre-encoded.
+
+            :returns: A tuple of (response, body)
+        """
+        with mock.patch.object(PreEncodedRowsViewMixin, "renderer_classes",
+                               api_settings.DEFAULT_RENDERER_CLASSES), \
+                mock.patch.object(JSONRenderer, "render", autospec=True,
+                                  side_effect=JSONRenderer.render) as render:
+            response, body = self.get(url, **extra)
+
+        self.assertTrue(render.called)
+        return response, body
+
+    def test_parity(self):
+        """
+            Check that pages are byte-for-byte the same as the ones rendered
+            by DRF's JSONRenderer, whether their rows were already encoded or
+            not.
+        """
+        urls = ("/towns",
+                "/towns?limit=25&offset=10&ordering=-population",
+                "/towns?fields=town_code,population,national_rank",
+                "/towns?vintage=2016&fields=town_name,population",
+                "/towns?department_code=2",
+                "/towns?department_code=99",
+                "/aggs/regions",
+                "/aggs/departments?vintage=2016",
+                "/aggs/districts?fields=code,town_count",
+                "/aggs/towns",
+                "/aggs/rollup")
+
+        for url in urls:
+            for accept in ("application/json",
+                           "application/json; indent=2"):
+                expected, body = self.get_with_drf(url, HTTP_ACCEPT=accept)
+                self.assertEqual(expected.status_code, status.HTTP_200_OK)
+
+                clear_fragment_store()
+                for _ in ("cold", "warm"):
+                    with mock.patch.object(JSONRenderer, "render") as render:
+                        response, content = self.get(url, HTTP_ACCEPT=accept)
+                    render.assert_not_called()
+                    self.assertEqual(content, body, (url, accept))
+                    self.assertEqual(response["Content-Type"],
+                                     expected["Content-Type"])
+
+        _, content = self.get("/towns")
+        self.assertIn(b"\\u2028", content)
+
+    def test_rows_are_reused(self):
+        """
+            Check that rows are only serialized once per dataset version, and
+            that changes to the data are sent.
+        """
+        self.get("/towns?limit=40")
+        self.assertEqual(len(get_fragment_store()), 40)
+
+        with mock.patch.object(TownSerializer, "to_representation",
+                               side_effect=AssertionError):
+            response, _ = self.get("/towns?limit=10&ordering=-population")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()["results"][0]["population"], 3900)
+
+        town = Town.objects.get(code=39)
+        town.population = 50
+        town.save()
+
+        response, _ = self.get("/towns?limit=10&ordering=population")
+        self.assertEqual(response.json()["results"][1],
+                         dict(response.json()["results"][1],
+                              town_code="39", population=50))
+        self.assertEqual(len(get_fragment_store()), 10)
+
+        with self.settings(API_JSON_FRAGMENTS_MAX_ROWS=5):
+            clear_fragment_store()
+            self.get("/towns")
+        self.assertEqual(len(get_fragment_store()), 5)
+
+    def test_streaming(self):
+        """
+            Check that large pages are streamed, with the same content, and
+            can still be batched.
+        """
+        for url in ("/towns?limit=30", "/aggs/towns"):
+            expected, body = self.get_with_drf(url)
+            with self.settings(API_JSON_STREAM_ROWS=20):
+                response, content = self.get(url)
+            self.assertTrue(response.streaming)
+            self.assertEqual(content, body)
+
+        with self.settings(API_JSON_STREAM_ROWS=20):
+            self.assertFalse(self.get("/towns?limit=10")[0].streaming)
+            response = self.client.post(
+                "/batch", {"queries": [{"path": "/aggs/towns"}]},
+                format="json")
+        self.assertEqual(response.json()["results"]["0"]["data"],
+                         expected.json())
@@ -4,15 +4,45 @@
     Declare the URL scheme used by the api app. We present the following
     endpoints:
     - /towns - Return the full list of towns
+    - /towns/columnar - Download the towns in a columnar binary format
+    - /towns/top - Return the top N towns in each region/department/district
+    - /aggs/{regions,departments,districts,towns} - Aggregate over one level
+    - /aggs/rollup - Aggregate over every level at once, as a tree
+    - /changes/{regions,departments,districts,towns} - Compare populations
+      between two census extracts (vintages)
+    - /regions/<code>[/departments/<code>[/districts/<code>[/towns/<code>]]]
+      - Return a single place, with its aggregates and child codes
+    - /batch - Run several queries against the endpoints above at once
+    - /status - Report the state of the worker handling the request
 """
 from django.conf.urls import url
-from .views import (DepartmentAggsView, DistrictAggsView, RegionAggsView,
-                    TownAggsView, TownsView)
+from .views import (BatchView, DepartmentAggsView, DistrictAggsView,
+                    PlaceDetailView, PopulationChangeView, RegionAggsView,
+                    RollupAggsView, StatusView, TopTownsView, TownAggsView,
+                    TownsColumnarView, TownsView)
+
+# The path to a place, from its region down (see PlaceDetailView)
+REGION_PATH = r'^regions/(?P<region_code>\d{1,2})'
+DEPARTMENT_PATH = (REGION_PATH +
+                   r'/departments/(?P<department_code>\d{1,3}[ABM]?)')
+DISTRICT_PATH = DEPARTMENT_PATH + r'/districts/(?P<district_code>\d{1,5})'
+TOWN_PATH = DISTRICT_PATH + r'/towns/(?P<town_code>\d{1,5})'
 
 urlpatterns = [
     url(r'^towns/?$', TownsView.as_view()),
+    url(r'^towns/columnar/?$', TownsColumnarView.as_view()),
+    url(r'^towns/top/?$', TopTownsView.as_view()),
     url(r'^aggs/regions/?$', RegionAggsView.as_view()),
     url(r'^aggs/departments/?$', DepartmentAggsView.as_view()),
     url(r'^aggs/districts/?$', DistrictAggsView.as_view()),
     url(r'^aggs/towns/?$', TownAggsView.as_view()),
+    url(r'^aggs/rollup/?$', RollupAggsView.as_view()),
+    url(r'^changes/(?P<level>regions|departments|districts|towns)/?$',
+        PopulationChangeView.as_view()),
+    url(REGION_PATH + r'/?$', PlaceDetailView.as_view()),
+    url(DEPARTMENT_PATH + r'/?$', PlaceDetailView.as_view()),
+    url(DISTRICT_PATH + r'/?$', PlaceDetailView.as_view()),
+    url(TOWN_PATH + r'/?$', PlaceDetailView.as_view()),
+    url(r'^batch/?$', BatchView.as_view()),
+    url(r'^status/?$', StatusView.as_view()),
 ]
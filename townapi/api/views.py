@@ -3,22 +3,227 @@
 
     This file declares views for the api app.
 """
-from django_filters import rest_framework as filters
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
 from rest_framework import generics
 
+from django.conf import settings
+from django.core.cache import caches
 from django.db.models import Avg, Count, F, IntegerField, Max, Min, Value
-from rest_framework.filters import OrderingFilter
-
+from django.http import StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import never_cache
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+from .batch import BatchError, InconsistentBatch, parse_batch, run_batch
+from .coalescing import get_coalescing_stats
+from .columnar import encode_towns
+from .constants import format_region_code
+from .dataset import get_dataset_version
+from .fastfilters import FastFilterBackend
 from .filters import (DepartmentAggsFilter, DistrictAggsFilter,
+                      PopulationChangeFilter, PopulationOrderingFilter,
                       TownAggsFilter, TownFilter)
-from .models import Department, District, Region, Town
+from .fragments import get_fragment_store
+from .hierarchy import HIERARCHY_LEVELS, get_hierarchy_index
+from .models import (Department, District, Region, Town, TownPopulation,
+                     Vintage)
 from .pagination import OneHundredResultsLimitOffsetPagination
+from .ranking import (RANK_FIELDS, TOWN_GROUPS, TOWN_SORT_FIELDS,
+                      top_n_per_group)
+from .renderers import ColumnarRenderer, PreEncodedJSONRenderer
+from .rollup import ROLLUP_MAX_DEPTH, build_rollup
 from .serializers import (DepartmentAggsSerializer, DistrictAggsSerializer,
-                          RegionAggsSerializer, TownAggsSerializer,
-                          TownSerializer, AggsSerializer)
+                          PlaceDetailSerializer,
+                          RegionAggsSerializer, RollupAggsSerializer,
+                          TownAggsSerializer, TownSerializer, AggsSerializer)
+from .vintages import (filter_vintage, get_population_changes,
+                       get_population_lookup, with_vintage_population)
+
+
+class SparseFieldsViewMixin:
+    """
+        Allow clients to limit the fields returned by a list view, using the
+        syntax:
 
+            ?fields=<FIELD>[,<FIELD>...]
 
-class TownsView(generics.ListAPIView):
+        The queryset is then pruned to match, so that only the joins and
+        columns needed by the requested fields are selected. Filtering and
+        ordering add any joins they need themselves, so they do not need to
+        be taken into account here.
+    """
+    fields_query_param = "fields"
+
+    def get_requested_fields(self):
+        """
+            Parse and validate the requested fields from the query string.
+
+            :returns: A list of field names, or None if all fields should be
+                      returned
+        """
+        if not self.fields_query_param:
+            return None
+
+        if not hasattr(self, "_requested_fields"):
+            value = self.request.query_params.get(self.fields_query_param)
+            fields = None
+
+            if value is not None:
+                fields = [field.strip() for field in value.split(",")
+                          if field.strip()]
+                available = self.get_serializer_class().Meta.fields
+                unknown = [field for field in fields
+                           if field not in available]
+
+                if unknown or not fields:
+                    raise ValidationError({self.fields_query_param: [
+                        "Unknown or missing field(s): {0}. Available fields "
+                        "are: {1}.".format(", ".join(unknown),
+                                           ", ".join(available))]})
+
+            self._requested_fields = fields
+
+        return self._requested_fields
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs.setdefault("fields", fields)
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields = self.get_requested_fields()
+        if fields is None:
+            return queryset
+
+        serializer = self.get_serializer_class()(fields=fields)
+        relations, columns = serializer.get_query_dependencies()
+
+        # Calling select_related() with no arguments would follow every
+        # relation, so only re-add relations if there are some
+        queryset = queryset.select_related(None)
+        if relations:
+            queryset = queryset.select_related(*relations)
+
+        return queryset.only(*columns)
+
+
+class VintageViewMixin:
+    """
+        Allow clients to ask for populations from a past census extract (a
+        vintage, see vintages.py) rather than the current ones, using the
+        syntax:
+
+            ?vintage=<YEAR>
+
+        Only towns with a population in that vintage are included.
+    """
+    vintage_query_param = "vintage"
+
+    def get_vintage_param(self, name, required=False):
+        """
+            Look up the vintage given by a query parameter.
+
+            :returns: A Vintage, or None if the parameter is not given
+        """
+        year = self.request.query_params.get(name)
+        if year is None and not required:
+            return None
+
+        vintage = None
+        if year is not None and year.isdigit():
+            vintage = Vintage.objects.filter(year=int(year)).first()
+
+        if vintage is None:
+            years = Vintage.objects.order_by("year") \
+                                   .values_list("year", flat=True)
+            raise ValidationError({name: [
+                "Unknown or missing vintage. Available vintages are: "
+                "{0}.".format(", ".join(str(year) for year in years))]})
+
+        return vintage
+
+    def get_vintage(self):
+        """
+            Get the requested vintage.
+
+            :returns: A Vintage, or None for the current populations
+        """
+        if not hasattr(self, "_vintage"):
+            self._vintage = self.get_vintage_param(self.vintage_query_param)
+        return self._vintage
+
+
+class PreEncodedRowsViewMixin:
+    """
+        Build the rows of a list view from the encoded rows kept for the
+        current dataset version (see fragments.py), so that each row is only
+        serialized and encoded once by each worker, rather than on every
+        request for a page which includes it. The vintage is part of the
+        key, so this needs VintageViewMixin.
+
+        Pages of at least API_JSON_STREAM_ROWS rows are streamed in chunks,
+        rather than rendered into memory all at once (streamed responses are
+        not cached by the middleware). Setting API_JSON_FRAGMENTS to False
+        turns all this off.
+    """
+    renderer_classes = (PreEncodedJSONRenderer, BrowsableAPIRenderer)
+
+    def uses_fragments(self):
+        """ Check whether the response is rendered from encoded rows """
+        return getattr(settings, "API_JSON_FRAGMENTS", True) and \
+            isinstance(self.request.accepted_renderer, PreEncodedJSONRenderer)
+
+    def list(self, request, *args, **kwargs):
+        if not self.uses_fragments():
+            return super().list(request, *args, **kwargs)
+
+        # Fetched before querying, so that the rows kept cannot come from a
+        # newer dataset version than the store
+        store = get_fragment_store()
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        vintage = self.get_vintage()
+
+        rows = store.encode(self.get_serializer(),
+                            queryset.iterator() if page is None else page,
+                            request.accepted_renderer.encode,
+                            key=vintage.pk if vintage is not None else None)
+
+        if page is None:
+            response = Response(rows)
+        else:
+            response = self.get_paginated_response(rows)
+        return self.stream_large_response(response, len(rows))
+
+    def stream_large_response(self, response, row_count):
+        """ Stream a response with at least API_JSON_STREAM_ROWS rows """
+        stream_rows = getattr(settings, "API_JSON_STREAM_ROWS", None)
+        if stream_rows is None or row_count < stream_rows:
+            return response
+
+        renderer = self.request.accepted_renderer
+        streamed = StreamingHttpResponse(
+            renderer.render_chunks(response.data,
+                                   self.request.accepted_media_type,
+                                   self.get_renderer_context()),
+            status=response.status_code,
+            content_type=renderer.media_type)
+        # Kept as on a Response, for batches and the slow request log
+        streamed.data = response.data
+        return streamed
+
+
+class TownsView(PreEncodedRowsViewMixin, VintageViewMixin,
+                SparseFieldsViewMixin, generics.ListAPIView):
     """
         Simple endpoint to return a list of French towns and cities. For each
         town, a JSON record is provided with information about the town and it
@@ -61,6 +266,37 @@ class TownsView(generics.ListAPIView):
         - Exact Population (`population`)
         - Minimum Population (`min_population`)
         - Maximum Population (`max_population`)
+        - Maximum Rank (`max_<LEVEL>_rank`)
+        - Minimum Percentile (`min_<LEVEL>_percentile`)
+
+        The fields in each record can be limited using the syntax:
+
+            /towns?fields=<FIELD>[,<FIELD>...]
+
+        (for example `/towns?fields=town_code,town_name,population`). Only the
+        parent places needed by the requested fields are looked up.
+
+        Each town's rank by population (1 for the largest) and percentile
+        within its district, department, region and the country are
+        precomputed, and are sent when asked for using `?fields=` (as
+        `<LEVEL>_rank` and `<LEVEL>_percentile`, where `<LEVEL>` is
+        `district`, `department`, `region` or `national`). They can also be
+        filtered and ordered on, for example:
+
+            /towns?max_department_rank=10&ordering=department_rank
+
+        The ranks are computed from the current populations at the end of
+        each import (or by the refresh_ranks command), so they are missing
+        for towns added since, and out of date for towns changed since (e.g.
+        through the admin site).
+
+        Populations from a past census extract can be requested using the
+        syntax:
+
+            /towns?vintage=<YEAR>
+
+        in which case population filters and ordering use that vintage too.
+        Rank filters and ordering cannot be used along with a vintage.
     """
     queryset = Town.objects.all() \
                    .select_related('district',
@@ -68,20 +304,243 @@ class TownsView(generics.ListAPIView):
                                    'district__department__region')
     serializer_class = TownSerializer
     pagination_class = OneHundredResultsLimitOffsetPagination
-    filter_backends = (OrderingFilter, filters.DjangoFilterBackend, )
+    filter_backends = (PopulationOrderingFilter, FastFilterBackend, )
     filter_class = TownFilter
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        vintage = self.get_vintage()
+        if vintage is not None:
+            self.check_no_rank_params()
+            queryset = with_vintage_population(queryset, vintage)
+        return queryset
+
+    def check_no_rank_params(self):
+        """
+            Reject rank filters and ordering, which would use the ranks from
+            the current populations rather than the requested vintage.
+        """
+        params = self.request.query_params
+        names = [name for name, rank_filter in TownFilter.base_filters.items()
+                 if rank_filter.field_name in RANK_FIELDS and name in params]
+
+        ordering_param = PopulationOrderingFilter.ordering_param
+        if any(term.strip().lstrip("-") in RANK_FIELDS
+               for term in params.get(ordering_param, "").split(",")):
+            names.append(ordering_param)
+
+        if names:
+            raise ValidationError({name: [
+                "Ranks are only available for the current populations, not "
+                "along with {0}.".format(self.vintage_query_param)]
+                for name in names})
+
+
+class TownsColumnarView(generics.GenericAPIView):
+    """
+        Bulk download of towns in a columnar binary format, for loading
+        straight into dataframes. Each column holds one of the fields of the
+        /towns endpoint, with codes and names dictionary-encoded and
+        populations as fixed-width integers. The layout is documented in
+        columnar.py, which also provides a reader (read_columnar).
 
-class AggsView(generics.ListAPIView):
+        Files are built once per dataset version (and set of filters), with
+        towns in the order they were added.
+
+        Filtering can be done using the same syntax and filters as the
+        /towns endpoint.
+    """
+    queryset = Town.objects.order_by("id")
+    renderer_classes = (ColumnarRenderer, )
+    filter_backends = (FastFilterBackend, )
+    filter_class = TownFilter
+
+    @classmethod
+    def get_cache_key(cls, query_params, dataset_version):
+        """
+            Key cached files on the dataset version and the filters used
+            (this is also used by admission control, see admission.py)
+        """
+        params = sorted((name, query_params.getlist(name))
+                        for name in cls.filter_class.base_filters
+                        if name in query_params)
+
+        return "api:columnar:{0}:{1}".format(
+            dataset_version,
+            hashlib.md5(json.dumps(params).encode("utf-8")).hexdigest())
+
+    def get_rows(self):
+        """ Get the filtered towns, formatted as for TownSerializer """
+        queryset = self.filter_queryset(self.get_queryset())
+
+        for row in queryset.values_list(
+                "code",
+                "name",
+                "population",
+                "district__code",
+                "district__department_id",
+                "district__department__region__code",
+                "district__department__region__name"):
+            yield (str(row[0]), row[1], row[2], str(row[3]), row[4],
+                   format_region_code(row[5]), row[6])
+
+    def get(self, request, *args, **kwargs):
+        cache = caches[settings.API_RESPONSE_CACHE]
+        dataset_version = get_dataset_version()
+        key = self.get_cache_key(request.query_params, dataset_version)
+
+        content = cache.get(key)
+        if content is None:
+            content = encode_towns(self.get_rows(), dataset_version)
+            cache.set(key, content, settings.API_RESPONSE_CACHE_TIMEOUT)
+
+        filename = "towns-{0}.columnar".format(dataset_version)
+        return Response(content, headers={
+            "Content-Disposition": 'attachment; filename="{0}"'
+                                   .format(filename)})
+
+
+class TopTownsView(generics.ListAPIView):
+    """
+        Endpoint to return the top N towns in each region, department or
+        district (for example, the 10 largest towns in each department).
+        The towns are grouped by their parent, using the following syntax:
+
+            /towns/top?group=<GROUP>&n=<N>&ordering=[-]<FIELD>
+
+        where `<GROUP>` is one of `region`, `department` or `district`
+        (`department` by default), `<N>` is the number of towns to return for
+        each group (10 by default) and `<FIELD>` is `population` or `name`
+        (towns are sorted by descending population by default). For example:
+
+            [
+                {
+                    "region_code": "84",
+                    "department_code": "1",
+                    "towns": [
+                        {
+                            "town_code": "53",
+                            "town_name": "Bourg-en-Bresse",
+                            "population": 41365,
+                            ...
+                        },
+                        ...
+                    ]
+                },
+                ...
+            ]
+
+        Each group is identified by the same fields as in the /towns records.
+        The ranking is done in a single query, using window functions.
+
+        Filtering can be done using the same syntax and filters as the
+        /towns endpoint (filters are applied before ranking).
+    """
+    queryset = Town.objects.all()
+    serializer_class = TownSerializer
+    filter_backends = (FastFilterBackend, )
+    filter_class = TownFilter
+    default_group = "department"
+    default_n = 10
+    max_n = 1000
+    default_ordering = "-population"
+
+    def get_parameters(self, request):
+        """
+            Read and validate the group, N and ordering from the query string
+
+            :returns: A tuple of (group, n, ordering)
+        """
+        params = request.query_params
+        errors = {}
+
+        group = params.get("group", self.default_group)
+        if group not in TOWN_GROUPS:
+            errors["group"] = ["Must be one of: {0}.".format(
+                ", ".join(sorted(TOWN_GROUPS)))]
+
+        try:
+            n = int(params.get("n", self.default_n))
+        except ValueError:
+            n = 0
+        if not 1 <= n <= self.max_n:
+            errors["n"] = ["Must be an integer between 1 and {0}.".format(
+                self.max_n)]
+
+        ordering = params.get("ordering", self.default_ordering)
+        if ordering.lstrip("-") not in TOWN_SORT_FIELDS:
+            errors["ordering"] = ["Must be one of: {0} (optionally prefixed "
+                                  "with -).".format(
+                                      ", ".join(TOWN_SORT_FIELDS))]
+
+        if errors:
+            raise ValidationError(errors)
+        return group, n, ordering
+
+    def list(self, request, *args, **kwargs):
+        group, n, ordering = self.get_parameters(request)
+        group_fields = TOWN_GROUPS[group][1]
+
+        towns = (top_n_per_group(self.filter_queryset(self.get_queryset()),
+                                 group,
+                                 n,
+                                 ordering)
+                 .select_related("district",
+                                 "district__department",
+                                 "district__department__region"))
+
+        groups = []
+        for town in self.get_serializer(towns, many=True).data:
+            key = [(field, town[field]) for field in group_fields]
+            if not groups or groups[-1][0] != key:
+                groups.append((key, []))
+            groups[-1][1].append(town)
+
+        return Response([OrderedDict(key + [("towns", members)])
+                         for key, members in groups])
+
+
+class AggsView(PreEncodedRowsViewMixin, VintageViewMixin,
+               SparseFieldsViewMixin, generics.ListAPIView):
     """
         Call through to the aggregate serializer to create the response
         but set the queryset based on the requested aggregation.
 
         This is a common view used for the different types of place
-        (to keep routing code simple)
+        (to keep routing code simple). As with /towns, the fields in each
+        record can be limited using `?fields=<FIELD>[,<FIELD>...]`, and
+        populations from a past census extract can be aggregated using
+        `?vintage=<YEAR>`.
     """
     serializer_class = AggsSerializer
-    filter_backends = (filters.DjangoFilterBackend, )
+    filter_backends = (FastFilterBackend, )
+    # The lookup from the aggregated model to its towns
+    town_path = None
+
+    def get_queryset(self):
+        return self.annotate_aggregates(super().get_queryset(),
+                                        self.get_vintage())
+
+    def annotate_aggregates(self, queryset, vintage):
+        """ Annotate each place with the aggregates of its towns """
+        population = get_population_lookup(self.town_path, vintage)
+
+        return (filter_vintage(queryset, self.town_path, vintage)
+                .annotate(min_population=Min(population),
+                          max_population=Max(population),
+                          avg_population=Avg(population),
+                          town_count=Count(self.town_path)))
+
+    def list(self, request, *args, **kwargs):
+        if self.uses_fragments():
+            return super().list(request, *args, **kwargs)
+
+        # These responses are not paginated, so serialize the results
+        # straight from the cursor rather than also keeping every model
+        # instance in the queryset's cache
+        queryset = self.filter_queryset(self.get_queryset())
+        serializer = self.get_serializer(queryset.iterator(), many=True)
+        return Response(serializer.data)
 
 
 class RegionAggsView(AggsView):
@@ -99,11 +558,8 @@ class RegionAggsView(AggsView):
             }
     """
     serializer_class = RegionAggsSerializer
-    queryset = Region.objects.annotate(
-        min_population=Min('department__district__town__population'),
-        max_population=Max('department__district__town__population'),
-        avg_population=Avg('department__district__town__population'),
-        town_count=Count('department__district__town'))
+    queryset = Region.objects.all()
+    town_path = "department__district__town"
 
 
 class DepartmentAggsView(AggsView):
@@ -126,11 +582,8 @@ class DepartmentAggsView(AggsView):
         - Region Code (`region_code`)
     """
     serializer_class = DepartmentAggsSerializer
-    queryset = Department.objects.select_related("region").annotate(
-        min_population=Min('district__town__population'),
-        max_population=Max('district__town__population'),
-        avg_population=Avg('district__town__population'),
-        town_count=Count('district__town'))
+    queryset = Department.objects.select_related("region")
+    town_path = "district__town"
     filter_class = DepartmentAggsFilter
 
 
@@ -157,11 +610,8 @@ class DistrictAggsView(AggsView):
     """
     serializer_class = DistrictAggsSerializer
     queryset = District.objects.select_related("department",
-                                               "department__region").annotate(
-        min_population=Min('town__population'),
-        max_population=Max('town__population'),
-        avg_population=Avg('town__population'),
-        town_count=Count('town'))
+                                               "department__region")
+    town_path = "town"
     filter_class = DistrictAggsFilter
 
 
@@ -190,12 +640,263 @@ class TownAggsView(AggsView):
         - District Code (`district_code`)
     """
     serializer_class = TownAggsSerializer
-    queryset = (Town.objects
-                .select_related("district",
-                                "district__department",
-                                "district__department__region")
-                .annotate(min_population=F('population'),
-                          max_population=F('population'),
-                          avg_population=F('population'),
+    queryset = Town.objects.select_related("district",
+                                           "district__department",
+                                           "district__department__region")
+    filter_class = TownAggsFilter
+
+    def annotate_aggregates(self, queryset, vintage):
+        """ Each town is aggregated on its own """
+        population = F(get_population_lookup("", vintage))
+
+        return (filter_vintage(queryset, "", vintage)
+                .annotate(min_population=population,
+                          max_population=population,
+                          avg_population=population,
                           town_count=Value(1, IntegerField())))
+
+
+class RollupAggsView(AggsView):
+    """
+        This endpoint provides the region, department and district
+        aggregations as a single tree, computed in one pass over the towns.
+        Each node has the same fields as the flat aggs endpoints, plus its
+        children (for example):
+
+            {
+                "code": "84",
+                "min_population": 12,
+                "max_population": 513275,
+                "avg_population": 1859,
+                "town_count": 4080,
+                "name": "Auvergne-Rhône-Alpes",
+                "departments": [
+                    {
+                        "code": "1",
+                        ...
+                        "districts": [
+                            {
+                                "code": 1,
+                                ...
+                            }
+                        ]
+                    }
+                ]
+            }
+
+        Only places which contain at least one town are included.
+
+        The depth of the tree can be limited using the syntax:
+
+            /aggs/rollup?depth=<DEPTH>
+
+        where `<DEPTH>` is 1 (regions only), 2 (regions and departments) or
+        3 (down to districts, the default).
+
+        Filtering can be done using the same syntax as the /towns endpoint,
+        with the following fields available to filter on:
+
+        - Region Code (`region_code`)
+        - Department Code (`department_code`)
+        - District Code (`district_code`)
+    """
+    serializer_class = RollupAggsSerializer
+    queryset = Town.objects.all()
     filter_class = TownAggsFilter
+    fields_query_param = None
+    depth_query_param = "depth"
+
+    def get_depth(self, request):
+        """ Read the requested depth of the tree from the query string """
+        depth = request.query_params.get(self.depth_query_param)
+        if depth is None:
+            return ROLLUP_MAX_DEPTH
+
+        try:
+            depth = int(depth)
+        except ValueError:
+            depth = 0
+
+        if not 1 <= depth <= ROLLUP_MAX_DEPTH:
+            raise ValidationError({
+                self.depth_query_param: ["Must be an integer between 1 and "
+                                         "{0}.".format(ROLLUP_MAX_DEPTH)]})
+        return depth
+
+    def annotate_aggregates(self, queryset, vintage):
+        """ The aggregates are calculated by build_rollup() instead """
+        return filter_vintage(queryset, "", vintage)
+
+    def list(self, request, *args, **kwargs):
+        depth = self.get_depth(request)
+        queryset = self.filter_queryset(self.get_queryset())
+        population = get_population_lookup("", self.get_vintage())
+
+        serializer = self.get_serializer(
+            build_rollup(queryset, depth, population), many=True)
+        return Response(serializer.data)
+
+
+class PopulationChangeView(VintageViewMixin, generics.ListAPIView):
+    """
+        This endpoint compares the populations of every place at one level
+        (`regions`, `departments`, `districts` or `towns`) between two census
+        extracts (vintages), using the syntax:
+
+            /changes/<LEVEL>?from=<YEAR>&to=<YEAR>
+
+        For each place, the following JSON record (for example) is provided:
+
+            {
+                "code": "1",
+                "region_code": "84",
+                "town_count": 410,
+                "start_population": 626127,
+                "end_population": 631877,
+                "change": 5750,
+                "change_percent": 0.92
+            }
+
+        Places at lower levels also include their parents' codes, and regions
+        and towns their name. Towns which are only in one of the vintages
+        count as having no population in the other.
+
+        Filtering can be done using the same syntax as the /towns endpoint,
+        with the following fields available to filter on:
+
+        - Region Code (`region_code`)
+        - Department Code (`department_code`)
+        - District Code (`district_code`)
+    """
+    queryset = TownPopulation.objects.all()
+    filter_backends = (FastFilterBackend, )
+    filter_class = PopulationChangeFilter
+    start_query_param = "from"
+    end_query_param = "to"
+
+    def list(self, request, *args, **kwargs):
+        start = self.get_vintage_param(self.start_query_param, required=True)
+        end = self.get_vintage_param(self.end_query_param, required=True)
+
+        return Response(get_population_changes(
+            self.filter_queryset(self.get_queryset()),
+            kwargs["level"],
+            start,
+            end))
+
+
+class PlaceDetailView(APIView):
+    """
+        This endpoint provides a single place, addressed by the codes of the
+        place and its parents:
+
+            /regions/<REGION>
+            /regions/<REGION>/departments/<DEPARTMENT>
+            /regions/<REGION>/departments/<DEPARTMENT>/districts/<DISTRICT>
+            /regions/<REGION>/departments/<DEPARTMENT>/districts/<DISTRICT>/
+                towns/<TOWN>
+
+        For each place, the same aggregates as the /aggs endpoints are
+        provided, along with the codes of its parents and its children. For
+        example, for a department:
+
+            {
+                "code": "1",
+                "min_population": 23,
+                "max_population": 42937,
+                "avg_population": 1569,
+                "town_count": 410,
+                "region_code": "84",
+                "districts": [1, 2, 3, 4]
+            }
+
+        Places are looked up in an in-memory index (see hierarchy.py), so this
+        does not need to query the database.
+    """
+    def get(self, request, *args, **kwargs):
+        codes = [parse(kwargs[field])
+                 for field, parse, _ in HIERARCHY_LEVELS
+                 if kwargs.get(field) is not None]
+
+        place = get_hierarchy_index().lookup(*codes)
+        if place is None:
+            raise NotFound("There is no place with this code.")
+
+        serializer = PlaceDetailSerializer(
+            place, context={"parent_codes": codes[:-1]})
+        return Response(serializer.data)
+
+
+class BatchView(APIView):
+    """
+        Run several queries against the other endpoints in one request, by
+        POSTing a JSON body of the form:
+
+            {
+                "queries": [
+                    {"id": "regions", "path": "/aggs/regions"},
+                    {"id": "top", "path": "/towns",
+                     "params": {"ordering": "-population", "limit": "10"}}
+                ]
+            }
+
+        The response has the result of each query (by its `id`, which
+        defaults to its position), as sent by the individual endpoint, along
+        with the dataset version every result comes from:
+
+            {
+                "dataset_version": 1234,
+                "results": {
+                    "regions": {"status": 200, "data": [...]},
+                    "top": {"status": 200, "data": {"count": ..., ...}}
+                }
+            }
+
+        Queries which fail have an `error` instead of `data`, without
+        affecting the rest of the batch. Identical queries are only run once,
+        and the others are run concurrently (see batch.py). At most
+        API_BATCH_MAX_QUERIES queries can be sent at once.
+    """
+    renderer_classes = (PreEncodedJSONRenderer, BrowsableAPIRenderer)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            sub_queries = parse_batch(request.data)
+        except BatchError as error:
+            raise ValidationError({"queries": [str(error)]})
+
+        try:
+            version, results = run_batch(request._request, sub_queries)
+        except InconsistentBatch:
+            response = Response(
+                {"detail": "The data changed while the batch was running. "
+                           "Please try again."},
+                status=503)
+            response["Retry-After"] = str(settings.API_ADMISSION_RETRY_AFTER)
+            return response
+
+        return Response(OrderedDict((
+            ("dataset_version", version),
+            ("results", results),
+        )))
+
+
+# The views which can be queried in a batch (read-only JSON endpoints)
+BATCH_VIEWS = (TownsView, TopTownsView, AggsView, PopulationChangeView,
+               PlaceDetailView)
+
+
+@method_decorator(never_cache, name="dispatch")
+class StatusView(APIView):
+    """
+        Report the state of the worker handling the request, including how
+        many requests it has coalesced (see RequestCoalescingMiddleware).
+        Counters are kept separately by each worker.
+    """
+
+    def get(self, request, *args, **kwargs):
+        return Response(OrderedDict((
+            ("pid", os.getpid()),
+            ("dataset_version", get_dataset_version()),
+            ("coalescing", get_coalescing_stats()),
+        )))
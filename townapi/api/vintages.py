@@ -0,0 +1,140 @@
+"""
+    vintages.py
+
+    Provide queries over the populations of past census extracts (vintages,
+    see the Vintage and TownPopulation models).
+
+    Towns, aggregates and the rollup can all be computed for a vintage by
+    reading populations through the town's vintage_populations (filtered to
+    that vintage) rather than from Town.population. Changes between two
+    vintages are computed with a single grouped query over TownPopulation.
+"""
+from collections import OrderedDict
+
+from django.db.models import Case, Count, F, IntegerField, Sum, When
+
+from .constants import format_region_code
+
+# The name of the annotation holding a town's population in a vintage
+VINTAGE_POPULATION = "vintage_population"
+
+# Lookups (from TownPopulation) for the fields of the places changes are
+# computed for
+REGION_CODE_LOOKUP = "town__district__department__region__code"
+DEPARTMENT_CODE_LOOKUP = "town__district__department__code"
+DISTRICT_CODE_LOOKUP = "town__district__code"
+
+# The levels changes can be computed at. Each level has the lookup which
+# uniquely identifies a place, and the fields returned for it (starting with
+# its code) as (name, lookup, display) tuples. Codes are displayed in the same
+# way as by the flat aggs serializers.
+CHANGE_LEVELS = OrderedDict((
+    ("regions", (
+        REGION_CODE_LOOKUP,
+        (("code", REGION_CODE_LOOKUP, format_region_code),
+         ("name", "town__district__department__region__name", str)))),
+    ("departments", (
+        DEPARTMENT_CODE_LOOKUP,
+        (("code", DEPARTMENT_CODE_LOOKUP, str),
+         ("region_code", REGION_CODE_LOOKUP, format_region_code)))),
+    ("districts", (
+        "town__district_id",
+        (("code", DISTRICT_CODE_LOOKUP, int),
+         ("region_code", REGION_CODE_LOOKUP, format_region_code),
+         ("department_code", DEPARTMENT_CODE_LOOKUP, str)))),
+    ("towns", (
+        "town_id",
+        (("code", "town__code", int),
+         ("name", "town__name", str),
+         ("region_code", REGION_CODE_LOOKUP, format_region_code),
+         ("department_code", DEPARTMENT_CODE_LOOKUP, str),
+         ("district_code", DISTRICT_CODE_LOOKUP, int)))),
+))
+
+
+def get_population_lookup(town_path, vintage):
+    """
+        Get the lookup for the population of the towns at the end of a path.
+
+        :param town_path: The lookup from the queried model to its towns (or
+                          "" for towns themselves)
+        :param vintage: The Vintage to read populations from, or None for
+                        the current populations
+    """
+    prefix = town_path + "__" if town_path else ""
+    if vintage is None:
+        return prefix + "population"
+    return prefix + "vintage_populations__population"
+
+
+def filter_vintage(queryset, town_path, vintage):
+    """
+        Limit a queryset to the towns which have a population in a vintage.
+        Aggregates over get_population_lookup() annotated afterwards then
+        only read that vintage's populations.
+    """
+    if vintage is None:
+        return queryset
+
+    prefix = town_path + "__" if town_path else ""
+    return queryset.filter(**{prefix + "vintage_populations__vintage":
+                              vintage})
+
+
+def with_vintage_population(towns, vintage):
+    """
+        Annotate a Town queryset with each town's population in a vintage (as
+        VINTAGE_POPULATION), leaving out towns without one.
+    """
+    return (filter_vintage(towns, "", vintage)
+            .annotate(**{VINTAGE_POPULATION:
+                         F(get_population_lookup("", vintage))}))
+
+
+def _vintage_sum(vintage):
+    """ Sum the populations from one vintage only """
+    return Sum(Case(When(vintage=vintage, then=F("population")),
+                    default=0,
+                    output_field=IntegerField()))
+
+
+def get_population_changes(populations, level, start, end):
+    """
+        Compare the populations of every place at one level between two
+        vintages, using a single query.
+
+        :param populations: A (possibly filtered) TownPopulation queryset
+        :param level: One of the keys of CHANGE_LEVELS
+        :param start: The Vintage to compare from
+        :param end: The Vintage to compare to
+        :returns: A list of dictionaries, one per place (ordered by code), with
+                  the place's fields, the populations in both vintages, the
+                  change and the change as a percentage (or None if the start
+                  population is 0). Places only in one vintage count as 0 in
+                  the other.
+    """
+    key, fields = CHANGE_LEVELS[level]
+    lookups = [key] + [lookup for _, lookup, _ in fields if lookup != key]
+
+    rows = (populations.filter(vintage__in=(start, end))
+                       .order_by()
+                       .values(*lookups)
+                       .annotate(start_population=_vintage_sum(start),
+                                 end_population=_vintage_sum(end),
+                                 town_count=Count("town_id", distinct=True))
+                       .order_by(fields[0][1], key))
+
+    changes = []
+    for row in rows:
+        change = OrderedDict((name, display(row[lookup]))
+                             for name, lookup, display in fields)
+        change["town_count"] = row["town_count"]
+        change["start_population"] = row["start_population"]
+        change["end_population"] = row["end_population"]
+        change["change"] = row["end_population"] - row["start_population"]
+        change["change_percent"] = (
+            round(100 * change["change"] / row["start_population"], 2)
+            if row["start_population"] else None)
+        changes.append(change)
+
+    return changes
@@ -0,0 +1,197 @@
+"""
+    warmup.py
+
+    Warm up a freshly started (or freshly imported) api by replaying the most
+    frequently requested URLs in-process.
+
+    This builds the URL resolvers, loads the database pages used by the
+    aggregations into memory and fills the response cache (see
+    CompressedResponseCacheMiddleware), so the first real users do not pay
+    the cold cost.
+
+    The URLs replayed are those in API_WARMUP_URLS, followed by the most
+    frequent successful /towns and /aggs/* requests in the gunicorn access
+    log at API_WARMUP_ACCESS_LOG (if set), up to API_WARMUP_MAX_URLS in
+    total. The access log must use gunicorn's default format (or at least
+    contain the request line in quotes followed by the status).
+
+    Only workers with a response cache shared between processes benefit from
+    a warm-up run in another process (see has_shared_response_cache).
+"""
+import re
+import time
+from collections import Counter, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import Client
+
+# Requests worth replaying (only GETs of the api endpoints)
+WARMUP_URL_PATTERN = re.compile(r"^/(towns|aggs/[a-z]+)/?(\?|$)")
+
+# The request line and status of an access log entry
+ACCESS_LOG_PATTERN = re.compile(r'"(?P<method>[A-Z]+) (?P<url>\S+) [^"]*" '
+                                r'(?P<status>\d{3}) ')
+
+# How many times to retry a request rejected by admission control, and the
+# longest to wait (in seconds) before each retry, whatever Retry-After says
+WARMUP_RETRIES = 30
+WARMUP_MAX_RETRY_WAIT = 5
+
+WarmUpResult = namedtuple("WarmUpResult", ("url", "status", "seconds"))
+
+
+class WarmUpReport:
+    """
+        The outcome of a warm-up: which URLs were requested, how long it
+        took, and how much of the logged traffic the URLs cover.
+    """
+
+    def __init__(self, results, seconds, coverage=None):
+        self.results = results
+        self.seconds = seconds
+        self.coverage = coverage
+
+    @property
+    def failed(self):
+        """ The results of requests which did not succeed """
+        return [result for result in self.results if result.status != 200]
+
+    def summary(self):
+        """ Describe the warm-up in one line """
+        summary = "Warmed up {0} URLs in {1:.2f}s ({2} failed)".format(
+            len(self.results), self.seconds, len(self.failed))
+
+        if self.coverage is not None:
+            summary += ", covering {0:.1%} of logged requests".format(
+                self.coverage)
+        return summary
+
+
+def read_access_log(path):
+    """
+        Count the successful GET requests to the api endpoints in a gunicorn
+        access log.
+
+        :returns: A Counter of URLs (with query strings)
+    """
+    counts = Counter()
+
+    with open(path, encoding="utf-8", errors="replace") as access_log:
+        for line in access_log:
+            match = ACCESS_LOG_PATTERN.search(line)
+            if match is None or match.group("method") != "GET" or \
+                    match.group("status") != "200":
+                continue
+
+            url = match.group("url")
+            if WARMUP_URL_PATTERN.match(url):
+                counts[url] += 1
+
+    return counts
+
+
+def get_warmup_urls(urls=None, access_log=None, max_urls=None):
+    """
+        Work out which URLs to replay, without duplicates.
+
+        :param urls: URLs to always replay (API_WARMUP_URLS by default)
+        :param access_log: The path to an access log to take the most
+                           frequent URLs from (API_WARMUP_ACCESS_LOG by
+                           default)
+        :param max_urls: The maximum number of URLs to replay
+                         (API_WARMUP_MAX_URLS by default)
+        :returns: A tuple of (URLs, logged request counts), where the counts
+                  are a Counter of URLs (or None if there is no access log)
+    """
+    if urls is None:
+        urls = settings.API_WARMUP_URLS
+    if access_log is None:
+        access_log = settings.API_WARMUP_ACCESS_LOG
+    if max_urls is None:
+        max_urls = settings.API_WARMUP_MAX_URLS
+
+    counts = read_access_log(access_log) if access_log else None
+    candidates = list(urls)
+    if counts:
+        candidates.extend(url for url, _ in counts.most_common())
+
+    selected = []
+    for url in candidates:
+        if len(selected) >= max_urls:
+            break
+        if url not in selected:
+            selected.append(url)
+
+    return selected, counts
+
+
+def has_shared_response_cache():
+    """
+        Check whether the response cache is shared between processes, i.e.
+        whether responses cached by one process are served by the others.
+    """
+    return not isinstance(caches[settings.API_RESPONSE_CACHE],
+                          (LocMemCache, DummyCache))
+
+
+def get_with_retries(client, url, heartbeat=None, **extra):
+    """
+        Make a GET request, waiting and retrying while admission control
+        rejects it (see AdmissionControlMiddleware).
+
+        :param heartbeat: A function to call before each wait (e.g. to tell
+                          gunicorn that the worker is still alive)
+        :returns: The final response
+    """
+    response = client.get(url, **extra)
+
+    for _ in range(WARMUP_RETRIES):
+        if response.status_code != 503:
+            break
+        if heartbeat is not None:
+            heartbeat()
+        time.sleep(min(int(response.get("Retry-After", 1)),
+                       WARMUP_MAX_RETRY_WAIT))
+        response = client.get(url, **extra)
+
+    return response
+
+
+def warm_up(urls=None, access_log=None, max_urls=None, host=None,
+            progress=None, heartbeat=None):
+    """
+        Replay the warm-up URLs (see get_warmup_urls) in-process.
+
+        :param host: The Host header to send, which should match the one real
+                     clients use, as it is part of the cache key
+                     (API_WARMUP_HOST by default)
+        :param progress: A function to call with each WarmUpResult
+        :param heartbeat: A function to call after each request and before
+                          each retry (see get_with_retries)
+        :returns: A WarmUpReport
+    """
+    start = time.perf_counter()
+    urls, counts = get_warmup_urls(urls, access_log, max_urls)
+    client = Client(HTTP_HOST=host or settings.API_WARMUP_HOST)
+
+    results = []
+    for url in urls:
+        request_start = time.perf_counter()
+        response = get_with_retries(client, url, heartbeat,
+                                    HTTP_ACCEPT="application/json")
+        results.append(WarmUpResult(url,
+                                    response.status_code,
+                                    time.perf_counter() - request_start))
+        if heartbeat is not None:
+            heartbeat()
+        if progress is not None:
+            progress(results[-1])
+
+    coverage = None
+    if counts:
+        coverage = sum(counts[url] for url in urls) / sum(counts.values())
+
+    return WarmUpReport(results, time.perf_counter() - start, coverage)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -39,11 +40,15 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'django_filters',
-    'api',
+    'api.apps.ApiConfig',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.SlowRequestMiddleware',
+    'api.middleware.CompressedResponseCacheMiddleware',
+    'api.middleware.RequestCoalescingMiddleware',
+    'api.middleware.AdmissionControlMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -92,6 +97,108 @@ DATABASES = {
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/1.11/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    }
+}
+
+# API responses are cached (along with their compressed variants) for each
+# version of the dataset, so the timeout only needs to limit memory use
+API_RESPONSE_CACHE = 'default'
+API_RESPONSE_CACHE_TIMEOUT = 60 * 60
+
+# Responses smaller than this (in bytes) are not worth compressing
+API_COMPRESSION_MIN_SIZE = 1024
+
+# The number of requests of each cost class (see api/admission.py) which may
+# run at once across all workers. Classes which are not listed are unlimited.
+API_ADMISSION_LIMITS = {
+    'expensive': 2,
+    'moderate': 4,
+}
+API_ADMISSION_LOCK_DIR = os.path.join(tempfile.gettempdir(),
+                                      'townapi-admission')
+API_ADMISSION_RETRY_AFTER = 1
+# /towns requests with offsets or limits at least this large are expensive
+API_ADMISSION_DEEP_OFFSET = 10000
+API_ADMISSION_LARGE_LIMIT = 1000
+
+# The largest page of results which can be requested (with ?limit=)
+API_MAX_PAGE_LIMIT = 10000
+
+# Requests which take longer than this many seconds are recorded, with their
+# SQL statements and query plans, in a rotating log (see api/slowlog.py). Set
+# the threshold to None to turn recording off.
+API_SLOW_REQUEST_THRESHOLD = 1.0
+API_SLOW_REQUEST_LOG = os.path.join(BASE_DIR, 'logs', 'slow_requests.log')
+API_SLOW_REQUEST_LOG_MAX_BYTES = 10 * 1024 * 1024
+API_SLOW_REQUEST_LOG_BACKUPS = 5
+API_SLOW_REQUEST_MAX_STATEMENTS = 200
+# Statement parameters are only kept (apart from the slowest statement's) once
+# a request has run for this many seconds
+API_SLOW_REQUEST_DETAIL_AFTER = 0.5
+
+# Batches (see api/batch.py) can have at most API_BATCH_MAX_QUERIES queries,
+# which are run on a pool of API_BATCH_WORKERS threads per process (or one at
+# a time if this is 0). Batches are re-run up to API_BATCH_RETRIES times if
+# the data changes while they are running.
+API_BATCH_MAX_QUERIES = 50
+API_BATCH_WORKERS = 4
+API_BATCH_RETRIES = 2
+
+# Map simple filters straight to queryset lookups, rather than going through
+# django-filter's forms (see api/fastfilters.py)
+API_FAST_FILTERS = True
+
+# Rows of the /towns and /aggs pages are encoded as JSON once per dataset
+# version and kept (up to API_JSON_FRAGMENTS_MAX_ROWS rows per worker), so
+# that pages are built by joining the encoded rows (see api/fragments.py).
+# Pages of at least API_JSON_STREAM_ROWS rows (such as a full /aggs/towns, or
+# a /towns page near API_MAX_PAGE_LIMIT) are streamed, and not cached.
+API_JSON_FRAGMENTS = True
+API_JSON_FRAGMENTS_MAX_ROWS = 500000
+API_JSON_STREAM_ROWS = 5000
+
+# Identical requests which arrive while one is already running wait (for up to
+# this many seconds) and share its response. Set API_COALESCING_SHARED to also
+# coalesce across workers, which needs a cache shared between them.
+API_COALESCING_TIMEOUT = 30
+API_COALESCING_SHARED = False
+API_COALESCING_CACHE = 'default'
+API_COALESCING_SHARED_TTL = 5
+
+# The most requested responses are rendered into a static snapshot after each
+# import, for nginx to serve directly (see the render_snapshot command). The
+# snapshot is rendered for API_SNAPSHOT_HOST, with relative pagination links,
+# and is taken down whenever the data changes until it is rendered again.
+API_SNAPSHOT_ROOT = os.path.join(BASE_DIR, 'snapshot')
+API_SNAPSHOT_HOST = 'localhost'
+API_SNAPSHOT_TOWNS_PAGES = 5
+
+# Each worker replays these URLs (followed by the most frequent ones in the
+# access log, if set) before handling requests (see api/warmup.py)
+API_WARMUP_ON_START = True
+API_WARMUP_URLS = [
+    '/towns',
+    '/towns?ordering=-population',
+    '/aggs/regions',
+    '/aggs/departments',
+    '/aggs/districts',
+    '/aggs/towns',
+    '/aggs/rollup',
+]
+API_WARMUP_ACCESS_LOG = None
+API_WARMUP_MAX_URLS = 50
+API_WARMUP_HOST = 'localhost'
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 